@@ -0,0 +1,396 @@
+import argparse
+import csv
+import json
+import time
+
+import numpy as np
+
+import synthetic_scan
+from calibration import calibrate_cloud, calibrate_mesh
+from mesh_volume import connected_components, mesh_volume
+from pointcloud_volume import alpha_volume, hull_volume, voxel_volume
+from reference_cube import CUBE_VOLUME_CM3
+from voxel_grid import voxel_downsample
+
+# Sweeps of a default run: share of the faces kept by the decimation, voxel size of the cloud
+# downsampling (mm, 0 for the full cloud) and standard deviation of the noise (mm)
+DEFAULT_RATIOS = (1.0, 0.5, 0.25, 0.1, 0.05, 0.02)
+DEFAULT_VOXEL_SIZES = (0.0, 0.5, 1.0, 2.0, 3.0)
+DEFAULT_NOISE = (0.0, 0.2, 0.5)
+
+# Largest relative error accepted for every trait
+DEFAULT_TOLERANCES = {"volume": 0.05, "calibrated_volume": 0.05, "cube_edge": 0.05, "volume_voxel": 0.05,
+                      "volume_alpha": 0.05, "volume_hull": 0.05}
+
+# Midpoint subdivisions of ReferenceObject.stl, so the decimation has faces to remove
+STL_SUBDIVISIONS = 3
+
+# mm³ -> cm³
+CM3_PER_MM3 = 1e-3
+
+CSV_FIELDS = ["kind", "trait", "object", "resolution", "noise", "seed", "size", "value", "truth", "error",
+              "reduce_seconds", "measure_seconds"]
+
+
+def subdivide(vertices, faces, levels=1):
+    """
+    Split every triangle in four at the midpoints of its edges, levels times (the surface is unchanged).
+
+    Args:
+        vertices (np.ndarray): (n, 3) vertex coordinates.
+        faces (np.ndarray): (m, 3) triangle vertex indices.
+        levels (int, optional): Number of subdivisions. Defaults to 1.
+
+    Returns:
+        tuple[np.ndarray, np.ndarray]: Vertices and faces (4**levels times as many).
+    """
+    vertices, faces = np.asarray(vertices, dtype=np.float64), np.asarray(faces, dtype=np.int64)
+    for _ in range(levels):
+        edges = np.sort(faces[:, [0, 1, 1, 2, 2, 0]].reshape(-1, 2), axis=1)
+        unique, inverse = np.unique(edges, axis=0, return_inverse=True)
+        middle = (len(vertices) + inverse.ravel()).reshape(-1, 3)
+        vertices = np.concatenate([vertices, vertices[unique].mean(axis=1)])
+        a, b, c = faces.T
+        ab, bc, ca = middle.T
+        faces = np.concatenate([np.stack(corners, axis=1) for corners in
+                                ((a, ab, ca), (ab, b, bc), (ca, bc, c), (ab, bc, ca))])
+    return vertices, faces
+
+
+def icosphere(radius, levels=5):
+    """Triangulated sphere: a subdivided icosahedron with its vertices pushed onto the sphere."""
+    t = (1 + np.sqrt(5)) / 2
+    vertices = np.array([[-1, t, 0], [1, t, 0], [-1, -t, 0], [1, -t, 0], [0, -1, t], [0, 1, t],
+                         [0, -1, -t], [0, 1, -t], [t, 0, -1], [t, 0, 1], [-t, 0, -1], [-t, 0, 1]], dtype=np.float64)
+    faces = np.array([[0, 11, 5], [0, 5, 1], [0, 1, 7], [0, 7, 10], [0, 10, 11], [1, 5, 9], [5, 11, 4],
+                      [11, 10, 2], [10, 7, 6], [7, 1, 8], [3, 9, 4], [3, 4, 2], [3, 2, 6], [3, 6, 8],
+                      [3, 8, 9], [4, 9, 5], [2, 4, 11], [6, 2, 10], [8, 6, 7], [9, 8, 1]])
+    vertices, faces = subdivide(vertices, faces, levels)
+    return radius * vertices / np.linalg.norm(vertices, axis=1, keepdims=True), faces
+
+
+def cylinder(radius, height, segments=256, levels=2):
+    """Closed triangulated cylinder along z, its base at z = 0, subdivided levels times."""
+    angle = np.arange(segments) * 2 * np.pi / segments
+    ring = np.stack([radius * np.cos(angle), radius * np.sin(angle), np.zeros(segments)], axis=1)
+    vertices = np.concatenate([ring, ring + [0, 0, height], [[0, 0, 0], [0, 0, height]]])
+    i, j = np.arange(segments), (np.arange(segments) + 1) % segments
+    bottom, top = 2 * segments, 2 * segments + 1
+    faces = np.concatenate([np.stack([i, j, j + segments], axis=1), np.stack([i, j + segments, i + segments], axis=1),
+                            np.stack([np.full(segments, bottom), j, i], axis=1),
+                            np.stack([np.full(segments, top), i + segments, j + segments], axis=1)])
+    return subdivide(vertices, faces, levels)
+
+
+def known_solids():
+    """
+    Test objects of known volume, in mm: the parts of ReferenceObject.stl (their exact enclosed
+    volumes), a sphere of radius 30 and a cylinder of radius 20 and height 60 (analytic volumes).
+
+    Returns:
+        list[dict]: name, vertices, faces and volume (mm³) of every object.
+    """
+    reference = synthetic_scan.reference_object()
+    vertices, faces = subdivide(reference["vertices"], reference["faces"], STL_SUBDIVISIONS)
+    # subdivide appends the four children of the faces block by block
+    face_part = np.tile(reference["face_part"], 4 ** STL_SUBDIVISIONS)
+    solids = [{"name": "reference_cube", "vertices": vertices, "faces": faces[face_part == synthetic_scan.CUBE],
+               "volume": reference["cube_volume"]},
+              {"name": "reference_stick", "vertices": vertices, "faces": faces[face_part == synthetic_scan.STICK],
+               "volume": mesh_volume(vertices, faces[face_part == synthetic_scan.STICK])}]
+    sphere_vertices, sphere_faces = icosphere(30.0)
+    solids.append({"name": "sphere", "vertices": sphere_vertices, "faces": sphere_faces, "volume": 4 / 3 * np.pi * 30.0 ** 3})
+    cylinder_vertices, cylinder_faces = cylinder(20.0, 60.0)
+    solids.append({"name": "cylinder", "vertices": cylinder_vertices, "faces": cylinder_faces, "volume": np.pi * 20.0 ** 2 * 60.0})
+    return solids
+
+
+def mesh_scene(solids, spacing=120.0):
+    """
+    All the solids in one mesh, side by side along x, as loose parts of one scan.
+
+    Returns:
+        tuple[np.ndarray, np.ndarray, np.ndarray]: Vertices, faces and the index in solids of every face.
+    """
+    vertices, faces, owner = [], [], []
+    offset, shift = 0, 0.0
+    for index, solid in enumerate(solids):
+        # The parts of the reference object stay where they are, together
+        if not solid["name"].startswith("reference"):
+            shift += spacing
+        used, local = np.unique(solid["faces"], return_inverse=True)
+        vertices.append(solid["vertices"][used] + [shift, 0, 0])
+        faces.append(local.reshape(-1, 3) + offset)
+        owner.append(np.full(len(solid["faces"]), index))
+        offset += len(used)
+    return np.concatenate(vertices), np.concatenate(faces), np.concatenate(owner)
+
+
+def cluster_vertices(vertices, faces, cell_size, labels=None):
+    """
+    Vertex clustering decimation: the vertices of every grid cell are merged at their mean, and
+    the triangles left with fewer than three distinct vertices are removed.
+
+    Args:
+        vertices (np.ndarray): (n, 3) vertex coordinates.
+        faces (np.ndarray): (m, 3) triangle vertex indices.
+        cell_size (float): Edge of the grid cells.
+        labels (np.ndarray, optional): (n,) loose part of every vertex; parts are never merged together.
+
+    Returns:
+        tuple[np.ndarray, np.ndarray, np.ndarray]: Vertices, faces and the indices of the kept faces.
+    """
+    cells = np.floor((vertices - vertices.min(axis=0)) / cell_size).astype(np.int64)
+    if labels is not None:
+        cells = np.column_stack([labels, cells])
+    _, inverse, counts = np.unique(cells, axis=0, return_inverse=True, return_counts=True)
+    inverse = inverse.ravel()
+    merged = np.stack([np.bincount(inverse, weights=column) for column in vertices.T], axis=1) / counts[:, None]
+    new_faces = inverse[faces]
+    kept = np.flatnonzero((new_faces[:, 0] != new_faces[:, 1]) & (new_faces[:, 1] != new_faces[:, 2])
+                          & (new_faces[:, 2] != new_faces[:, 0]))
+    # Triangles merged onto the same three vertices are kept once
+    _, first = np.unique(np.sort(new_faces[kept], axis=1), axis=0, return_index=True)
+    kept = kept[np.sort(first)]
+    return merged, new_faces[kept], kept
+
+
+def decimate(vertices, faces, ratio, labels=None, iterations=16):
+    """
+    Decimate a mesh to about ratio x its faces by vertex clustering, the cell size found by bisection.
+
+    Args:
+        vertices (np.ndarray): (n, 3) vertex coordinates.
+        faces (np.ndarray): (m, 3) triangle vertex indices.
+        ratio (float): Share of the faces to keep, in (0, 1].
+        labels (np.ndarray, optional): See cluster_vertices.
+        iterations (int, optional): Bisection steps on the cell size. Defaults to 16.
+
+    Returns:
+        tuple[np.ndarray, np.ndarray, np.ndarray]: See cluster_vertices.
+    """
+    if ratio >= 1:
+        return vertices, faces, np.arange(len(faces))
+    target = ratio * len(faces)
+    low, high = 1e-6, float(np.linalg.norm(np.ptp(vertices, axis=0)))
+    best = None
+    for _ in range(iterations):
+        cell_size = np.sqrt(low * high)
+        result = cluster_vertices(vertices, faces, cell_size, labels)
+        if len(result[1]) > target:
+            low = cell_size
+        else:
+            high = cell_size
+        if best is None or abs(len(result[1]) - target) < abs(len(best[1]) - target):
+            best = result
+    return best
+
+
+def _error(value, truth):
+    return None if value is None else abs(value - truth) / truth
+
+
+def mesh_sweep(ratios=DEFAULT_RATIOS, noise_levels=DEFAULT_NOISE, seeds=(0,), cube_volume_cm3=CUBE_VOLUME_CM3):
+    """
+    Volume and cube edge of the known solids after noise on the vertices and decimation.
+
+    Every setting decimates the whole scene (mesh_scene), then calibrates it with its cube part
+    (calibration.calibrate_mesh) and measures the volume of every solid, raw (mm³) and calibrated
+    (cm³, with cube_volume_cm3 as the volume of the cube part, as OBJECT_volumePlant).
+
+    Returns:
+        list[dict]: One record per trait, object, ratio, noise and seed (see CSV_FIELDS).
+    """
+    solids = known_solids()
+    vertices, faces, owner = mesh_scene(solids)
+    labels = connected_components(len(vertices), faces)[1]
+    records = []
+    for noise in noise_levels:
+        for seed in seeds:
+            noisy = vertices + np.random.default_rng(seed).normal(0, noise, vertices.shape) if noise else vertices
+            for ratio in ratios:
+                start = time.perf_counter()
+                reduced, reduced_faces, kept = decimate(noisy, faces, ratio, labels)
+                reduce_seconds = time.perf_counter() - start
+
+                start = time.perf_counter()
+                calibration = calibrate_mesh(reduced, reduced_faces)
+                volumes = [mesh_volume(reduced, reduced_faces[owner[kept] == index]) for index in range(len(solids))]
+                measure_seconds = time.perf_counter() - start
+
+                ratio_cm3 = None if calibration is None else calibration["volume_ratio"] * cube_volume_cm3 / CUBE_VOLUME_CM3
+                setting = {"kind": "mesh", "resolution": ratio, "noise": noise, "seed": seed, "size": len(reduced_faces),
+                           "reduce_seconds": reduce_seconds, "measure_seconds": measure_seconds}
+                edge = None if calibration is None else calibration["cube_edge"]
+                records.append({**setting, "trait": "cube_edge", "object": "reference_cube", "value": edge,
+                                "truth": np.cbrt(solids[0]["volume"])})
+                for solid, volume in zip(solids, volumes):
+                    records.append({**setting, "trait": "volume", "object": solid["name"], "value": volume,
+                                    "truth": solid["volume"]})
+                    records.append({**setting, "trait": "calibrated_volume", "object": solid["name"],
+                                    "value": None if ratio_cm3 is None else volume * ratio_cm3,
+                                    "truth": solid["volume"] * CM3_PER_MM3})
+    for record in records:
+        record["error"] = _error(record["value"], record["truth"])
+    return records
+
+
+def cloud_sweep(voxel_sizes=DEFAULT_VOXEL_SIZES, noise_levels=DEFAULT_NOISE, seeds=(0,), n_points=300_000):
+    """
+    Cube edge found in synthetic scans (see synthetic_scan.py) of several noise levels, voxel downsampled.
+
+    The scans show the same plant for every setting, sampled again for every seed.
+
+    Returns:
+        list[dict]: One record per trait, voxel size, noise and seed (see CSV_FIELDS).
+    """
+    records = []
+    for noise in noise_levels:
+        for seed in seeds:
+            scan = synthetic_scan.synthetic_scan(n_points, seed=0, noise=noise, sample_seed=seed)
+            for voxel_size in voxel_sizes:
+                start = time.perf_counter()
+                if voxel_size:
+                    points, colors = voxel_downsample(scan["points"], voxel_size, scan["colors"] / 255)
+                else:
+                    points, colors = scan["points"].astype(np.float64), scan["colors"]
+                reduce_seconds = time.perf_counter() - start
+
+                start = time.perf_counter()
+                calibration = calibrate_cloud(points, colors)
+                measure_seconds = time.perf_counter() - start
+                records.append({"kind": "cloud", "trait": "cube_edge", "object": "reference_cube",
+                                "resolution": voxel_size, "noise": noise, "seed": seed, "size": len(points),
+                                "value": None if calibration is None else calibration["cube_edge"],
+                                "truth": scan["cube_edge"], "reduce_seconds": reduce_seconds,
+                                "measure_seconds": measure_seconds})
+    for record in records:
+        record["error"] = _error(record["value"], record["truth"])
+    return records
+
+
+def cloud_volume_sweep(voxel_sizes=DEFAULT_VOXEL_SIZES, noise_levels=DEFAULT_NOISE, seeds=(0,), n_points=300_000):
+    """
+    Point cloud volumes (see pointcloud_volume.py) of the known solids, sampled on their surfaces.
+
+    The voxel size is the one of the occupancy volume and of the downsampling before the alpha
+    shape and the hull; the alpha radius is 3/4 of the size of the solid, so it fills it.
+
+    Returns:
+        list[dict]: One record per trait, solid, voxel size (0 is skipped), noise and seed (see CSV_FIELDS).
+    """
+    estimators = {"volume_voxel": lambda points, voxel_size, solid: voxel_volume(points, voxel_size),
+                  "volume_alpha": lambda points, voxel_size, solid: alpha_volume(
+                      voxel_downsample(points, voxel_size)[0], 0.75 * np.ptp(solid["vertices"][solid["faces"]].reshape(-1, 3), axis=0).max()),
+                  "volume_hull": lambda points, voxel_size, solid: hull_volume(voxel_downsample(points, voxel_size)[0])}
+    records = []
+    for noise in noise_levels:
+        for seed in seeds:
+            rng = np.random.default_rng(seed)
+            for solid in known_solids():
+                points = synthetic_scan.sample_triangles(solid["vertices"], solid["faces"], n_points, rng)
+                points += rng.normal(0, noise, points.shape)
+                for voxel_size in voxel_sizes:
+                    if not voxel_size:
+                        continue
+                    for trait, estimate in estimators.items():
+                        start = time.perf_counter()
+                        value = estimate(points, voxel_size, solid)
+                        records.append({"kind": "cloud", "trait": trait, "object": solid["name"], "resolution": voxel_size,
+                                        "noise": noise, "seed": seed, "size": len(points), "value": value,
+                                        "truth": solid["volume"], "reduce_seconds": 0.0,
+                                        "measure_seconds": time.perf_counter() - start})
+    for record in records:
+        record["error"] = _error(record["value"], record["truth"])
+    return records
+
+
+def choose_settings(records, tolerances=None):
+    """
+    Cheapest resolution of every trait and noise level whose error stays within the tolerance.
+
+    The error of a resolution is the largest one over the objects and seeds (a failed measure is
+    out of tolerance), its cost the mean measure time.
+
+    Args:
+        records (list[dict]): Records of mesh_sweep and cloud_sweep.
+        tolerances (dict, optional): Largest relative error of every trait. Defaults to DEFAULT_TOLERANCES.
+
+    Returns:
+        list[dict]: kind, trait, noise, tolerance, then resolution, error and measure_seconds of the
+                    choice (None when no resolution is within the tolerance).
+    """
+    tolerances = {**DEFAULT_TOLERANCES, **(tolerances or {})}
+    groups = {}
+    for record in records:
+        groups.setdefault((record["kind"], record["trait"], record["noise"]), {}).setdefault(record["resolution"], []).append(record)
+    choices = []
+    for (kind, trait, noise), resolutions in groups.items():
+        tolerance = tolerances.get(trait)
+        best = None
+        for resolution, group in resolutions.items():
+            errors = [record["error"] for record in group]
+            error = np.inf if any(value is None for value in errors) else max(errors)
+            seconds = float(np.mean([record["measure_seconds"] for record in group]))
+            if tolerance is not None and error <= tolerance and (best is None or seconds < best["measure_seconds"]):
+                best = {"resolution": resolution, "error": error, "measure_seconds": seconds}
+        choices.append({"kind": kind, "trait": trait, "noise": noise, "tolerance": tolerance,
+                        **(best or {"resolution": None, "error": None, "measure_seconds": None})})
+    return choices
+
+
+def print_choices(choices):
+    """Print the table of choose_settings."""
+    print(f"{'kind':<6} {'trait':<18} {'noise':>6} {'tolerance':>9} {'resolution':>10} {'error':>8} {'seconds':>8}")
+    for choice in choices:
+        head = f"{choice['kind']:<6} {choice['trait']:<18} {choice['noise']:>6g} {choice['tolerance'] or 0:>9.1%}"
+        if choice["resolution"] is None:
+            print(f"{head} {'none':>10}")
+        else:
+            print(f"{head} {choice['resolution']:>10g} {choice['error']:>8.2%} {choice['measure_seconds']:>8.3f}")
+
+
+def parse_tolerances(items):
+    """Parse "trait=value" items into a dict of tolerances."""
+    tolerances = {}
+    for item in items or []:
+        trait, _, value = item.partition("=")
+        if not value:
+            raise ValueError(f"Expected trait=value, got {item!r}")
+        tolerances[trait] = float(value)
+    return tolerances
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Measure the accuracy and cost of the volume and calibration traits against known objects.")
+    parser.add_argument("--ratios", type=float, nargs="+", default=list(DEFAULT_RATIOS), help="Shares of the mesh faces kept by the decimation")
+    parser.add_argument("--voxel_sizes", type=float, nargs="+", default=list(DEFAULT_VOXEL_SIZES), help="Voxel sizes of the cloud downsampling in mm, 0 for none")
+    parser.add_argument("--noise", type=float, nargs="+", default=list(DEFAULT_NOISE), help="Noise levels (standard deviation in mm)")
+    parser.add_argument("--seeds", type=int, default=2, help="Noise and sampling draws of every setting (default: 2)")
+    parser.add_argument("--points", type=int, default=300_000, help="Points of the synthetic scans (default: 300000)")
+    parser.add_argument("--cube_volume", type=float, default=CUBE_VOLUME_CM3, help=f"Volume of the cube part in cm³ for the calibrated volumes (default: {CUBE_VOLUME_CM3})")
+    parser.add_argument("--tolerance", action="append", default=None, metavar="TRAIT=VALUE", help="Largest relative error of a trait, e.g. volume=0.01 (repeatable)")
+    parser.add_argument("--skip", nargs="+", default=[], choices=["mesh", "cloud", "volume"], help="Sweeps not to run")
+    parser.add_argument("--csv", type=str, default=None, help="Write every measure to this CSV file")
+    parser.add_argument("--json", type=str, default=None, help="Write the chosen settings to this JSON file")
+
+    args = parser.parse_args()
+    seeds = range(args.seeds)
+    records = []
+    if "mesh" not in args.skip:
+        records += mesh_sweep(args.ratios, args.noise, seeds, args.cube_volume)
+    if "cloud" not in args.skip:
+        records += cloud_sweep(args.voxel_sizes, args.noise, seeds, args.points)
+    if "volume" not in args.skip:
+        records += cloud_volume_sweep(args.voxel_sizes, args.noise, seeds, args.points)
+    if args.csv:
+        with open(args.csv, "w", newline="") as file:
+            writer = csv.DictWriter(file, fieldnames=CSV_FIELDS)
+            writer.writeheader()
+            writer.writerows(records)
+        print(f"{len(records)} measures saved to {args.csv}")
+    choices = choose_settings(records, parse_tolerances(args.tolerance))
+    print_choices(choices)
+    if args.json:
+        with open(args.json, "w") as file:
+            json.dump(choices, file, indent=2)
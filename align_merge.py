@@ -1,65 +1,410 @@
-import open3d as o3d
+import argparse
+import glob
+import json
+import os
+import re
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+
 import numpy as np
+import open3d as o3d
+
+import ply_io
+import reference_cube
+from feature_cache import FeatureCache
+from stage_timer import StageTimer
+
+# Default registration parameters (same values as the original hand-run script)
+DEFAULT_PARAMS = {
+    'voxel_size': 0.02,             # Downsampling pour réduire le nombre de points
+    'normal_radius': 0.1,           # Estimation de normales
+    'normal_max_nn': 30,
+    'fpfh_radius': 0.25,            # Calcul des features FPFH pour les correspondances
+    'fpfh_max_nn': 100,
+    'distance_threshold': 0.05,     # Distance maximale pour considérer une correspondance (RANSAC)
+    'ransac_max_iteration': 4000000,
+    'ransac_confidence': 0.999,
+    'icp_threshold': 0.02,          # Distance maximale de l'ICP au niveau le plus fin
+    'icp_levels': (4, 2, 1),        # Taille des voxels de la pyramide ICP, en multiples de voxel_size
+    'icp_max_iteration': (50, 30, 20),
+    'prior': 'cube',                # Alignement initial: 'cube' (cube de référence) ou 'ransac' (FPFH + RANSAC)
+    'cube_steps': 36,               # Nombre d'angles essayés autour de l'axe du cube
+    'feature_workers': 2,           # Threads des features des deux nuages (1: l'un après l'autre)
+}
+
+PRIORS = ('cube', 'ransac')
+
+
+# Parameters the downsampled cloud and its features depend on (the cache key)
+FEATURE_PARAMS = ('voxel_size', 'normal_radius', 'normal_max_nn', 'fpfh_radius', 'fpfh_max_nn')
+
+
+def preprocess(pcd, params, cache=None, path=None):
+    """
+    Downsample a point cloud, estimate its normals and compute its FPFH features.
+
+    Args:
+        pcd (o3d.geometry.PointCloud): Full resolution point cloud.
+        params (dict): Registration parameters (see DEFAULT_PARAMS).
+        cache (FeatureCache, optional): Cache of the results, keyed by the content of path and FEATURE_PARAMS.
+        path (str, optional): File pcd was loaded from, required to use the cache.
+
+    Returns:
+        tuple: The downsampled point cloud and its FPFH features (o3d.pipelines.registration.Feature).
+    """
+    if cache is not None and path is not None:
+        key = cache.key(path, {name: params[name] for name in FEATURE_PARAMS})
+        arrays = cache.load(key)
+        if arrays is not None:
+            down = o3d.geometry.PointCloud()
+            down.points = o3d.utility.Vector3dVector(arrays['points'])
+            down.normals = o3d.utility.Vector3dVector(arrays['normals'])
+            fpfh = o3d.pipelines.registration.Feature()
+            fpfh.data = arrays['fpfh']
+            return down, fpfh
+
+    down = pcd.voxel_down_sample(voxel_size=params['voxel_size'])
+    down.estimate_normals(search_param=o3d.geometry.KDTreeSearchParamHybrid(
+        radius=params['normal_radius'], max_nn=params['normal_max_nn']))
+    fpfh = o3d.pipelines.registration.compute_fpfh_feature(
+        down, o3d.geometry.KDTreeSearchParamHybrid(radius=params['fpfh_radius'], max_nn=params['fpfh_max_nn']))
+
+    if cache is not None and path is not None:
+        cache.store(key, {'points': np.asarray(down.points), 'normals': np.asarray(down.normals),
+                          'fpfh': np.asarray(fpfh.data)})
+    return down, fpfh
+
+
+def compute_features(source, target, params, cache=None, source_file=None, target_file=None):
+    """
+    Run preprocess on both clouds at the same time, in params['feature_workers'] threads (Open3D
+    releases the GIL in the downsampling, normals and FPFH). The "features" stage of the result
+    JSON of every pair records the time; feature_workers=1 preprocesses the clouds one after the other.
+    """
+    with ThreadPoolExecutor(max_workers=params.get('feature_workers', 2)) as pool:
+        source_job = pool.submit(preprocess, source, params, cache, source_file)
+        target_job = pool.submit(preprocess, target, params, cache, target_file)
+        return source_job.result(), target_job.result()
+
+
+def global_registration(source_down, target_down, source_fpfh, target_fpfh, params):
+    """
+    Initial alignment by RANSAC on FPFH feature matches.
+
+    Returns:
+        o3d.pipelines.registration.RegistrationResult: Result of the global registration.
+    """
+    distance_threshold = params['distance_threshold']
+    return o3d.pipelines.registration.registration_ransac_based_on_feature_matching(
+        source_down, target_down, source_fpfh, target_fpfh, True,
+        distance_threshold,
+        o3d.pipelines.registration.TransformationEstimationPointToPoint(),
+        ransac_n=4,
+        checkers=[
+            o3d.pipelines.registration.CorrespondenceCheckerBasedOnEdgeLength(0.9),
+            o3d.pipelines.registration.CorrespondenceCheckerBasedOnDistance(distance_threshold)
+        ],
+        criteria=o3d.pipelines.registration.RANSACConvergenceCriteria(
+            max_iteration=params['ransac_max_iteration'], confidence=params['ransac_confidence'])
+    )
+
+
+def cube_prior(source, target, params):
+    """
+    Initial alignment from the reference cube found in both scans.
+
+    The cube is segmented by colour and geometry in each scan (reference_cube.segment_cube),
+    which fixes the translation and the direction from the scan centre to the cube. The rotation
+    about that direction is sampled (cube_steps angles) and the candidate that fits the two
+    downsampled scans best is kept. This replaces the global FPFH + RANSAC search and cannot
+    lock onto the symmetric pot rim, since the cube is off the pot axis.
+
+    Args:
+        source (o3d.geometry.PointCloud): Full resolution source cloud, with colours.
+        target (o3d.geometry.PointCloud): Full resolution target cloud, with colours.
+        params (dict): Registration parameters (see DEFAULT_PARAMS).
+
+    Returns:
+        np.ndarray | None: (4, 4) initial transformation, or None if the cube was not found in both scans.
+    """
+    if not (source.has_colors() and target.has_colors()):
+        return None
+    source_points = np.asarray(source.points)
+    target_points = np.asarray(target.points)
+    source_cube = reference_cube.segment_cube(source_points, np.asarray(source.colors))
+    target_cube = reference_cube.segment_cube(target_points, np.asarray(target.colors))
+    if source_cube is None or target_cube is None:
+        return None
+
+    # Score the candidates at the coarsest level of the ICP pyramid
+    coarsest, finest = max(params['icp_levels']), min(params['icp_levels'])
+    source_coarse = source.voxel_down_sample(coarsest * params['voxel_size'])
+    target_coarse = target.voxel_down_sample(coarsest * params['voxel_size'])
+    threshold = params['icp_threshold'] * coarsest / finest
+    best_score, best = None, None
+    for transformation in reference_cube.cube_prior_candidates(
+            source_points[source_cube], source_points.mean(axis=0),
+            target_points[target_cube], target_points.mean(axis=0), params['cube_steps']):
+        evaluation = o3d.pipelines.registration.evaluate_registration(source_coarse, target_coarse, threshold, transformation)
+        score = (evaluation.fitness, -evaluation.inlier_rmse)
+        if best_score is None or score > best_score:
+            best_score, best = score, transformation
+    return best
+
+
+def multiscale_icp(source, target, init, params):
+    """
+    Refine an alignment with ICP over a coarse-to-fine voxel pyramid.
+
+    Each level downsamples both clouds with a voxel size of level * voxel_size and runs a
+    point-to-point ICP started from the previous level, with a correspondence distance scaled
+    the same way. The finest level uses icp_threshold, so the full resolution ICP of the
+    original script is replaced by cheap passes on smaller clouds.
+
+    Args:
+        source (o3d.geometry.PointCloud): Full resolution source cloud.
+        target (o3d.geometry.PointCloud): Full resolution target cloud.
+        init (np.ndarray): (4, 4) initial transformation of the source.
+        params (dict): Registration parameters (see DEFAULT_PARAMS).
+
+    Returns:
+        o3d.pipelines.registration.RegistrationResult: Result of the finest level.
+    """
+    transformation = init
+    result = None
+    finest = min(params['icp_levels'])
+    for level, max_iteration in zip(params['icp_levels'], params['icp_max_iteration']):
+        voxel_size = level * params['voxel_size']
+        result = o3d.pipelines.registration.registration_icp(
+            source.voxel_down_sample(voxel_size), target.voxel_down_sample(voxel_size),
+            params['icp_threshold'] * level / finest, transformation,
+            o3d.pipelines.registration.TransformationEstimationPointToPoint(),
+            o3d.pipelines.registration.ICPConvergenceCriteria(max_iteration=max_iteration)
+        )
+        transformation = result.transformation
+    return result
+
+
+def register_pair(source_file, target_file, output_file, params=None, verbose=False, cache=None):
+    """
+    Align the 0° scan (source) on the -8° scan (target) and save the merged cloud.
+
+    Args:
+        source_file (str): Path to the 0° scan (.ply).
+        target_file (str): Path to the -8° scan (.ply).
+        output_file (str): Path of the merged .ply file. The transformation and fitness are
+                           written next to it, with a .json extension.
+        params (dict, optional): Registration parameters overriding DEFAULT_PARAMS.
+        verbose (bool, optional): Print the time of each stage. Defaults to False.
+        cache (FeatureCache, optional): Cache of the downsampled clouds and FPFH features.
+
+    Returns:
+        dict: Transformation (4x4 list), fitness and inlier RMSE of the ICP, initial alignment used and stage timings.
+    """
+    params = {**DEFAULT_PARAMS, **(params or {})}
+    timer = StageTimer(verbose=verbose)
+
+    # Charger les deux nuages de points
+    with timer.stage("load") as stage:
+        source = o3d.io.read_point_cloud(source_file)
+        target = o3d.io.read_point_cloud(target_file)
+        stage["points"] = len(source.points) + len(target.points)
+
+    # Alignement initial par le cube de référence
+    init = None
+    prior = params['prior']
+    if prior == 'cube':
+        with timer.stage("cube"):
+            init = cube_prior(source, target, params)
+        if init is None:
+            print(f"Reference cube not found in {source_file} or {target_file}, using RANSAC.")
+            prior = 'ransac'
+
+    # Alignement initial par RANSAC
+    ransac_fitness = None
+    if init is None:
+        with timer.stage("features"):
+            (source_down, source_fpfh), (target_down, target_fpfh) = compute_features(
+                source, target, params, cache, source_file, target_file)
+
+        with timer.stage("ransac", len(source_down.points) + len(target_down.points)):
+            result_ransac = global_registration(source_down, target_down, source_fpfh, target_fpfh, params)
+        init = result_ransac.transformation
+        ransac_fitness = result_ransac.fitness
+
+    # Affiner l'alignement avec ICP
+    with timer.stage("icp"):
+        result_icp = multiscale_icp(source, target, init, params)
+
+    # Appliquer la transformation sur le nuage de points source et fusionner
+    with timer.stage("merge") as stage:
+        source.transform(result_icp.transformation)
+        merged_pcd = source + target
+        colors = np.asarray(merged_pcd.colors) if merged_pcd.has_colors() else None
+        normals = np.asarray(merged_pcd.normals) if merged_pcd.has_normals() else None
+        ply_io.write_points(output_file, np.asarray(merged_pcd.points), colors, normals)
+        stage["points"] = len(merged_pcd.points)
+
+    result = {
+        'source': source_file,
+        'target': target_file,
+        'output': output_file,
+        'transformation': np.asarray(result_icp.transformation).tolist(),
+        'fitness': result_icp.fitness,
+        'inlier_rmse': result_icp.inlier_rmse,
+        'prior': prior,
+        'ransac_fitness': ransac_fitness,
+        'params': params,
+        'seconds': timer.total,
+        'stages': timer.stages,
+    }
+    with open(result_path_for(output_file), 'w') as file:
+        json.dump(result, file, indent=2)
+    return result
+
+
+# ------ Batch mode
+
+
+def find_pairs(directory):
+    """
+    Pair every 0° scan with its -8° scan, e.g. A2L-D6-8-C-0_pc.ply with A2L-D6-8-C-8_pc.ply.
+
+    Args:
+        directory (str): Directory holding the scans.
+
+    Returns:
+        list[tuple[str, str, str]]: (name, 0° scan, -8° scan) for every complete pair, name being the
+                                    plant name without angle (A2L-D6-8-C). Incomplete pairs are reported.
+    """
+    pairs = []
+    for source_file in sorted(glob.glob(os.path.join(directory, "*-0*.ply"))):
+        match = re.fullmatch(r"(.+)-0(_pc)?\.ply", os.path.basename(source_file))
+        if match is None:
+            continue
+        name, suffix = match.group(1), match.group(2) or ""
+        target_file = os.path.join(directory, f"{name}-8{suffix}.ply")
+        if os.path.exists(target_file):
+            pairs.append((name, source_file, target_file))
+        else:
+            print(f"No -8 scan for {source_file}, skipped.")
+    return pairs
+
+
+def output_path_for(name, output_dir):
+    """Path of the merged cloud of a plant, e.g. Merge_A2L-D6-8-C_pc.ply."""
+    return os.path.join(output_dir, f"Merge_{name}_pc.ply")
+
+
+def result_path_for(output_file):
+    """Path of the JSON file holding the transformation and fitness of a merged cloud."""
+    return os.path.splitext(output_file)[0] + ".json"
+
+
+# Parameters that do not change the merged cloud, left out of the up-to-date check
+RUN_ONLY_PARAMS = ('feature_workers',)
+
+
+def _output_params(params):
+    # Parameters as stored in the JSON result (tuples become lists), without RUN_ONLY_PARAMS
+    params = json.loads(json.dumps({**DEFAULT_PARAMS, **(params or {})}))
+    return {key: value for key, value in params.items() if key not in RUN_ONLY_PARAMS}
+
+
+def is_current(source_file, target_file, output_file, params=None):
+    """
+    True if the merged cloud and its JSON result exist, are not older than both scans, and were made
+    with the same parameters (the "params" of the JSON result, see register_pair).
+    """
+    result_file = result_path_for(output_file)
+    if not (os.path.exists(output_file) and os.path.exists(result_file)):
+        return False
+    if os.path.getmtime(output_file) < max(os.path.getmtime(source_file), os.path.getmtime(target_file)):
+        return False
+    try:
+        with open(result_file) as file:
+            stored = json.load(file).get('params')
+    except ValueError:
+        return False
+    return stored is not None and _output_params(stored) == _output_params(params)
+
+
+def _pair_job(name, source_file, target_file, output_file, params, cache):
+    # Runs in a worker process
+    try:
+        result = register_pair(source_file, target_file, output_file, params, cache=cache)
+        result['status'] = 'done'
+    except Exception as error:
+        result = {'source': source_file, 'output': output_file, 'status': f'failed: {error}'}
+    result['name'] = name
+    return result
+
+
+def run_pairs(directory, output_dir, params=None, workers=None, force=False, cache=None):
+    """
+    Register and merge every 0°/-8° pair of a directory on a process pool.
+
+    Args:
+        directory (str): Directory holding the scans (see find_pairs).
+        output_dir (str): Directory of the merged clouds and their JSON results.
+        params (dict, optional): Registration parameters overriding DEFAULT_PARAMS.
+        workers (int, optional): Number of worker processes. Defaults to the number of CPUs.
+        force (bool, optional): Redo pairs whose merged cloud is already up to date (see is_current). Defaults to False.
+        cache (FeatureCache, optional): Cache of the downsampled clouds and FPFH features.
+
+    Returns:
+        list[dict]: One result per pair (see register_pair), with a status.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    results = []
+    jobs = []
+    for name, source_file, target_file in find_pairs(directory):
+        output_file = output_path_for(name, output_dir)
+        if not force and is_current(source_file, target_file, output_file, params):
+            results.append({'name': name, 'output': output_file, 'status': 'skipped'})
+        else:
+            jobs.append((name, source_file, target_file, output_file))
+
+    print(f"{len(jobs) + len(results)} pairs, {len(jobs)} to register, {len(results)} up to date.")
+    if jobs:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            futures = [pool.submit(_pair_job, *job, params, cache) for job in jobs]
+            for done, future in enumerate(as_completed(futures), 1):
+                result = future.result()
+                results.append(result)
+                if result['status'] == 'done':
+                    print(f"[{done}/{len(jobs)}] {result['name']}: fitness {result['fitness']:.3f}, "
+                          f"rmse {result['inlier_rmse']:.4f}, {result['seconds']:.1f} s")
+                else:
+                    print(f"[{done}/{len(jobs)}] {result['name']}: {result['status']}")
+    return sorted(results, key=lambda result: result['name'])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Register and merge the 0° and -8° scans of every plant.")
+    parser.add_argument("scans", type=str, help="Directory holding the *-0_pc.ply and *-8_pc.ply scans.")
+    parser.add_argument("output_dir", type=str, help="Directory of the merged clouds (Merge_<plant>_pc.ply + .json).")
+    parser.add_argument("--voxel_size", type=float, default=DEFAULT_PARAMS['voxel_size'], help="Voxel size of the feature computation (default: 0.02)")
+    parser.add_argument("--distance_threshold", type=float, default=DEFAULT_PARAMS['distance_threshold'], help="RANSAC correspondence distance (default: 0.05)")
+    parser.add_argument("--icp_threshold", type=float, default=DEFAULT_PARAMS['icp_threshold'], help="ICP correspondence distance at the finest level (default: 0.02)")
+    parser.add_argument("--prior", choices=PRIORS, default=DEFAULT_PARAMS['prior'], help="Initial alignment: reference cube, or FPFH + RANSAC over the whole clouds (default: cube)")
+    parser.add_argument("--workers", type=int, default=None, help="Number of pairs registered in parallel (default: number of CPUs)")
+    parser.add_argument("--feature_workers", type=int, default=DEFAULT_PARAMS['feature_workers'], help="Threads computing the features of the two clouds of a pair, 1 for one after the other (default: 2)")
+    parser.add_argument("--force", action="store_true", help="Redo pairs whose merged cloud is already up to date")
+    parser.add_argument("--cache_dir", type=str, default=".feature_cache", help="Cache of the downsampled clouds and FPFH features, '' to disable (default: .feature_cache)")
+    parser.add_argument("--cache_size_mb", type=float, default=2048, help="Size of the feature cache above which the least recently used entries are removed (default: 2048)")
+    parser.add_argument("--view", action="store_true", help="Show each merged cloud (runs the pairs one after the other)")
+
+    args = parser.parse_args()
+    params = {'voxel_size': args.voxel_size, 'distance_threshold': args.distance_threshold,
+              'icp_threshold': args.icp_threshold, 'prior': args.prior, 'feature_workers': args.feature_workers}
+    cache = FeatureCache(args.cache_dir, int(args.cache_size_mb * 2**20)) if args.cache_dir else None
 
-# Charger les deux nuages de points (remplace par tes fichiers)
-print("Loading files...\n")
-source = o3d.io.read_point_cloud("scans/A2L-D6-8-C-0_pc.ply")
-target = o3d.io.read_point_cloud("scans/A2L-D6-8-C-8_pc.ply")
-print("Done.\n")
-
-# Downsampling pour réduire le nombre de points (facultatif)
-print("Downsampling to reduce number of points...\n")
-source_down = source.voxel_down_sample(voxel_size=0.02)
-target_down = target.voxel_down_sample(voxel_size=0.02)
-print("Done.\n")
-
-# Estimation de normales (facultatif, mais utile pour un meilleur alignement)
-print("Estimating Normals...\n")
-source_down.estimate_normals(search_param=o3d.geometry.KDTreeSearchParamHybrid(radius=0.1, max_nn=30))
-target_down.estimate_normals(search_param=o3d.geometry.KDTreeSearchParamHybrid(radius=0.1, max_nn=30))
-print("Done.\n")
-
-# Calcul des features FPFH pour les correspondances
-print("computing Features...\n")
-source_fpfh = o3d.pipelines.registration.compute_fpfh_feature(
-    source_down, o3d.geometry.KDTreeSearchParamHybrid(radius=0.25, max_nn=100))
-target_fpfh = o3d.pipelines.registration.compute_fpfh_feature(
-    target_down, o3d.geometry.KDTreeSearchParamHybrid(radius=0.25, max_nn=100))
-print("Done.\n")
-
-# Alignement initial par RANSAC
-print("RANSAC...\n")
-distance_threshold = 0.05  # Distance maximale pour considérer une correspondance
-result_ransac = o3d.pipelines.registration.registration_ransac_based_on_feature_matching(
-    source_down, target_down, source_fpfh, target_fpfh, True,
-    distance_threshold,
-    o3d.pipelines.registration.TransformationEstimationPointToPoint(),
-    ransac_n=4,
-    checkers=[
-        o3d.pipelines.registration.CorrespondenceCheckerBasedOnEdgeLength(0.9),
-        o3d.pipelines.registration.CorrespondenceCheckerBasedOnDistance(distance_threshold)
-    ],
-    criteria=o3d.pipelines.registration.RANSACConvergenceCriteria(4000000, 500)
-)
-print("Done.\n")
-
-# Affiner l'alignement avec ICP
-print("Adjusting alignment...\n")
-result_icp = o3d.pipelines.registration.registration_icp(
-    source, target, 0.02, result_ransac.transformation,
-    o3d.pipelines.registration.TransformationEstimationPointToPoint()
-)
-print("Done.\n")
-
-# Appliquer la transformation sur le nuage de points source
-print("Applying result on source...\n")
-source.transform(result_icp.transformation)
-print("Done.\n")
-
-# Fusionner les nuages de points alignés
-print("Merging pointclouds...\n")
-merged_pcd = source + target
-print("Done.\n")
-
-# Afficher le résultat
-o3d.visualization.draw_geometries([merged_pcd], window_name="Nuage de points fusionné")
+    if args.view:
+        os.makedirs(args.output_dir, exist_ok=True)
+        for name, source_file, target_file in find_pairs(args.scans):
+            output_file = output_path_for(name, args.output_dir)
+            register_pair(source_file, target_file, output_file, params, verbose=True, cache=cache)
+            # Afficher le résultat
+            o3d.visualization.draw_geometries([o3d.io.read_point_cloud(output_file)], window_name="Nuage de points fusionné")
+    else:
+        run_pairs(args.scans, args.output_dir, params, args.workers, args.force, cache)
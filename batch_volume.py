@@ -0,0 +1,216 @@
+"""
+Plant volume of every PLY mesh of a folder, without the Blender UI.
+
+Run it with Blender in background mode (or with plain Python, then Blender is started for the workers):
+
+    blender --background --python batch_volume.py -- scans/meshes volumes.csv --workers 4
+
+Each worker is one background Blender process that handles a share of the files: it imports a
+mesh, separates its loose parts, picks the reference cube (smallest cube-like part) and computes
+the cube-calibrated plant volume like the "Get plant volume" operator of get_measures.py.
+The results of all the workers are gathered in one CSV file.
+"""
+import argparse
+import csv
+import glob
+import os
+import subprocess
+import sys
+import tempfile
+
+import numpy as np
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+from mesh_volume import CSV_FIELDS, STORED_TRAITS
+from reference_cube import CUBE_VOLUME_CM3, box_extents, pick_cube_part
+from trait_store import TraitStore, record_rows
+
+try:
+    import bpy
+    import bmesh
+    from blender_io import world_vertices
+except ImportError:
+    # Plain Python: only the coordinator can run, the workers are Blender processes
+    bpy = None
+
+# ------ Worker (inside Blender)
+
+
+def clear_scene():
+    """Remove every object and the meshes they leave behind."""
+    for obj in list(bpy.data.objects):
+        bpy.data.objects.remove(obj, do_unlink=True)
+    for mesh in list(bpy.data.meshes):
+        if mesh.users == 0:
+            bpy.data.meshes.remove(mesh)
+
+
+def import_ply(path):
+    """Import a PLY file and return the new object."""
+    if hasattr(bpy.ops.wm, "ply_import"):
+        bpy.ops.wm.ply_import(filepath=path)  # Blender >= 3.6
+    else:
+        bpy.ops.import_mesh.ply(filepath=path)
+    return bpy.context.selected_objects[0]
+
+
+def separate_loose_parts(obj):
+    """Separate a mesh object by loose parts (like OBJECT_separate) and return the parts."""
+    bpy.ops.object.select_all(action='DESELECT')
+    obj.select_set(True)
+    bpy.context.view_layer.objects.active = obj
+    bpy.ops.object.mode_set(mode='EDIT')
+    bpy.ops.mesh.select_all(action='SELECT')
+    bpy.ops.mesh.separate(type='LOOSE')
+    bpy.ops.object.mode_set(mode='OBJECT')
+    return list(bpy.context.selected_objects)
+
+
+def part_measures(obj):
+    """Volume (world space, like mesh_helpers.bmesh_copy_from_object), box extents and vertex count of a part."""
+    bm = bmesh.new()
+    bm.from_mesh(obj.data)
+    bm.transform(obj.matrix_world)
+    volume = bm.calc_volume()
+    bm.free()
+    points = world_vertices(obj)
+    extents = box_extents(points) if len(points) >= 4 else np.zeros(3)
+    return {"volume": volume, "extents": extents, "vertices": len(points)}
+
+
+def plant_volume(path):
+    """
+    Compute the cube-calibrated plant volume of one PLY mesh.
+
+    The ratio is CUBE_VOLUME_CM3 / cube volume, as in OBJECT_volumePlant; the unit settings of
+    the scene cancel out in the ratio, so the result is in cm³ whatever the scene units.
+
+    Args:
+        path (str): Path to the .ply mesh (plant and reference cube).
+
+    Returns:
+        dict: One CSV row (see CSV_FIELDS).
+    """
+    clear_scene()
+    parts = separate_loose_parts(import_ply(path))
+    measures = [part_measures(part) for part in parts]
+    row = {"file": os.path.basename(path), "parts": len(parts)}
+
+    cube = pick_cube_part(measures)
+    if cube is None:
+        row["status"] = "no cube found"
+        return row
+
+    ratio = CUBE_VOLUME_CM3 / measures[cube]["volume"]
+    plant_raw = sum(measure["volume"] for i, measure in enumerate(measures) if i != cube)
+    row.update({
+        "status": "done" if len(parts) == 2 else f"done, plant in {len(parts) - 1} parts",
+        "cube_volume": measures[cube]["volume"],
+        "ratio": ratio,
+        "plant_volume_raw": plant_raw,
+        "plant_volume_cm3": plant_raw * ratio,
+    })
+    return row
+
+
+def run_worker(files, output_csv):
+    """Process files one after the other in this Blender process and write their rows to output_csv."""
+    with open(output_csv, "w", newline="") as file:
+        writer = csv.DictWriter(file, fieldnames=CSV_FIELDS)
+        writer.writeheader()
+        for path in files:
+            try:
+                row = plant_volume(path)
+            except Exception as error:
+                row = {"file": os.path.basename(path), "status": f"failed: {error}"}
+            writer.writerow(row)
+            file.flush()
+            print(f"{row['file']}: {row['status']}", flush=True)
+
+
+# ------ Coordinator
+
+
+def run_batch(folder, output_csv, workers=1, blender="blender", store=None, date=None):
+    """
+    Compute the plant volume of every PLY file of folder with background Blender workers.
+
+    Args:
+        folder (str): Folder of the exported .ply meshes.
+        output_csv (str): Path of the CSV file gathering the results.
+        workers (int, optional): Number of Blender processes started. Defaults to 1.
+        blender (str, optional): Blender executable used for the workers. Defaults to "blender",
+                                 or the running Blender when called from inside Blender.
+        store (str, optional): SQLite trait store the volumes are also recorded in (see trait_store.py).
+        date (str, optional): Date of the scan session recorded in the store. Defaults to the date in the path of the files.
+
+    Returns:
+        list[dict]: The rows of the CSV file, sorted by file name.
+    """
+    files = sorted(glob.glob(os.path.join(folder, "*.ply")))
+    if not files:
+        print(f"No .ply file in {folder}")
+        return []
+    workers = max(1, min(workers, len(files)))
+    if bpy is not None:
+        blender = bpy.app.binary_path
+
+    rows = []
+    if workers == 1 and bpy is not None:
+        # Already inside Blender: no need to start another one
+        run_worker(files, output_csv)
+        with open(output_csv, newline="") as file:
+            rows.extend(csv.DictReader(file))
+    else:
+        with tempfile.TemporaryDirectory() as temporary:
+            processes = []
+            for worker in range(workers):
+                shard_csv = os.path.join(temporary, f"worker_{worker}.csv")
+                command = [blender, "--background", "--python", os.path.abspath(__file__), "--",
+                           "--worker", shard_csv, *files[worker::workers]]
+                processes.append((subprocess.Popen(command), shard_csv))
+            for process, shard_csv in processes:
+                process.wait()
+                if os.path.exists(shard_csv):
+                    with open(shard_csv, newline="") as file:
+                        rows.extend(csv.DictReader(file))
+
+    rows.sort(key=lambda row: row["file"])
+    with open(output_csv, "w", newline="") as file:
+        writer = csv.DictWriter(file, fieldnames=CSV_FIELDS)
+        writer.writeheader()
+        writer.writerows(rows)
+    print(f"{len(rows)}/{len(files)} files measured, results saved to {output_csv}")
+    if store:
+        with TraitStore(store) as traits:
+            print(f"{record_rows(traits, rows, STORED_TRAITS, folder, date=date)} values recorded in {store}")
+    return rows
+
+
+def parse_args(argv):
+    # Blender passes the script arguments after "--"
+    if "--" in argv:
+        argv = argv[argv.index("--") + 1:]
+    elif bpy is not None:
+        argv = []
+    else:
+        argv = argv[1:]
+    parser = argparse.ArgumentParser(description="Cube-calibrated plant volume of every PLY mesh of a folder.")
+    parser.add_argument("folder", nargs="?", help="Folder of the exported .ply meshes.")
+    parser.add_argument("output_csv", nargs="?", help="Path of the CSV file of the results.")
+    parser.add_argument("--workers", type=int, default=1, help="Number of background Blender processes (default: 1)")
+    parser.add_argument("--blender", type=str, default="blender", help="Blender executable, when run with plain Python (default: blender)")
+    parser.add_argument("--store", type=str, default=None, help="SQLite trait store the volumes are also recorded in")
+    parser.add_argument("--date", type=str, default=None, help="Date of the scan session recorded with --store, YYYY-MM-DD (default: the date in the path of the scans)")
+    parser.add_argument("--worker", type=str, default=None, metavar="CSV", help=argparse.SUPPRESS)
+    parser.add_argument("files", nargs="*", help=argparse.SUPPRESS)
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    args = parse_args(sys.argv)
+    if args.worker is not None:
+        # Worker process started by run_batch: the positional arguments are the files
+        run_worker([path for path in (args.folder, args.output_csv, *args.files) if path], args.worker)
+    else:
+        run_batch(args.folder, args.output_csv, args.workers, args.blender, args.store, args.date)
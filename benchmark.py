@@ -0,0 +1,339 @@
+import argparse
+import importlib
+import json
+import os
+import platform
+import statistics
+import subprocess
+import tempfile
+import time
+from datetime import datetime
+
+import numpy as np
+
+import synthetic_scan
+from color_segmentation import classify
+from leaf_geometry import farthest_pair, leaf_table
+from reference_cube import point_spacing
+from skeleton_graph import skeletonize_voxels
+from voxel_grid import sparse_voxelize, voxel_degrees, voxelize
+
+# Point counts of the synthetic scans of a default run
+DEFAULT_POINTS = (100_000, 1_000_000)
+
+# A case is slower than the baseline when its best time is more than this ratio of the baseline one
+DEFAULT_THRESHOLD = 1.25
+
+# DBSCAN eps of the pot removal, in multiples of the point spacing of the scan
+EPS_FACTOR = 3.0
+
+# Voxel size of the leaf tip counting (mm, as count_leaves_test.py)
+LEAF_VOXEL_SIZE = 2.1
+
+# Registration parameters for the synthetic scans, which are in mm: the lengths of
+# align_merge.DEFAULT_PARAMS scaled to a 1 mm voxel
+REGISTRATION_PARAMS = {
+    'voxel_size': 1.0,
+    'normal_radius': 5.0,
+    'fpfh_radius': 12.5,
+    'distance_threshold': 2.5,
+    'icp_threshold': 1.0,
+}
+
+# Modules whose versions are written in the report
+VERSION_MODULES = ("numpy", "scipy", "sklearn", "skimage", "open3d")
+
+
+class SkipCase(Exception):
+    """Raised by a case that cannot run here, e.g. without Open3D."""
+
+
+def _require_open3d():
+    try:
+        importlib.import_module("open3d")
+    except ImportError:
+        raise SkipCase("open3d is not installed")
+
+
+def scan_data(n_points, seed=0, directory="benchmark_data"):
+    """
+    Synthetic scan of a benchmark size, and its PLY files for the cases that read files.
+
+    The files are written once in directory and reused by later runs; the arrays are generated
+    again (the generator is deterministic and fast).
+
+    Args:
+        n_points (int): Number of points of the scan.
+        seed (int, optional): Random seed of the scene. Defaults to 0.
+        directory (str, optional): Directory of the PLY files. Defaults to "benchmark_data".
+
+    Returns:
+        dict: scan (see synthetic_scan.synthetic_scan), file (merged-like scan), pair (paths of the
+              0° and -8° scans), spacing (point spacing) and directory.
+    """
+    os.makedirs(directory, exist_ok=True)
+    scan = synthetic_scan.synthetic_scan(n_points, seed)
+    name = f"Synthetic-{n_points}-{seed}"
+    path = os.path.join(directory, f"Merge_{name}_pc.ply")
+    pair = (os.path.join(directory, f"{name}-0_pc.ply"), os.path.join(directory, f"{name}-8_pc.ply"))
+    if not os.path.exists(path):
+        synthetic_scan.write_scan(path, scan)
+    if not all(os.path.exists(file) for file in pair):
+        first, second, _ = synthetic_scan.synthetic_pair(n_points, seed)
+        synthetic_scan.write_scan(pair[0], first)
+        synthetic_scan.write_scan(pair[1], second)
+    return {"scan": scan, "file": path, "pair": pair, "spacing": point_spacing(scan["points"]),
+            "directory": directory}
+
+
+# ------ Cases: each one prepares its inputs and returns the function that is timed
+
+def pot_removal_case(data, prefilter=None):
+    import clustering_algo
+
+    eps = EPS_FACTOR * data["spacing"]
+    output = os.path.join(tempfile.mkdtemp(), "filtered.ply")
+    return lambda: clustering_algo.main(data["file"], output, eps=eps, min_samples=20, visualize=False,
+                                        verbose=False, prefilter=prefilter)
+
+
+def color_classes_case(data):
+    colors = data["scan"]["colors"]
+    return lambda: classify(colors)
+
+
+def calibration_case(data):
+    from calibration import calibrate_cloud
+
+    points, colors = data["scan"]["points"], data["scan"]["colors"]
+    return lambda: calibrate_cloud(points, colors)
+
+
+def registration_case(data):
+    _require_open3d()
+    import align_merge
+
+    output = os.path.join(tempfile.mkdtemp(), "merged.ply")
+    return lambda: align_merge.register_pair(*data["pair"], output, params=REGISTRATION_PARAMS)
+
+
+def leaf_voxels_case(data):
+    plant = data["scan"]["points"][data["scan"]["part"] == synthetic_scan.PLANT]
+
+    def run():
+        counts, _ = voxelize(plant, LEAF_VOXEL_SIZE)
+        coords, _, _ = sparse_voxelize(plant, LEAF_VOXEL_SIZE)
+        return {"voxels": len(coords), "occupied": int(np.count_nonzero(counts))}
+
+    return run
+
+
+def leaf_tips_case(data):
+    # Core of count_leaves_test.count_tips_file without Open3D: sparse voxels, skeleton, tips
+    plant = data["scan"]["points"][data["scan"]["part"] == synthetic_scan.PLANT]
+
+    def run():
+        coords, _, _ = sparse_voxelize(plant, LEAF_VOXEL_SIZE)
+        skeleton = skeletonize_voxels(coords, closing=0)
+        return {"skeleton": len(skeleton), "tips": int(np.sum(voxel_degrees(skeleton, simplify=True) == 1))}
+
+    return run
+
+
+def count_leaves_case(data):
+    _require_open3d()
+    import open3d as o3d
+    from count_leaves_test import skeleton_tips, skeletonize_point_cloud
+
+    pcd = o3d.geometry.PointCloud()
+    pcd.points = o3d.utility.Vector3dVector(data["scan"]["points"][data["scan"]["part"] == synthetic_scan.PLANT])
+
+    def run():
+        skeleton, _, _ = skeletonize_point_cloud(pcd, LEAF_VOXEL_SIZE, sparse=True)
+        return {"skeleton": len(skeleton), "tips": len(skeleton_tips(skeleton))}
+
+    return run
+
+
+def leaf_measures_case(data):
+    scan = data["scan"]
+    selected = scan["leaf"] >= 0
+    points, labels = scan["points"][selected], scan["leaf"][selected]
+
+    def run():
+        table = leaf_table(points, labels, scan["cm_per_unit"])
+        lengths = [farthest_pair(points[labels == leaf])[2] for leaf in table["leaf"]]
+        return {"leaves": len(table), "length_max": float(max(lengths))}
+
+    return run
+
+
+# Benchmark cases, in the order they run
+CASES = {
+    "color_classes": color_classes_case,
+    "calibration": calibration_case,
+    "pot_removal": pot_removal_case,
+    "pot_removal_prefilter": lambda data: pot_removal_case(data, prefilter=["soil", "pot"]),
+    "registration": registration_case,
+    "leaf_voxels": leaf_voxels_case,
+    "leaf_tips": leaf_tips_case,
+    "count_leaves": count_leaves_case,
+    "leaf_measures": leaf_measures_case,
+}
+
+
+def _stages(result):
+    # Stage timings of the results of clustering_algo.main ({stage: seconds}) and
+    # align_merge.register_pair (list of StageTimer records)
+    stages = result.get("stages") if isinstance(result, dict) else None
+    if isinstance(stages, list):
+        return {record["stage"]: record["seconds"] for record in stages}
+    return stages
+
+
+def time_case(run, repeats=3):
+    """
+    Time a function several times.
+
+    Args:
+        run (callable): Function without arguments.
+        repeats (int, optional): Number of runs. Defaults to 3.
+
+    Returns:
+        dict: seconds of every run, min and median seconds, and stages (stage timings of the
+              fastest run, if the function returns them).
+    """
+    seconds, best, best_stages = [], None, None
+    for _ in range(repeats):
+        start = time.perf_counter()
+        result = run()
+        seconds.append(time.perf_counter() - start)
+        if best is None or seconds[-1] < best:
+            best, best_stages = seconds[-1], _stages(result)
+    record = {"seconds": seconds, "min": min(seconds), "median": statistics.median(seconds)}
+    if best_stages:
+        record["stages"] = best_stages
+    return record
+
+
+def environment():
+    """Host, Python and library versions of the report, and the commit of the code if it is a git checkout."""
+    versions = {}
+    for name in VERSION_MODULES:
+        try:
+            versions[name] = importlib.import_module(name).__version__
+        except ImportError:
+            versions[name] = None
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {"host": platform.node(), "platform": platform.platform(), "processor": platform.processor(),
+            "cpus": os.cpu_count(), "python": platform.python_version(), "versions": versions, "commit": commit}
+
+
+def run_benchmarks(sizes=DEFAULT_POINTS, cases=None, repeats=3, seed=0, directory="benchmark_data", verbose=True):
+    """
+    Run the benchmark cases on synthetic scans of several sizes.
+
+    Args:
+        sizes (list[int], optional): Point counts of the scans. Defaults to DEFAULT_POINTS.
+        cases (list[str], optional): Names of the cases (see CASES). Defaults to all.
+        repeats (int, optional): Runs of every case. Defaults to 3.
+        seed (int, optional): Random seed of the scans. Defaults to 0.
+        directory (str, optional): Directory of the scan files (see scan_data). Defaults to "benchmark_data".
+        verbose (bool, optional): Print every result. Defaults to True.
+
+    Returns:
+        dict: The report: date, environment, settings and results (one record per case and size,
+              with the timings of time_case, or skipped and its reason).
+    """
+    cases = list(CASES) if cases is None else cases
+    unknown = set(cases) - set(CASES)
+    if unknown:
+        raise ValueError(f"Unknown benchmark case(s): {', '.join(sorted(unknown))}, expected {', '.join(CASES)}")
+    results = []
+    for n_points in sizes:
+        data = scan_data(n_points, seed, directory)
+        for name in cases:
+            record = {"case": name, "points": n_points}
+            try:
+                record.update(time_case(CASES[name](data), repeats))
+            except SkipCase as error:
+                record["skipped"] = str(error)
+            results.append(record)
+            if verbose:
+                print(format_result(record))
+    return {"created": datetime.now().isoformat(timespec="seconds"), **environment(),
+            "repeats": repeats, "seed": seed, "results": results}
+
+
+def format_result(record):
+    """Format a result as "pot_removal  1,000,000 points  min 1.234 s  median 1.250 s"."""
+    head = f"{record['case']:<22} {record['points']:>10,} points"
+    if "skipped" in record:
+        return f"{head}  skipped ({record['skipped']})"
+    return f"{head}  min {record['min']:.3f} s  median {record['median']:.3f} s"
+
+
+def compare(report, baseline, threshold=DEFAULT_THRESHOLD):
+    """
+    Compare the best times of a report with a baseline report, case by case and size by size.
+
+    Args:
+        report (dict): Report of run_benchmarks.
+        baseline (dict): Earlier report (e.g. of the main branch on the same host).
+        threshold (float, optional): Ratio of the times above which a case is a regression.
+                                     Defaults to DEFAULT_THRESHOLD.
+
+    Returns:
+        list[dict]: case, points, baseline and current min seconds, ratio (current / baseline) and
+                    regression, for the cases timed in both reports.
+    """
+    reference = {(record["case"], record["points"]): record for record in baseline["results"] if "min" in record}
+    rows = []
+    for record in report["results"]:
+        old = reference.get((record["case"], record["points"]))
+        if old is None or "min" not in record:
+            continue
+        ratio = record["min"] / old["min"] if old["min"] > 0 else float("inf")
+        rows.append({"case": record["case"], "points": record["points"], "baseline": old["min"],
+                     "current": record["min"], "ratio": ratio, "regression": ratio > threshold})
+    return rows
+
+
+def print_comparison(rows, threshold=DEFAULT_THRESHOLD):
+    """Print the table of compare, the regressions flagged."""
+    print(f"{'case':<22} {'points':>10} {'baseline':>9} {'current':>9} {'ratio':>6}")
+    for row in rows:
+        flag = "  SLOWER" if row["regression"] else ""
+        print(f"{row['case']:<22} {row['points']:>10,} {row['baseline']:>8.3f}s {row['current']:>8.3f}s "
+              f"{row['ratio']:>6.2f}{flag}")
+    regressions = sum(row["regression"] for row in rows)
+    print(f"{regressions} regression(s) above x{threshold:.2f}, {len(rows)} case(s) compared")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Time the processing steps on synthetic scans and compare with a baseline.")
+    parser.add_argument("--points", type=int, nargs="+", default=list(DEFAULT_POINTS), help="Point counts of the synthetic scans (default: 100000 1000000)")
+    parser.add_argument("--cases", nargs="+", default=None, choices=list(CASES), help="Cases to run (default: all)")
+    parser.add_argument("--repeats", type=int, default=3, help="Runs of every case, the best one is compared (default: 3)")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed of the synthetic scans (default: 0)")
+    parser.add_argument("--data", type=str, default="benchmark_data", help="Directory of the generated scans, reused between runs (default: benchmark_data)")
+    parser.add_argument("--output", type=str, default=None, help="Write the report to this JSON file")
+    parser.add_argument("--baseline", type=str, default=None, help="Report to compare with; exits with status 1 on regressions")
+    parser.add_argument("--threshold", type=float, default=DEFAULT_THRESHOLD, help=f"Slowdown ratio counted as a regression (default: {DEFAULT_THRESHOLD})")
+
+    args = parser.parse_args()
+    report = run_benchmarks(args.points, args.cases, args.repeats, args.seed, args.data)
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(report, file, indent=2)
+        print(f"Report saved to {args.output}")
+    if args.baseline:
+        with open(args.baseline) as file:
+            rows = compare(report, json.load(file), args.threshold)
+        print_comparison(rows, args.threshold)
+        if any(row["regression"] for row in rows):
+            raise SystemExit(1)
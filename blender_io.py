@@ -0,0 +1,117 @@
+import bpy
+import numpy as np
+
+
+def mesh_vertices(mesh):
+    """
+    Return the vertex coordinates of a mesh, read in one call with foreach_get.
+
+    Args:
+        mesh (bpy.types.Mesh): Mesh data (obj.data).
+
+    Returns:
+        np.ndarray: (n, 3) float32 array of local coordinates.
+    """
+    buffer = np.empty(len(mesh.vertices) * 3, dtype=np.float32)
+    mesh.vertices.foreach_get("co", buffer)
+    return buffer.reshape(-1, 3)
+
+
+def transform_points(points, matrix):
+    """
+    Apply a 4x4 transformation (e.g. obj.matrix_world) to an array of points.
+
+    Args:
+        points (np.ndarray): (n, 3) array of points.
+        matrix (mathutils.Matrix | np.ndarray): 4x4 transformation.
+
+    Returns:
+        np.ndarray: (n, 3) transformed points.
+    """
+    matrix = np.array(matrix, dtype=np.float64)
+    return points @ matrix[:3, :3].T + matrix[:3, 3]
+
+
+def world_vertices(obj):
+    """(n, 3) vertex coordinates of a mesh object in world space."""
+    return transform_points(mesh_vertices(obj.data), obj.matrix_world)
+
+
+def _read_colors(data, count):
+    # Colour attribute values as sRGB RGBA floats (Blender >= 3.4 has color_srgb)
+    buffer = np.empty(count * 4, dtype=np.float32)
+    try:
+        data.foreach_get("color_srgb", buffer)
+    except (AttributeError, TypeError):
+        data.foreach_get("color", buffer)
+    return buffer.reshape(-1, 4)
+
+
+def mesh_colors(mesh):
+    """
+    Return one RGB colour per vertex from the active colour attribute of a mesh.
+
+    Colours stored per face corner (the usual layout of imported meshes and of the legacy
+    vertex_colors layers) are averaged over the corners of each vertex.
+
+    Args:
+        mesh (bpy.types.Mesh): Mesh data (obj.data).
+
+    Returns:
+        np.ndarray | None: (n, 3) float32 sRGB colours in [0, 1], or None if the mesh has no colours.
+    """
+    attributes = getattr(mesh, "color_attributes", None)
+    if attributes is not None and attributes.active_color is not None:
+        attribute = attributes.active_color
+        domain = attribute.domain
+        data = attribute.data
+    elif getattr(mesh, "vertex_colors", None) and mesh.vertex_colors.active is not None:
+        domain = "CORNER"
+        data = mesh.vertex_colors.active.data
+    else:
+        return None
+
+    n = len(mesh.vertices)
+    if domain == "POINT":
+        return _read_colors(data, n)[:, :3]
+
+    corner_colors = _read_colors(data, len(mesh.loops))[:, :3]
+    vertex_index = np.empty(len(mesh.loops), dtype=np.int32)
+    mesh.loops.foreach_get("vertex_index", vertex_index)
+    counts = np.bincount(vertex_index, minlength=n)
+    colors = np.stack([np.bincount(vertex_index, corner_colors[:, i], minlength=n) for i in range(3)], axis=1)
+    return (colors / np.maximum(counts, 1)[:, None]).astype(np.float32)
+
+
+def new_point_mesh(name, points, colors=None, collection=None):
+    """
+    Create a mesh object made of vertices only (a point cloud), filled with foreach_set.
+
+    Args:
+        name (str): Name of the mesh and of the object.
+        points (np.ndarray): (n, 3) vertex coordinates.
+        colors (np.ndarray, optional): (n, 3) sRGB colours in [0, 1], stored in a "Col" point attribute.
+        collection (bpy.types.Collection, optional): Collection the object is linked to.
+                                                      Defaults to the active collection.
+
+    Returns:
+        bpy.types.Object: The new object.
+    """
+    mesh = bpy.data.meshes.new(name)
+    mesh.vertices.add(len(points))
+    mesh.vertices.foreach_set("co", np.ascontiguousarray(points, dtype=np.float32).ravel())
+
+    if colors is not None:
+        rgba = np.ones((len(points), 4), dtype=np.float32)
+        rgba[:, :3] = colors
+        attribute = mesh.color_attributes.new(name="Col", type="FLOAT_COLOR", domain="POINT")
+        try:
+            attribute.data.foreach_set("color_srgb", rgba.ravel())
+        except (AttributeError, TypeError):
+            attribute.data.foreach_set("color", rgba.ravel())
+        mesh.color_attributes.active_color = attribute
+
+    mesh.update()
+    obj = bpy.data.objects.new(name, mesh)
+    (collection or bpy.context.collection).objects.link(obj)
+    return obj
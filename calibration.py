@@ -0,0 +1,207 @@
+import argparse
+import json
+import os
+
+import numpy as np
+from scipy.spatial import cKDTree
+
+import ply_io
+from feature_cache import file_hash
+from mesh_volume import component_measures, connected_components
+from reference_cube import (CUBE_EDGE_CM, CUBE_VOLUME_CM3, STICK_LENGTH_CM, minimum_box, oriented_box,
+                            pick_cube_part, segment_cube)
+
+CALIBRATION_SUFFIX = "_calibration.json"
+
+
+def calibrate_cube(cube_points, cube_volume=None, trim=2.0):
+    """
+    Derive the scale of a scan from the points of its reference cube.
+
+    The smallest oriented box is fitted to the cube points (see reference_cube.minimum_box); the
+    edge of the cube is the median of its three extents, which tolerates a face missing from the scan.
+
+    Args:
+        cube_points (np.ndarray): (m, 3) points (or mesh vertices) of the cube.
+        cube_volume (float, optional): Enclosed volume of the cube mesh, when known. The volume
+                                       ratio is then CUBE_VOLUME_CM3 / cube_volume, else cm_per_unit ** 3.
+        trim (float, optional): Percentage of stray points ignored on each side of the box. Defaults to 2.
+
+    Returns:
+        dict: The calibration: "cm_per_unit" (lengths), "volume_ratio" (volumes, cm³ per unit³; the
+        mesh ratio also accounts for the stub of stick of the cube part, see CUBE_VOLUME_CM3)
+        and the fitted cube ("cube_center", "cube_axes", "cube_extents", "cube_edge", ...).
+    """
+    center, axes, extents = minimum_box(cube_points, trim)
+    edge = float(np.median(extents))
+    cm_per_unit = CUBE_EDGE_CM / edge
+    calibration = {
+        "method": "cube mesh" if cube_volume else "cube colour",
+        "cube_points": int(len(cube_points)),
+        "cube_center": center.tolist(),
+        "cube_axes": axes.T.tolist(),
+        "cube_extents": extents.tolist(),
+        "cube_edge": edge,
+        "cm_per_unit": cm_per_unit,
+    }
+    if cube_volume:
+        # Same ratio as the "Get plant volume" operator
+        calibration["cube_volume"] = float(cube_volume)
+        calibration["volume_ratio"] = CUBE_VOLUME_CM3 / float(cube_volume)
+    else:
+        calibration["volume_ratio"] = cm_per_unit ** 3
+    return calibration
+
+
+def find_stick(points, calibration, cube_indices=None, radius_factor=0.5):
+    """
+    Find the stick holding the reference cube and add its axis to the calibration.
+
+    The stick leaves the cube on the side where the non-cube points touching the cube are; its
+    points are then taken in a cylinder of radius radius_factor x cube edge along that direction,
+    and the axis is refined by PCA. The bottom of the stick is in the soil, so only its axis
+    ("stick_axis", pointing up from the stick to the cube) and its visible length are recorded,
+    the scale comes from the cube.
+
+    Args:
+        points (np.ndarray): (n, 3) points of the whole scan.
+        calibration (dict): Result of calibrate_cube, updated in place.
+        cube_indices (np.ndarray, optional): Indices of the cube points, excluded from the stick.
+        radius_factor (float, optional): Radius of the stick cylinder in cube edges. Defaults to 0.5.
+
+    Returns:
+        np.ndarray | None: Indices of the stick points, or None if no stick was found.
+    """
+    points = np.asarray(points, dtype=np.float64)
+    center = np.asarray(calibration["cube_center"])
+    edge = calibration["cube_edge"]
+    max_length = 1.2 * STICK_LENGTH_CM / calibration["cm_per_unit"]
+    outside = np.ones(len(points), dtype=bool)
+    if cube_indices is not None:
+        outside[cube_indices] = False
+
+    # Direction of the stick: the non-cube points touching the cube
+    touching = np.array(cKDTree(points).query_ball_point(center, 1.2 * edge), dtype=np.int64)
+    touching = touching[outside[touching]]
+    if len(touching) < 5:
+        return None
+    direction = points[touching].mean(axis=0) - center
+    if np.linalg.norm(direction) == 0:
+        return None
+    direction /= np.linalg.norm(direction)
+
+    for _ in range(2):
+        relative = points - center
+        along = relative @ direction
+        radial = np.linalg.norm(relative - along[:, None] * direction, axis=1)
+        stick = np.flatnonzero(outside & (along > 0) & (along <= max_length) & (radial <= radius_factor * edge))
+        if len(stick) < 10:
+            return None
+        # Refine the axis on the stick points
+        _, axes, _ = oriented_box(points[stick])
+        direction = axes[:, 0] if axes[:, 0] @ direction > 0 else -axes[:, 0]
+
+    visible = float(np.percentile((points[stick] - center) @ direction, 99))
+    calibration["stick_axis"] = (-direction).tolist()
+    calibration["stick_points"] = int(len(stick))
+    calibration["stick_visible_cm"] = visible * calibration["cm_per_unit"]
+    return stick
+
+
+def calibrate_cloud(points, colors, trim=2.0):
+    """
+    Calibrate a coloured point cloud: find the blue cube, fit its box and find its stick.
+
+    Args:
+        points (np.ndarray): (n, 3) point coordinates.
+        colors (np.ndarray): (n, 3) RGB colours, uint8 or floats in [0, 1].
+        trim (float, optional): See calibrate_cube. Defaults to 2.
+
+    Returns:
+        dict | None: The calibration (see calibrate_cube and find_stick), or None if no cube was found.
+    """
+    cube = segment_cube(points, colors)
+    if cube is None:
+        return None
+    calibration = calibrate_cube(np.asarray(points[cube], dtype=np.float64), trim=trim)
+    find_stick(points, calibration, cube)
+    return calibration
+
+
+def calibrate_mesh(vertices, faces, trim=2.0):
+    """
+    Calibrate a mesh: the cube is the smallest cube-like loose part, as in batch_volume.
+
+    Args:
+        vertices (np.ndarray): (n, 3) vertex coordinates.
+        faces (np.ndarray): (m, 3) triangle vertex indices.
+        trim (float, optional): See calibrate_cube. Defaults to 2.
+
+    Returns:
+        dict | None: The calibration (see calibrate_cube), or None if no cube was found.
+    """
+    components = connected_components(len(vertices), faces)
+    parts = component_measures(vertices, faces, components=components)
+    cube = pick_cube_part(parts)
+    if cube is None:
+        return None
+    cube_indices = np.flatnonzero(components[1] == cube)
+    calibration = calibrate_cube(np.asarray(vertices[cube_indices], dtype=np.float64), parts[cube]["volume"], trim)
+    find_stick(vertices, calibration, cube_indices)
+    return calibration
+
+
+def calibration_path_for(path):
+    """Path of the calibration cached next to a scan: <scan>_calibration.json."""
+    return os.path.splitext(path)[0] + CALIBRATION_SUFFIX
+
+
+def calibrate_file(path, force=False):
+    """
+    Return the calibration of a scan, computed once and cached next to it.
+
+    The cache stores the hash of the scan content, so it is recomputed when the scan changes.
+    Meshes are calibrated with their cube part (calibrate_mesh), point clouds (or meshes where
+    no closed cube is found) with the cube colour (calibrate_cloud).
+
+    Args:
+        path (str): Path to the .ply scan.
+        force (bool, optional): Recompute even if a cached calibration is up to date. Defaults to False.
+
+    Returns:
+        dict | None: The calibration, or None if no cube was found.
+    """
+    cache_path = calibration_path_for(path)
+    digest = file_hash(path)
+    if not force and os.path.exists(cache_path):
+        with open(cache_path) as file:
+            cached = json.load(file)
+        if cached.get("hash") == digest:
+            return cached["calibration"]
+
+    vertices, faces = ply_io.read_ply(path)
+    points = ply_io.xyz(vertices)
+    calibration = None
+    if faces is not None and len(faces):
+        calibration = calibrate_mesh(points, np.asarray(faces, dtype=np.int64))
+    colors = ply_io.colors(vertices)
+    if calibration is None and colors is not None:
+        calibration = calibrate_cloud(points, colors)
+
+    with open(cache_path, "w") as file:
+        json.dump({"file": os.path.basename(path), "hash": digest, "calibration": calibration}, file, indent=2)
+    return calibration
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Find the reference cube of scans and cache their scale next to them.")
+    parser.add_argument("files", nargs="+", help="The .ply scans.")
+    parser.add_argument("--force", action="store_true", help="Recompute the calibrations even if they are cached")
+
+    args = parser.parse_args()
+    for path in args.files:
+        calibration = calibrate_file(path, args.force)
+        if calibration is None:
+            print(f"{path}: no reference cube found")
+        else:
+            print(f"{path}: {calibration['cm_per_unit']:.6g} cm per unit ({calibration['method']})")
@@ -1,22 +1,358 @@
-import open3d as o3d
 import numpy as np
+from scipy.spatial import cKDTree
 from sklearn.cluster import DBSCAN
 import argparse
-import time
-import sys
-
-# Loading animation function
-def loading_animation(message="Loading", duration=2):
-    animation = ["[■□□□□□□□□□]", "[■■□□□□□□□□]", "[■■■□□□□□□□]", "[■■■■□□□□□□]", "[■■■■■□□□□□]", "[■■■■■■□□□□]", 
-                 "[■■■■■■■□□□]", "[■■■■■■■■□□]", "[■■■■■■■■■□]", "[■■■■■■■■■■]"]
-    sys.stdout.write(f"\r{message}: {animation[0]}")
-    for i in range(len(animation)):
-        time.sleep(duration / len(animation))
-        sys.stdout.write(f"\r{message}: {animation[i % len(animation)]}")
-        sys.stdout.flush()
-    print("\n")
-
-def main(input_file, output_file, eps=0.5, min_samples=20):
+import glob
+import os
+import tempfile
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import ply_io
+import stream_cloud
+from color_segmentation import CLASSES, class_mask
+from mesh_volume import union_find
+from stage_timer import StageTimer
+from voxel_dbscan import voxel_dbscan
+
+
+ENGINES = ("voxel", "sklearn")
+
+
+def cluster_points(points, eps=0.5, min_samples=20, engine="voxel", return_core=False):
+    """
+    Label the points with DBSCAN.
+    Parameters:
+    points (np.ndarray): (n, 3) array of point coordinates.
+    eps (float, optional): DBSCAN eps parameter. Default is 0.5.
+    min_samples (int, optional): DBSCAN min_samples parameter. Default is 20.
+    engine (str, optional): "voxel" for the voxel accelerated implementation (voxel_dbscan.py), or
+                            "sklearn" for sklearn.cluster.DBSCAN. Both give the same labels. Default is "voxel".
+    return_core (bool, optional): Also return the boolean mask of the core points. Default is False.
+    Returns:
+    np.ndarray: Cluster label of each point, -1 for noise (and the core mask with return_core).
+    """
+    if engine == "voxel":
+        return voxel_dbscan(points, eps=eps, min_samples=min_samples, return_core=return_core)
+    if engine == "sklearn":
+        dbscan = DBSCAN(eps=eps, min_samples=min_samples).fit(points)
+        if not return_core:
+            return dbscan.labels_
+        core = np.zeros(len(points), dtype=bool)
+        core[dbscan.core_sample_indices_] = True
+        return dbscan.labels_, core
+    raise ValueError(f"Unknown clustering engine {engine!r}, expected one of {ENGINES}")
+
+CLUSTER_DTYPE = np.dtype([
+    ('label', np.int64),
+    ('count', np.int64),
+    ('min_distance', np.float64),
+    ('centroid', np.float64, 3),
+    ('bbox_min', np.float64, 3),
+    ('bbox_max', np.float64, 3),
+])
+
+
+def cluster_table(points, labels, center):
+    """
+    Compute the statistics of every cluster in one pass over the points.
+    The points are sorted once by label and each statistic is a segmented reduction
+    (np.add/minimum/maximum.reduceat), instead of one boolean mask per cluster.
+    Parameters:
+    points (np.ndarray): (n, 3) array of point coordinates.
+    labels (np.ndarray): (n,) cluster label of each point, -1 for noise.
+    center (np.ndarray): (3,) reference point, e.g. the center of mass of the cloud.
+    Returns:
+    np.ndarray: Structured array (CLUSTER_DTYPE) with one row per label, sorted by label (noise included):
+                label, count, min_distance to center, centroid, bbox_min and bbox_max.
+    """
+    order = np.argsort(labels, kind='stable')
+    sorted_labels = labels[order]
+    sorted_points = points[order]
+    starts = np.flatnonzero(np.r_[True, sorted_labels[1:] != sorted_labels[:-1]])
+
+    table = np.zeros(len(starts), dtype=CLUSTER_DTYPE)
+    table['label'] = sorted_labels[starts]
+    table['count'] = np.diff(np.r_[starts, len(labels)])
+    distances = np.linalg.norm(sorted_points - center, axis=1)
+    table['min_distance'] = np.minimum.reduceat(distances, starts)
+    table['centroid'] = np.add.reduceat(sorted_points, starts, axis=0) / table['count'][:, None]
+    table['bbox_min'] = np.minimum.reduceat(sorted_points, starts, axis=0)
+    table['bbox_max'] = np.maximum.reduceat(sorted_points, starts, axis=0)
+    return table
+
+
+def merge_cluster_tables(tables):
+    """
+    Merge cluster tables of parts of the same cloud (see cluster_table), e.g. of chunks of points.
+    Parameters:
+    tables (np.ndarray): Concatenated tables, a label can have one row per part.
+    Returns:
+    np.ndarray: One row per label, sorted by label, as cluster_table of all the points.
+    """
+    labels, inverse = np.unique(tables['label'], return_inverse=True)
+    table = np.zeros(len(labels), dtype=CLUSTER_DTYPE)
+    table['label'] = labels
+    table['count'] = np.bincount(inverse, weights=tables['count'], minlength=len(labels))
+    table['min_distance'] = np.inf
+    np.minimum.at(table['min_distance'], inverse, tables['min_distance'])
+    table['bbox_min'], table['bbox_max'] = np.inf, -np.inf
+    np.minimum.at(table['bbox_min'], inverse, tables['bbox_min'])
+    np.maximum.at(table['bbox_max'], inverse, tables['bbox_max'])
+    for i in range(3):
+        table['centroid'][:, i] = np.bincount(inverse, weights=tables['centroid'][:, i] * tables['count'],
+                                              minlength=len(labels)) / table['count']
+    return table
+
+
+def select_plant_clusters(table, n_largest=3, n_closest=2):
+    """
+    Select the clusters of the plant: among the n_largest biggest clusters, the n_closest ones to the center of mass.
+    Parameters:
+    table (np.ndarray): Cluster statistics returned by cluster_table.
+    n_largest (int, optional): Number of biggest clusters considered. Default is 3.
+    n_closest (int, optional): Number of clusters kept. Default is 2.
+    Returns:
+    list[int]: Labels of the selected clusters, closest first.
+    """
+    # Stable sorts: ties keep the label order
+    largest = table[np.argsort(-table['count'], kind='stable')[:n_largest]]
+    closest = largest[np.argsort(largest['min_distance'], kind='stable')[:n_closest]]
+    return closest['label'].tolist()
+
+
+# ------ Streaming mode
+
+
+# Bytes per point of a tile clustered in streaming mode: peak resident memory of voxel_dbscan
+# measured on dense scans (about half of it is NumPy arrays, the rest the KD-trees and neighbour
+# pairs of scipy and the heap they leave behind)
+TILE_BYTES_PER_POINT = 2048
+
+TILE_DTYPE = np.dtype([('index', np.int64), ('xyz', np.float64, 3)])
+
+
+def _greedy_edges(counts, margin, max_points):
+    # Bin boundaries of consecutive ranges holding at most max_points with margin bins on both
+    # sides, at least margin bins wide (a range can go over max_points when that is too thin)
+    below = np.concatenate([[0], np.cumsum(counts)])
+    bins = len(counts)
+    boundaries = [0]
+    while boundaries[-1] < bins:
+        start = boundaries[-1]
+        end = int(np.searchsorted(below, below[max(start - margin, 0)] + max_points, side="right")) - 1 - margin
+        boundaries.append(min(max(end, start + margin), bins))
+    return np.asarray(boundaries)
+
+
+def tile_boxes(input_file, axes, low, high, halo, max_points, chunk_size, bins=1024):
+    """
+    Cut a point cloud in tiles holding at most about max_points points each, their halo included,
+    from a 2D histogram of the points read one chunk at a time. The cloud is cut in slabs across
+    the first axis, and the slabs still too dense (a slab is at least halo thick) are cut across
+    the second axis.
+    Parameters:
+    input_file (str): Path to the binary .ply file.
+    axes (tuple[int, int]): The two axes of the cuts, e.g. the longest ones of the bounds.
+    low (np.ndarray): (3,) lower bounds of the cloud.
+    high (np.ndarray): (3,) upper bounds of the cloud.
+    halo (float): Margin added around every tile. Tiles are at least that wide.
+    max_points (int): Maximal number of points of a tile with its halo.
+    chunk_size (int): Vertices per chunk.
+    bins (int, optional): Bins of the histogram along each axis. Default is 1024.
+    Returns:
+    tuple[np.ndarray, np.ndarray]: (t, 2, 2) boxes of the tiles (lower and upper bounds along the
+    two axes, infinite on the outer sides) and (t,) slab of every tile, tiles sorted by slab.
+    """
+    low, high = np.asarray(low, dtype=np.float64)[list(axes)], np.asarray(high, dtype=np.float64)[list(axes)]
+    width = np.where(high > low, (high - low) / bins, 1.0)
+    histogram = np.zeros((bins, bins), dtype=np.int64)
+    for chunk in ply_io.iter_vertex_chunks(input_file, chunk_size):
+        position = np.clip(np.floor((ply_io.xyz(chunk)[:, list(axes)] - low) / width).astype(np.int64), 0, bins - 1)
+        histogram += np.bincount(position[:, 0] * bins + position[:, 1], minlength=bins * bins).reshape(bins, bins)
+    margin = np.maximum(np.ceil(halo / width).astype(np.int64), 1)
+
+    def edges(boundaries, axis):
+        values = low[axis] + boundaries * width[axis]
+        values[0], values[-1] = -np.inf, np.inf
+        return values
+
+    boxes, slabs = [], []
+    slab_bounds = _greedy_edges(histogram.sum(axis=1), margin[0], max_points)
+    u_edges = edges(slab_bounds.astype(np.float64), 0)
+    for slab, (start, end) in enumerate(zip(slab_bounds[:-1], slab_bounds[1:])):
+        counts = histogram[max(start - margin[0], 0):end + margin[0]].sum(axis=0)
+        v_edges = edges(_greedy_edges(counts, margin[1], max_points).astype(np.float64), 1)
+        for v_low, v_high in zip(v_edges[:-1], v_edges[1:]):
+            boxes.append([[u_edges[slab], v_low], [u_edges[slab + 1], v_high]])
+            slabs.append(slab)
+    return np.asarray(boxes), np.asarray(slabs)
+
+
+def _in_box(coordinates, box, margin):
+    # Points of (n, 2) coordinates inside a (2, 2) box grown by margin (shrunk if negative)
+    return np.all((coordinates >= box[0] - margin) & (coordinates < box[1] + margin), axis=1)
+
+
+def _spill_tiles(input_file, boxes, axes, halo, chunk_size, directory, prefilter=None):
+    # One pass over the file: every point (unless prefiltered) is appended to the file of every
+    # tile whose halo holds it. Returns the number of prefiltered points.
+    paths = [os.path.join(directory, f"tile_{t}.bin") for t in range(len(boxes))]
+    for path in paths:
+        open(path, "wb").close()
+    start = prefiltered = 0
+    for chunk in ply_io.iter_vertex_chunks(input_file, chunk_size):
+        records = np.empty(len(chunk), dtype=TILE_DTYPE)
+        records['index'] = np.arange(start, start + len(chunk))
+        records['xyz'] = ply_io.xyz(chunk)
+        start += len(chunk)
+        if prefilter:
+            colors = ply_io.rgb(chunk)
+            if colors is None:
+                raise ValueError(f"{input_file} has no colours, it cannot be prefiltered")
+            removed = class_mask(colors, prefilter)
+            prefiltered += int(removed.sum())
+            records = records[~removed]
+        coordinates = records['xyz'][:, list(axes)]
+        # One file open at a time: there can be more tiles than open files allowed
+        for box, path in zip(boxes, paths):
+            inside = _in_box(coordinates, box, halo)
+            if inside.any():
+                with open(path, "ab") as file:
+                    records[inside].tofile(file)
+    return prefiltered
+
+
+def _link_shared(indices, nodes):
+    # Distinct links between the nodes holding the same point
+    order = np.argsort(indices, kind='stable')
+    indices, nodes = indices[order], nodes[order]
+    same = indices[1:] == indices[:-1]
+    links = np.unique(np.stack([nodes[:-1][same], nodes[1:][same]], axis=1), axis=0)
+    return links[:, 0], links[:, 1]
+
+
+def stream_clusters(input_file, stats, directory, eps=0.5, min_samples=20, engine="voxel", memory_budget_mb=512,
+                    prefilter=None):
+    """
+    DBSCAN of a point cloud too large for memory, one tile at a time.
+    The cloud is cut in tiles (see tile_boxes), each tile is written to a temporary file with a
+    halo of 2 eps and clustered alone. A point within eps of a tile has all its neighbours in the
+    tile and its halo, so its core status is exact there: two tiles that both hold a core point
+    near their edges have their clusters of that point merged (union-find), which gives the
+    clusters of the whole cloud. Every point takes its label from the tile that owns it. Memory
+    holds one tile and the edge points of two slabs, and the labels of the whole cloud are a
+    memory-mapped file in directory.
+    The labels are the same as cluster_points on the whole cloud: the clusters are numbered in the
+    order of their first core point, and the border points touching several clusters are given the
+    lowest label after the merge.
+    Parameters:
+    input_file (str): Path to the binary .ply file.
+    stats (dict): Result of stream_cloud.cloud_stats (min, max and centroid are used).
+    directory (str): Directory of the temporary files (tiles and labels).
+    eps, min_samples, engine: See cluster_points.
+    memory_budget_mb (float, optional): Memory of a tile and of a chunk of the file, in MB. Default is 512.
+    prefilter (list[str], optional): Colour classes left out of the clustering (see main). Default is None.
+    Returns:
+    tuple[np.ndarray, np.ndarray, int]: The cluster table of the points (see cluster_table, noise
+    included, prefiltered points left out), the (n,) memory-mapped labels (-1 for noise, -2 for
+    prefiltered points) and the number of prefiltered points.
+    """
+    _, count, _ = ply_io.vertex_layout(input_file)
+    chunk_size = stream_cloud.chunk_size_for(input_file, memory_budget_mb)
+    low, high = np.asarray(stats["min"]), np.asarray(stats["max"])
+    center = np.asarray(stats["centroid"])
+    axes = tuple(int(axis) for axis in np.argsort(high - low)[::-1][:2])
+    max_points = max(int(memory_budget_mb * 2**20) // TILE_BYTES_PER_POINT, 1024)
+    boxes, slabs = tile_boxes(input_file, axes, low, high, 2 * eps, max_points, chunk_size)
+    prefiltered = _spill_tiles(input_file, boxes, axes, 2 * eps, chunk_size, directory, prefilter)
+
+    labels = np.lib.format.open_memmap(os.path.join(directory, "labels.npy"), mode="w+", dtype=np.int32, shape=(count,))
+    labels[:] = -2
+    # Nodes: the clusters of every tile, node 0 of a tile being its noise
+    nodes = 0
+    links_a, links_b, first_core, ties = [], [], [], []
+    # Core points near the edges of the tiles of the previous and current slabs: (index, node)
+    previous, current = [], []
+    for t, box in enumerate(boxes):
+        path = os.path.join(directory, f"tile_{t}.bin")
+        records = np.fromfile(path, dtype=TILE_DTYPE)
+        os.remove(path)
+        coordinates = records['xyz'][:, list(axes)]
+        if len(records):
+            local, core = cluster_points(records['xyz'], eps, min_samples, engine, return_core=True)
+        else:
+            local, core = np.zeros(0, dtype=np.int64), np.zeros(0, dtype=bool)
+        node = nodes + local + 1
+        n_local = int(local.max(initial=-1)) + 2
+        # All the noise is one node
+        links_a.append([nodes])
+        links_b.append([0])
+        edge = core & _in_box(coordinates, box, eps) & ~_in_box(coordinates, box, -eps)
+        current.append((records['index'][edge], node[edge]))
+
+        owned = _in_box(coordinates, box, 0)
+        labels[records['index'][owned]] = node[owned]
+        first = np.full(n_local, count, dtype=np.int64)
+        np.minimum.at(first, node[owned & core] - nodes, records['index'][owned & core])
+        first_core.append(first)
+        # Border points touching several clusters of the tile: the cluster of the lowest final
+        # label is only known after the merge, their candidates are kept (index, node)
+        border = owned & ~core & (local >= 0)
+        if border.any():
+            pairs = cKDTree(records['xyz'][border]).sparse_distance_matrix(
+                cKDTree(records['xyz'][core]), eps, output_type="ndarray")
+            candidates = np.unique(np.stack([np.flatnonzero(border)[pairs["i"]],
+                                             node[np.flatnonzero(core)[pairs["j"]]]], axis=1), axis=0)
+            several = np.bincount(candidates[:, 0], minlength=len(records)) > 1
+            tied = candidates[several[candidates[:, 0]]]
+            ties.append(np.stack([records['index'][tied[:, 0]], tied[:, 1]], axis=1))
+        nodes += n_local
+
+        if t + 1 == len(boxes) or slabs[t + 1] != slabs[t]:
+            # End of a slab: merge its tiles together and with the previous slab
+            shared = previous + current
+            a, b = _link_shared(np.concatenate([index for index, _ in shared]),
+                                np.concatenate([node for _, node in shared]))
+            links_a.append(a)
+            links_b.append(b)
+            previous, current = current, []
+
+    # Clusters of the whole cloud: the roots of the merged nodes, numbered like DBSCAN in the order
+    # of their first core point, noise (root 0) left at -1
+    root = union_find(nodes, np.concatenate(links_a).astype(np.int64), np.concatenate(links_b).astype(np.int64))
+    first = np.full(nodes, count, dtype=np.int64)
+    np.minimum.at(first, root, np.concatenate(first_core))
+    clusters = np.flatnonzero((first < count) & (np.arange(nodes) == root))
+    rank = np.full(nodes, -1, dtype=np.int64)
+    rank[clusters[np.argsort(first[clusters], kind='stable')]] = np.arange(len(clusters))
+    final = rank[root]
+
+    # Node labels -> cluster labels, one chunk at a time, then the tied border points
+    for start in range(0, count, chunk_size):
+        block = labels[start:start + chunk_size]
+        labels[start:start + chunk_size] = np.where(block >= 0, final[np.maximum(block, 0)], block)
+    if ties:
+        ties = np.concatenate(ties)
+        index, inverse = np.unique(ties[:, 0], return_inverse=True)
+        best = np.full(len(index), len(clusters), dtype=np.int64)
+        np.minimum.at(best, inverse, final[ties[:, 1]])
+        labels[index] = best
+    labels.flush()
+
+    # Cluster table of the final labels, one chunk at a time
+    parts, start = [], 0
+    for chunk in ply_io.iter_vertex_chunks(input_file, chunk_size):
+        block = labels[start:start + len(chunk)]
+        start += len(chunk)
+        clustered = block >= -1
+        if clustered.any():
+            parts.append(cluster_table(ply_io.xyz(chunk)[clustered], block[clustered].astype(np.int64), center))
+    parts = np.concatenate(parts) if parts else np.zeros(0, dtype=CLUSTER_DTYPE)
+    return merge_cluster_tables(parts), labels, prefiltered
+
+
+def main(input_file, output_file, eps=0.5, min_samples=20, visualize=True, verbose=True, timing_file=None, engine="voxel",
+         memory_budget_mb=None, prefilter=None):
     """
     Main function to perform DBSCAN clustering on a point cloud and filter the clusters (pot removing).
     Parameters:
@@ -24,91 +360,322 @@ def main(input_file, output_file, eps=0.5, min_samples=20):
     output_file (str): Path to the output .ply file to save the filtered point cloud.
     eps (float, optional): The maximum distance between two samples for one to be considered as in the neighborhood of the other. Default is 0.5.
     min_samples (int, optional): The number of samples in a neighborhood for a point to be considered as a core point. Default is 20.
+    visualize (bool, optional): Open a viewer window on the filtered point cloud at the end. Default is True.
+    verbose (bool, optional): Print the time, point count and memory of each stage. Default is True.
+    timing_file (str, optional): If given, write the timing record of the run to this JSON file.
+    engine (str, optional): DBSCAN implementation, "voxel" or "sklearn" (see cluster_points). Default is "voxel".
+    memory_budget_mb (float, optional): If given, streaming mode: the cloud is never loaded whole. It is read
+                                        one chunk of vertices at a time and clustered one tile at a time
+                                        (see stream_clusters), within about this budget. Default is None.
+    prefilter (list[str], optional): Colour classes removed before DBSCAN, e.g. ["soil", "pot"] (see color_segmentation.py).
+                                     They are not clustered, which shrinks the expensive step, and never kept. Default is None.
     
     Save the filtered point cloud to a new file
+    Returns:
+    dict: Summary of the run (number of points in/out, clusters found, selected clusters, cluster_table, elapsed seconds, stage timings).
     """
-    loading_animation("Loading point cloud")
+    if memory_budget_mb:
+        return _main_streamed(input_file, output_file, eps, min_samples, visualize, verbose, timing_file, engine,
+                              memory_budget_mb, prefilter)
+    timer = StageTimer(verbose=verbose)
 
     # Load the .ply file
-    pcd = o3d.io.read_point_cloud(input_file)
-    
-    # Extract points and colors
-    points = np.asarray(pcd.points)
-    colors = np.asarray(pcd.colors)
+    with timer.stage("load") as stage:
+        # Memory-mapped vertex data, points is a view on it
+        vertices = ply_io.read_vertices(input_file)
+        points = ply_io.xyz(vertices)
+        stage["points"] = len(points)
     
     # Calculate center of mass (origin of the point cloud)
-    loading_animation("Calculating center of mass")
-    center_of_mass = np.mean(points, axis=0)
+    with timer.stage("centroid", len(points)):
+        center_of_mass = np.mean(points, axis=0, dtype=np.float64)
     
+    # Remove the points of the prefilter colour classes (one table lookup per point)
+    candidates = None
+    if prefilter:
+        with timer.stage("prefilter", len(points)) as stage:
+            if ply_io.rgb(vertices) is None:
+                raise ValueError(f"{input_file} has no colours, it cannot be prefiltered")
+            removed = class_mask(ply_io.rgb(vertices), prefilter)
+            candidates = np.flatnonzero(~removed)
+            stage["points"] = len(candidates)
+
     # Apply DBSCAN clustering
-    loading_animation("Applying DBSCAN clustering")
-    dbscan = DBSCAN(eps=eps, min_samples=min_samples).fit(points)
-    labels = dbscan.labels_
-    
-    # Get unique labels of clusters
-    unique_labels = np.unique(labels)
-    print("Cluster labels:", unique_labels)
+    with timer.stage("dbscan", len(points) if candidates is None else len(candidates)):
+        if candidates is None:
+            labels = cluster_points(points, eps, min_samples, engine)
+        else:
+            # Prefiltered points are labelled as noise
+            labels = np.full(len(points), -1, dtype=np.int64)
+            labels[candidates] = cluster_points(points[candidates], eps, min_samples, engine)
     
-    clusters = {}
-    for label in unique_labels:
-        # Count number of points in each cluster
-        cluster_points = points[labels == label]
-        count = len(cluster_points)
-        
-        # Compute distance of each point to the center of mass
-        distances = np.linalg.norm(cluster_points - center_of_mass, axis=1)
-        
-        # Find minimal distance between points and center of mass
-        min_distance = np.min(distances)
+    with timer.stage("ranking", len(points)):
+        # Per cluster statistics, then keep the clusters of the plant. The prefiltered points are
+        # left out of the table: their -1 label would otherwise rank them with the noise
+        if candidates is None:
+            table = cluster_table(points, labels, center_of_mass)
+        else:
+            table = cluster_table(points[candidates], labels[candidates], center_of_mass)
+        closest_clusters = select_plant_clusters(table)
         
-        # Store count and minimal distance for each cluster
-        clusters[label] = {'count': count, 'min_distance': min_distance}
-    
-    # Sort clusters by size and keep the three biggest clusters
-    loading_animation("Sorting clusters")
-    sorted_by_size = dict(sorted(clusters.items(), key=lambda item: item[1]['count'], reverse=True))
-    largest_clusters = dict(list(sorted_by_size.items())[:3])
-    
-    # Sort the biggest clusters by distance to the center of mass
-    sorted_by_distance = dict(sorted(largest_clusters.items(), key=lambda item: item[1]['min_distance']))
-    
-    # Select clusters closest to the center of mass
-    closest_clusters = list(sorted_by_distance.keys())[:2]
-    print("Nearest clusters:", closest_clusters)
-    
-    # Mask to keep points in the selected clusters
-    mask = np.isin(labels, closest_clusters)
-    filtered_points = points[mask]
-    filtered_colors = colors[mask]
+        # Mask to keep points in the selected clusters
+        mask = np.isin(labels, closest_clusters)
+        if candidates is not None:
+            mask[removed] = False
+        kept = int(mask.sum())
+        filtered = vertices[mask]
+    if verbose:
+        print("Cluster labels:", table['label'])
+        print("Nearest clusters:", closest_clusters)
     
-    # # Apply brown filter to remove brownish points from the filtered clusters
-    # loading_animation("Applying color filter")
-    # brown_filter = (filtered_colors[:, 0] > 0.4) & (filtered_colors[:, 1] > 0.2) & (filtered_colors[:, 1] < 0.6) & (filtered_colors[:, 2] < 0.3)
-    
-    # # Keep only points that are not brownish
-    # filtered_points = filtered_points[~brown_filter]
-    # filtered_colors = filtered_colors[~brown_filter]
-    
-    # Create a new point cloud with the filtered points and colors
-    loading_animation("Saving filtered point cloud")
-    filtered_pcd = o3d.geometry.PointCloud()
-    filtered_pcd.points = o3d.utility.Vector3dVector(filtered_points)
-    filtered_pcd.colors = o3d.utility.Vector3dVector(filtered_colors)
-    
-    # Save the filtered point cloud to a file
-    o3d.io.write_point_cloud(output_file, filtered_pcd)
-    print(f"Filtered point cloud saved to: {output_file}")
+    # Save the filtered points with all their properties (colors, normals)
+    with timer.stage("save", kept):
+        ply_io.write_ply(output_file, filtered, comments=[run_comment(eps, min_samples, engine, prefilter)])
+    if verbose:
+        print(f"Filtered point cloud saved to: {output_file} ({timer.total:.2f} s)")
+
+    if timing_file is not None:
+        timer.write_json(timing_file, input=input_file, output=output_file, eps=eps, min_samples=min_samples, engine=engine)
     
     # Visualize the filtered point cloud
-    o3d.visualization.draw_geometries([filtered_pcd], point_show_normal=False)
+    if visualize:
+        show_point_cloud(filtered)
+
+    return {
+        'input': input_file,
+        'output': output_file,
+        'points': len(points),
+        'kept': kept,
+        'prefiltered': 0 if candidates is None else len(points) - len(candidates),
+        'clusters': int(np.sum(table['label'] >= 0)),
+        'selected': [int(label) for label in closest_clusters],
+        'cluster_table': table,
+        'seconds': timer.total,
+        'stages': {record['stage']: record['seconds'] for record in timer.stages},
+    }
+
+
+def _main_streamed(input_file, output_file, eps, min_samples, visualize, verbose, timing_file, engine, memory_budget_mb,
+                   prefilter):
+    # Streaming mode of main: the same stages, no whole-cloud array in memory
+    timer = StageTimer(verbose=verbose)
+    chunk_size = stream_cloud.chunk_size_for(input_file, memory_budget_mb)
+    with timer.stage("centroid") as stage:
+        stats = stream_cloud.cloud_stats(input_file, chunk_size)
+        stage["points"] = n_points = stats["points"]
+    if not n_points:
+        raise ValueError(f"{input_file} has no points")
+
+    with tempfile.TemporaryDirectory(dir=os.path.dirname(os.path.abspath(output_file))) as directory:
+        with timer.stage("dbscan", n_points):
+            table, labels, prefiltered = stream_clusters(input_file, stats, directory, eps, min_samples, engine,
+                                                         memory_budget_mb, prefilter)
+        with timer.stage("ranking", len(table)):
+            closest_clusters = select_plant_clusters(table)
+            kept = int(table['count'][np.isin(table['label'], closest_clusters)].sum())
+        if verbose:
+            print("Cluster labels:", table['label'])
+            print("Nearest clusters:", closest_clusters)
+
+        # Save the points of the selected clusters, the labels read one chunk at a time like the vertices
+        with timer.stage("save", kept):
+            read = [0]
+
+            def keep(chunk):
+                start, read[0] = read[0], read[0] + len(chunk)
+                return np.isin(labels[start:read[0]], closest_clusters)
+
+            stream_cloud.stream_filter(input_file, output_file, keep, chunk_size,
+                                       comments=[run_comment(eps, min_samples, engine, prefilter)])
+        del labels
+    if verbose:
+        print(f"Filtered point cloud saved to: {output_file} ({timer.total:.2f} s)")
+
+    if timing_file is not None:
+        timer.write_json(timing_file, input=input_file, output=output_file, eps=eps, min_samples=min_samples, engine=engine)
+    if visualize:
+        show_point_cloud(ply_io.read_vertices(output_file))
+
+    return {
+        'input': input_file,
+        'output': output_file,
+        'points': n_points,
+        'kept': kept,
+        'prefiltered': prefiltered,
+        'clusters': int(np.sum(table['label'] >= 0)),
+        'selected': [int(label) for label in closest_clusters],
+        'cluster_table': table,
+        'seconds': timer.total,
+        'stages': {record['stage']: record['seconds'] for record in timer.stages},
+    }
+
+
+def show_point_cloud(vertices):
+    """Open the Open3D viewer on a structured vertex array (see ply_io)."""
+    # Only needed for the viewer, batch runs do not import Open3D
+    import open3d as o3d
+
+    pcd = o3d.geometry.PointCloud()
+    pcd.points = o3d.utility.Vector3dVector(np.asarray(ply_io.xyz(vertices), dtype=np.float64))
+    colors = ply_io.colors(vertices)
+    if colors is not None:
+        pcd.colors = o3d.utility.Vector3dVector(np.asarray(colors, dtype=np.float64))
+    o3d.visualization.draw_geometries([pcd], point_show_normal=False)
+
+
+# ------ Batch mode
+
+
+OUTPUT_SUFFIX = "_Plant_Filtered.ply"
+
+
+def expand_inputs(pattern):
+    """
+    List the point cloud files to process.
+    Parameters:
+    pattern (str): A directory (every .ply inside is taken) or a glob pattern such as "scans/Merge_*_pc.ply".
+    Returns:
+    list[str]: Sorted input paths. Outputs of a previous run (*_Plant_Filtered.ply) are left out.
+    """
+    if os.path.isdir(pattern):
+        pattern = os.path.join(pattern, "*.ply")
+    files = sorted(glob.glob(pattern))
+    return [f for f in files if not f.endswith(OUTPUT_SUFFIX)]
+
+
+def output_path_for(input_file, output_dir):
+    """Path of the filtered cloud written for input_file, e.g. Merge_01_pc.ply -> Merge_01_pc_Plant_Filtered.ply."""
+    stem = os.path.splitext(os.path.basename(input_file))[0]
+    return os.path.join(output_dir, stem + OUTPUT_SUFFIX)
+
+
+def timing_path_for(output_file):
+    """Path of the JSON timing record written next to output_file, e.g. Merge_01_pc_Plant_Filtered_timing.json."""
+    return os.path.splitext(output_file)[0] + "_timing.json"
+
+
+def run_comment(eps, min_samples, engine, prefilter=None):
+    """Header comment of an output file recording the parameters it was made with (see is_current)."""
+    return (f"clustering eps={float(eps)!r} min_samples={int(min_samples)} engine={engine} "
+            f"prefilter={','.join(sorted(prefilter)) if prefilter else 'none'}")
+
+
+def is_current(input_file, output_file, eps=0.5, min_samples=20, engine="voxel", prefilter=None):
+    """
+    True if output_file exists, is not older than input_file and was made with the same parameters.
+    The parameters are read from the comments of its header (see run_comment): an output made with
+    other parameters, or before they were recorded, is out of date.
+    """
+    if not os.path.exists(output_file) or os.path.getmtime(output_file) < os.path.getmtime(input_file):
+        return False
+    try:
+        comments = ply_io.read_header(output_file)["comments"]
+    except ValueError:
+        return False
+    return run_comment(eps, min_samples, engine, prefilter) in comments
+
+
+def _batch_job(input_file, output_file, eps, min_samples, timing, engine, memory_budget_mb=None, prefilter=None):
+    # Runs in a worker process: no viewer, no progress output.
+    timing_file = timing_path_for(output_file) if timing else None
+    try:
+        result = main(input_file, output_file, eps, min_samples, visualize=False, verbose=False,
+                      timing_file=timing_file, engine=engine, memory_budget_mb=memory_budget_mb, prefilter=prefilter)
+        result['status'] = 'done'
+    except Exception as error:
+        result = {'input': input_file, 'output': output_file, 'status': f'failed: {error}'}
+    return result
+
+
+def run_batch(pattern, output_dir, eps=0.5, min_samples=20, workers=None, force=False, timing=False, engine="voxel",
+              memory_budget_mb=None, prefilter=None):
+    """
+    Run pot removal on every point cloud matching pattern, in parallel and without visualization.
+    Parameters:
+    pattern (str): Directory or glob pattern of the input .ply files (see expand_inputs).
+    output_dir (str): Directory where the filtered clouds are written (one output per input).
+    eps (float, optional): DBSCAN eps parameter. Default is 0.5.
+    min_samples (int, optional): DBSCAN min_samples parameter. Default is 20.
+    workers (int, optional): Number of worker processes. Default is the number of CPUs.
+    force (bool, optional): Reprocess inputs even if their output is already up to date. Default is False.
+    timing (bool, optional): Write a JSON timing record next to each output (see timing_path_for). Default is False.
+    engine (str, optional): DBSCAN implementation, "voxel" or "sklearn" (see cluster_points). Default is "voxel".
+    memory_budget_mb (float, optional): Streaming mode of every worker (see main). Default is None.
+    prefilter (list[str], optional): Colour classes removed before DBSCAN (see main). Default is None.
+    Returns:
+    list[dict]: One summary per input file, in input order.
+    """
+    inputs = expand_inputs(pattern)
+    if not inputs:
+        print(f"No .ply file matches {pattern}")
+        return []
+    os.makedirs(output_dir, exist_ok=True)
+
+    results = {}
+    jobs = []
+    for input_file in inputs:
+        output_file = output_path_for(input_file, output_dir)
+        if not force and is_current(input_file, output_file, eps, min_samples, engine, prefilter):
+            results[input_file] = {'input': input_file, 'output': output_file, 'status': 'skipped'}
+        else:
+            jobs.append((input_file, output_file))
+
+    print(f"{len(inputs)} files, {len(jobs)} to process, {len(inputs) - len(jobs)} up to date.")
+    if jobs:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            futures = [pool.submit(_batch_job, input_file, output_file, eps, min_samples, timing, engine, memory_budget_mb, prefilter)
+                       for input_file, output_file in jobs]
+            for done, future in enumerate(as_completed(futures), 1):
+                result = future.result()
+                results[result['input']] = result
+                print(f"[{done}/{len(jobs)}] {os.path.basename(result['input'])}: {result['status']}")
+
+    ordered = [results[input_file] for input_file in inputs]
+    print_summary(ordered)
+    return ordered
+
+
+def print_summary(results):
+    """Print one line per file with timing and cluster statistics."""
+    header = (f"{'file':<40} {'status':<10} {'points':>10} {'kept':>10} {'clusters':>9} {'selected':>10} "
+              f"{'dbscan [s]':>10} {'time [s]':>9}")
+    print(header)
+    print("-" * len(header))
+    for result in results:
+        name = os.path.basename(result['input'])
+        if result['status'] == 'done':
+            selected = ",".join(str(label) for label in result['selected'])
+            print(f"{name:<40} {'done':<10} {result['points']:>10} {result['kept']:>10} "
+                  f"{result['clusters']:>9} {selected:>10} {result['stages']['dbscan']:>10.2f} {result['seconds']:>9.2f}")
+        else:
+            print(f"{name:<40} {result['status']:<10}")
+    total = sum(result.get('seconds', 0.0) for result in results)
+    print(f"Total processing time: {total:.2f} s")
+
+
+def _is_batch_input(path):
+    return os.path.isdir(path) or glob.has_magic(path)
+
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Filter and cluster point clouds with DBSCAN and color filtering.")
-    parser.add_argument("input_file", type=str, help="Path to the input .ply file.")
-    parser.add_argument("output_file", type=str, help="Path to save the filtered .ply file.")
+    parser.add_argument("input_file", type=str, help="Path to the input .ply file, or a directory / glob pattern (quote it) for batch mode.")
+    parser.add_argument("output_file", type=str, help="Path to save the filtered .ply file (output directory in batch mode).")
     parser.add_argument("--eps", type=float, default=0.5, help="DBSCAN eps parameter (default: 0.5)")
     parser.add_argument("--min_samples", type=int, default=20, help="DBSCAN min_samples parameter (default: 20)")
+    parser.add_argument("--engine", choices=ENGINES, default="voxel", help="DBSCAN implementation: voxel accelerated or sklearn (default: voxel)")
+    parser.add_argument("--workers", type=int, default=None, help="Batch mode: number of worker processes (default: number of CPUs)")
+    parser.add_argument("--force", action="store_true", help="Batch mode: reprocess files whose output is already up to date")
+    parser.add_argument("--no-view", action="store_true", help="Do not open the viewer at the end (single file mode)")
+    parser.add_argument("--timing-json", action="store_true", help="Write a JSON record of the stage timings next to each output file")
+    parser.add_argument("--memory_budget", type=float, default=None, help="Streaming mode: read the vertices in chunks and cluster the cloud in tiles within about this budget in MB (see stream_clusters)")
+    parser.add_argument("--prefilter", nargs="+", default=None, choices=CLASSES, help="Colour classes removed before DBSCAN, e.g. soil pot (see color_segmentation.py)")
     
     args = parser.parse_args()
     
-    main(args.input_file, args.output_file, args.eps, args.min_samples)
\ No newline at end of file
+    if _is_batch_input(args.input_file):
+        run_batch(args.input_file, args.output_file, args.eps, args.min_samples, args.workers, args.force, args.timing_json, args.engine, args.memory_budget, args.prefilter)
+    else:
+        timing_file = timing_path_for(args.output_file) if args.timing_json else None
+        main(args.input_file, args.output_file, args.eps, args.min_samples, visualize=not args.no_view,
+             timing_file=timing_file, engine=args.engine, memory_budget_mb=args.memory_budget, prefilter=args.prefilter)
\ No newline at end of file
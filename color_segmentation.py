@@ -0,0 +1,219 @@
+import argparse
+from functools import lru_cache
+
+import numpy as np
+
+# Colour classes of the points of a scan; the class of a colour is its index in CLASSES
+CLASSES = ("unknown", "plant", "soil", "pot", "cube")
+UNKNOWN, PLANT, SOIL, POT, CUBE = range(len(CLASSES))
+
+# Bits per channel of the lookup tables: 6 bits gives 64³ = 262 144 quantized colours (256 kB),
+# a step of 4/255 per channel
+DEFAULT_BITS = 6
+
+# Hue (degrees), minimal saturation and minimal value of the blue reference cube
+CUBE_HUE = (190, 260)
+CUBE_MIN_SATURATION = 0.35
+CUBE_MIN_VALUE = 0.15
+
+# Lab chroma (sqrt(a² + b²)) below which a colour is a grey
+MIN_CHROMA = 15
+
+# D65 white point and sRGB -> XYZ matrix of the Lab conversion
+WHITE_D65 = np.array([0.95047, 1.0, 1.08883])
+SRGB_TO_XYZ = np.array([[0.4124564, 0.3575761, 0.1804375],
+                        [0.2126729, 0.7151522, 0.0721750],
+                        [0.0193339, 0.1191920, 0.9503041]])
+
+
+def _unit_rgb(colors):
+    # Colours as float32 in [0, 1], from uint8 or floats
+    rgb = np.asarray(colors, dtype=np.float32)
+    if np.issubdtype(np.asarray(colors).dtype, np.integer):
+        rgb = rgb / 255
+    return rgb
+
+
+def rgb_to_hsv(colors):
+    """
+    Convert colours to HSV in bulk.
+
+    Args:
+        colors (np.ndarray): (n, 3) RGB colours, uint8 or floats in [0, 1].
+
+    Returns:
+        np.ndarray: (n, 3) float32 array of hue in degrees [0, 360), saturation and value in [0, 1].
+    """
+    rgb = _unit_rgb(colors)
+    value = rgb.max(axis=1)
+    delta = value - rgb.min(axis=1)
+    saturation = np.divide(delta, value, out=np.zeros_like(value), where=value > 0)
+    safe = np.where(delta > 0, delta, 1)
+    r, g, b = rgb[:, 0], rgb[:, 1], rgb[:, 2]
+    hue = np.select(
+        [delta == 0, value == r, value == g],
+        [0, ((g - b) / safe) % 6, (b - r) / safe + 2],
+        (r - g) / safe + 4,
+    ) * 60
+    return np.stack([hue, saturation, value], axis=1).astype(np.float32)
+
+
+def rgb_to_lab(colors):
+    """
+    Convert sRGB colours to CIE Lab (D65) in bulk.
+
+    Args:
+        colors (np.ndarray): (n, 3) sRGB colours, uint8 or floats in [0, 1].
+
+    Returns:
+        np.ndarray: (n, 3) float32 array of L in [0, 100], a and b (about -128 to 127).
+    """
+    rgb = _unit_rgb(colors).astype(np.float64)
+    linear = np.where(rgb > 0.04045, ((rgb + 0.055) / 1.055) ** 2.4, rgb / 12.92)
+    xyz = (linear @ SRGB_TO_XYZ.T) / WHITE_D65
+    f = np.where(xyz > (6 / 29) ** 3, np.cbrt(xyz), xyz / (3 * (6 / 29) ** 2) + 4 / 29)
+    lab = np.stack([116 * f[:, 1] - 16, 500 * (f[:, 0] - f[:, 1]), 200 * (f[:, 1] - f[:, 2])], axis=1)
+    return lab.astype(np.float32)
+
+
+def color_classes(colors):
+    """
+    Class of every colour from its HSV and Lab coordinates (the rules the lookup tables are built from).
+
+    - cube: the blue of the reference cube (CUBE_HUE, CUBE_MIN_SATURATION, CUBE_MIN_VALUE and MIN_CHROMA)
+    - plant: green to yellow-green, not too dark, chroma of at least MIN_CHROMA
+    - soil: browns, i.e. orange hues of low value, and the brown filter once commented out in clustering_algo.py
+    - pot: dark colours of low chroma (black or grey plastic)
+
+    Args:
+        colors (np.ndarray): (n, 3) RGB colours, uint8 or floats in [0, 1].
+
+    Returns:
+        np.ndarray: (n,) uint8 class indices (see CLASSES).
+    """
+    rgb = _unit_rgb(colors)
+    hsv = rgb_to_hsv(rgb)
+    lab = rgb_to_lab(rgb)
+    hue, saturation, value = hsv[:, 0], hsv[:, 1], hsv[:, 2]
+    chroma = np.hypot(lab[:, 1], lab[:, 2])
+
+    cube = ((hue >= CUBE_HUE[0]) & (hue <= CUBE_HUE[1])
+            & (saturation >= CUBE_MIN_SATURATION) & (value >= CUBE_MIN_VALUE) & (chroma >= MIN_CHROMA))
+    # Dark greys have unstable hues and saturations: the coloured classes also need some chroma
+    plant = (hue >= 60) & (hue <= 170) & (saturation >= 0.15) & (value >= 0.12) & (chroma >= MIN_CHROMA)
+    brown = (rgb[:, 0] > 0.4) & (rgb[:, 1] > 0.2) & (rgb[:, 1] < 0.6) & (rgb[:, 2] < 0.3)
+    soil = brown | ((hue >= 10) & (hue <= 50) & (saturation >= 0.25) & (value >= 0.08) & (value <= 0.55)
+                    & (chroma >= MIN_CHROMA))
+    pot = (chroma < MIN_CHROMA) & (lab[:, 0] < 40)
+
+    # First matching rule wins, in this order
+    return np.select([cube, plant, soil, pot], [CUBE, PLANT, SOIL, POT], UNKNOWN).astype(np.uint8)
+
+
+def quantize(colors, bits=DEFAULT_BITS):
+    """
+    Index of the quantized colour of every point in a lookup table (see build_lut).
+
+    Args:
+        colors (np.ndarray): (n, 3) RGB colours, uint8 or floats in [0, 1].
+        bits (int, optional): Bits per channel. Defaults to DEFAULT_BITS.
+
+    Returns:
+        np.ndarray: (n,) int64 indices in [0, 2**(3 * bits)).
+    """
+    colors = np.asarray(colors)
+    if colors.dtype == np.uint8:
+        levels = colors.astype(np.int64) >> (8 - bits)
+    else:
+        levels = np.clip((colors * (1 << bits)).astype(np.int64), 0, (1 << bits) - 1)
+    return (levels[:, 0] << (2 * bits)) | (levels[:, 1] << bits) | levels[:, 2]
+
+
+def lut_colors(bits=DEFAULT_BITS):
+    """RGB colours (floats in [0, 1]) of all the entries of a lookup table, in the order of quantize."""
+    shift = 8 - bits
+    # Centre of every bin, in 8-bit units; exactly the 256 levels for bits=8
+    levels = ((np.arange(1 << bits) << shift) + ((1 << shift) >> 1)) / 255
+    r, g, b = np.meshgrid(levels, levels, levels, indexing="ij")
+    return np.stack([r.ravel(), g.ravel(), b.ravel()], axis=1).astype(np.float32)
+
+
+def build_lut(bits=DEFAULT_BITS, classifier=color_classes):
+    """
+    Precompute the class of every quantized colour.
+
+    Args:
+        bits (int, optional): Bits per channel. Defaults to DEFAULT_BITS.
+        classifier (callable, optional): (n, 3) colours -> (n,) values. Defaults to color_classes.
+
+    Returns:
+        np.ndarray: (2**(3 * bits),) lookup table, indexed by quantize.
+    """
+    return classifier(lut_colors(bits))
+
+
+@lru_cache(maxsize=None)
+def default_lut(bits=DEFAULT_BITS):
+    """Lookup table of color_classes, built once per process."""
+    lut = build_lut(bits)
+    lut.flags.writeable = False
+    return lut
+
+
+def classify(colors, lut=None, bits=DEFAULT_BITS):
+    """
+    Class of every point from its colour: one quantization and one indexed gather per point.
+
+    Args:
+        colors (np.ndarray): (n, 3) RGB colours, uint8 or floats in [0, 1].
+        lut (np.ndarray, optional): Lookup table (see build_lut). Defaults to default_lut(bits).
+        bits (int, optional): Bits per channel of the table. Defaults to DEFAULT_BITS.
+
+    Returns:
+        np.ndarray: (n,) values of the table, class indices for the default one (see CLASSES).
+    """
+    lut = default_lut(bits) if lut is None else lut
+    return lut[quantize(colors, bits)]
+
+
+def class_mask(colors, classes, lut=None, bits=DEFAULT_BITS):
+    """
+    Select the points of some colour classes.
+
+    Args:
+        colors (np.ndarray): (n, 3) RGB colours, uint8 or floats in [0, 1].
+        classes (str | list[str]): Class name(s), e.g. "cube" or ["soil", "pot"].
+        lut, bits: See classify.
+
+    Returns:
+        np.ndarray: (n,) boolean mask.
+    """
+    classes = [classes] if isinstance(classes, str) else list(classes)
+    unknown = set(classes) - set(CLASSES)
+    if unknown:
+        raise ValueError(f"Unknown colour class(es): {', '.join(sorted(unknown))}, expected {', '.join(CLASSES)}")
+    selected = np.zeros(len(CLASSES), dtype=bool)
+    selected[[CLASSES.index(name) for name in classes]] = True
+    return selected[classify(colors, lut, bits)]
+
+
+if __name__ == "__main__":
+    import ply_io
+
+    parser = argparse.ArgumentParser(description="Classify the points of a point cloud by colour (plant, soil, pot, cube).")
+    parser.add_argument("input_file", type=str, help="Path to the point cloud (.ply, with colours).")
+    parser.add_argument("--remove", nargs="+", default=None, choices=CLASSES, help="Classes removed from the cloud")
+    parser.add_argument("--output", type=str, default=None, help="Path of the cloud without the removed classes")
+
+    args = parser.parse_args()
+    vertices = ply_io.read_vertices(args.input_file)
+    colors = ply_io.rgb(vertices)
+    if colors is None:
+        raise SystemExit(f"{args.input_file} has no colours")
+    counts = np.bincount(classify(colors), minlength=len(CLASSES))
+    for name, count in zip(CLASSES, counts):
+        print(f"{name:<8} {count:>10} ({count / max(len(colors), 1):.1%})")
+    if args.remove and args.output:
+        keep = ~class_mask(colors, args.remove)
+        ply_io.write_ply(args.output, vertices[keep])
+        print(f"{int(keep.sum())} points saved to {args.output}")
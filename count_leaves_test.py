@@ -1,118 +1,176 @@
+import argparse
+import csv
+import glob
+import os
+from concurrent.futures import ProcessPoolExecutor
+
 import open3d as o3d
 import numpy as np
 from skimage.morphology import skeletonize
-from skimage import img_as_bool
+
+import ply_io
+from voxel_grid import dense_boxes, sparse_voxelize, voxel_degrees, voxel_downsample, voxelize
 
 # Function to convert a point cloud to voxel grid and then to binary image
 def point_cloud_to_binary_image(pcd, voxel_size=2.1):
     # Voxel grid downsampling -> reducing data size
     voxel_grid = pcd.voxel_down_sample(voxel_size)
-    
+
     # Convert the point cloud to numpy array
     points = np.asarray(voxel_grid.points)
-    
-    # Create a 3D grid that bounds the point cloud
-    min_bound = points.min(axis=0)
-    max_bound = points.max(axis=0)
-    shape = np.ceil((max_bound - min_bound) / voxel_size).astype(int)
-
-    # Translate the points to fit within the grid
-    translated_points = ((points - min_bound) / voxel_size).astype(int)
-    
-    # Initialize a 3D binary grid (False means empty, True means filled)
-    binary_image = np.zeros(shape, dtype=bool)
-    
-    # Mark the points as occupied in the binary image
-    for pt in translated_points:
-        bdinary_image[tuple(pt)] = True
-    
+
+    # 3D grid that bounds the point cloud, filled in one call (count of points per voxel)
+    counts, min_bound = voxelize(points, voxel_size)
+
+    # Occupancy: False means empty, True means filled
+    binary_image = counts > 0
+
     return binary_image, min_bound, voxel_size
 
+# Function to convert an (n, 3) array of points to the set of its occupied voxels (no dense grid)
+def points_to_voxel_set(points, voxel_size=2.1):
+    downsampled, _ = voxel_downsample(points, voxel_size)
+    coords, counts, min_bound = sparse_voxelize(downsampled, voxel_size)
+    return coords, counts, min_bound, voxel_size
+
 # Function to perform skeletonization
-def skeletonize_point_cloud(pcd, voxel_size=2.1):
-    # Convert the point cloud to a binary 3D image
-    binary_image, min_bound, voxel_size = point_cloud_to_binary_image(pcd, voxel_size)
-    
-    # Perform skeletonization on the binary image (skimage's skeletonize function)
-    skeleton = skeletonize(binary_image)
-    
+def skeletonize_point_cloud(pcd, voxel_size=2.1, sparse=False):
+    """
+    Skeletonize the voxels of a point cloud.
+
+    With sparse=True, the occupied voxels are kept as coordinates and every connected part is
+    skeletonized in its own small box, so large plants do not need a dense grid of their whole
+    bounding box. The skeleton is then returned as (k, 3) voxel coordinates instead of a grid.
+    """
+    if not sparse:
+        # Convert the point cloud to a binary 3D image
+        binary_image, min_bound, voxel_size = point_cloud_to_binary_image(pcd, voxel_size)
+
+        # Perform skeletonization on the binary image (skimage's skeletonize function)
+        skeleton = skeletonize(binary_image)
+
+        return skeleton, min_bound, voxel_size
+
+    return skeletonize_points(np.asarray(pcd.points), voxel_size)
+
+# Function to perform the sparse skeletonization of an (n, 3) array of points
+def skeletonize_points(points, voxel_size=2.1):
+    coords, _, min_bound, voxel_size = points_to_voxel_set(points, voxel_size)
+    parts = [corner + np.argwhere(skeletonize(box)) for corner, box, _ in dense_boxes(coords)]
+    skeleton = np.concatenate(parts) if parts else np.empty((0, 3), dtype=np.int64)
     return skeleton, min_bound, voxel_size
 
 # Function to convert skeleton back to point cloud (visualization)
 def skeleton_to_point_cloud(skeleton, min_bound, voxel_size):
-    # Get the indices of the skeleton points
-    skeleton_points = np.argwhere(skeleton)
-    
+    # Get the indices of the skeleton points (a grid, or already voxel coordinates)
+    skeleton_points = np.argwhere(skeleton) if skeleton.ndim == 3 else skeleton
+
     # Scale back to the original point cloud scale
     scaled_points = skeleton_points * voxel_size + min_bound
-    
+
     # Create Open3D point cloud from the skeleton points
     skeleton_pcd = o3d.geometry.PointCloud()
     skeleton_pcd.points = o3d.utility.Vector3dVector(scaled_points)
-    
+
     return skeleton_pcd
 
 
-def count_leaf_tips(point_cloud, radius=2):
+def skeleton_tips(skeleton):
     """
-    Count points with exactly one neighbor in the point cloud.
-    
+    Find the end points of a skeleton from the adjacency of its voxels (degree 1), without a radius.
+
     Args:
-        point_cloud (o3d.geometry.PointCloud): The input point cloud.
-        radius (float): The radius to consider for neighborhood search.
-        
+        skeleton (np.ndarray): Skeleton grid, or (k, 3) voxel coordinates (sparse skeleton).
+
+    Returns:
+        np.ndarray: (t, 3) voxel coordinates of the tips.
+    """
+    coords = np.argwhere(skeleton) if skeleton.ndim == 3 else skeleton
+    return coords[voxel_degrees(coords, simplify=True) == 1]
+
+
+def count_tips_file(path, voxel_size=2.1):
+    """
+    Skeletonize one point cloud (sparse voxels) and count the tips of its skeleton.
+
+    Args:
+        path (str): Path to the .ply point cloud.
+        voxel_size (float, optional): Edge of the voxels. Defaults to 2.1.
+
+    Returns:
+        dict: file, skeleton (number of skeleton voxels) and tips (number of leaf tips).
+    """
+    # Memory-mapped vertices, no Open3D object
+    skeleton, _, _ = skeletonize_points(ply_io.xyz(ply_io.read_vertices(path)), voxel_size)
+    return {"file": os.path.basename(path), "skeleton": len(skeleton), "tips": len(skeleton_tips(skeleton))}
+
+
+def run_batch(files, output_csv=None, voxel_size=2.1, workers=None):
+    """
+    Count the leaf tips of many point clouds on a process pool.
+
+    Args:
+        files (list[str]): Paths to the .ply point clouds.
+        output_csv (str, optional): CSV file the counts are saved to. Defaults to None (printed only).
+        voxel_size (float, optional): Edge of the voxels. Defaults to 2.1.
+        workers (int, optional): Number of worker processes. Defaults to the number of CPUs.
+
     Returns:
-        tuple: A list of tip points and the count of leaf tips.
+        list[dict]: One row per file (see count_tips_file).
     """
-    # Create a KDTree for the point cloud
-    pcd_tree = o3d.geometry.KDTreeFlann(point_cloud)
-    
-    # Extract points
-    points = np.asarray(point_cloud.points)
-    
-    # List to store tip points
-    tip_points = []
-    
-    # Iterate through each point
-    for i, point in enumerate(points):
-        # Find neighbors within the radius
-        [_, idx, _] = pcd_tree.search_radius_vector_3d(point, radius)
-        
-        # If exactly one neighbor exists, it's a tip
-        if len(idx) == 2:  # Include the point itself and one neighbor
-            tip_points.append(point)
-        
-    # Check if tip_points is empty
-    if not tip_points:
-        print("No tip points found. Check your radius or point cloud density.")
-    
-    # Convert tip points to a point cloud for visualization
-    tip_pcd = o3d.geometry.PointCloud()
-    tip_pcd.points = o3d.utility.Vector3dVector(np.array(tip_points))
-    
-    return tip_pcd, len(tip_points)
-
-
-
-# Load your point cloud
-pcd = o3d.io.read_point_cloud("scans/Merge_01_pc_Plant_Filteredwocube_pc.ply")  # Replace with your path
-
-# Skeletonize the point cloud
-skeleton, min_bound, voxel_size = skeletonize_point_cloud(pcd)
-
-# Convert the skeleton back to a point cloud for visualization
-skeleton_pcd = skeleton_to_point_cloud(skeleton, min_bound, voxel_size)
-
-# Visualize the original point cloud and skeleton
-o3d.visualization.draw_geometries([skeleton_pcd])
-
-
-# Count leaf tips
-radius = 3.62  # Adjust based on point cloud scale and resolution
-tip_pcd, tip_count = count_leaf_tips(skeleton_pcd, radius)
-
-# Print results
-print(f"Number of leaf tips: {tip_count}")
-
-# Visualize the tip points
-o3d.visualization.draw_geometries([pcd, tip_pcd.paint_uniform_color([1, 0, 0])])
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        rows = list(pool.map(count_tips_file, files, [voxel_size] * len(files)))
+    for row in rows:
+        print(f"{row['file']}: {row['tips']} leaf tips ({row['skeleton']} skeleton voxels)")
+    if output_csv:
+        with open(output_csv, "w", newline="") as file:
+            writer = csv.DictWriter(file, fieldnames=["file", "skeleton", "tips"])
+            writer.writeheader()
+            writer.writerows(rows)
+    return rows
+
+
+
+def _is_batch_input(path):
+    return os.path.isdir(path) or glob.has_magic(path)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Count the leaf tips of point clouds from their skeleton.")
+    parser.add_argument("inputs", nargs="*", default=["scans/Merge_01_pc_Plant_Filteredwocube_pc.ply"],
+                        help="Point cloud(s); several files, a directory or a glob pattern (quote it) run in batch mode.")
+    parser.add_argument("--voxel_size", type=float, default=2.1, help="Edge of the voxels (default: 2.1)")
+    parser.add_argument("--workers", type=int, default=None, help="Batch mode: number of worker processes (default: number of CPUs)")
+    parser.add_argument("--csv", type=str, default=None, help="Batch mode: save the counts to this CSV file")
+    args = parser.parse_args()
+
+    if len(args.inputs) > 1 or _is_batch_input(args.inputs[0]):
+        files = []
+        for pattern in args.inputs:
+            files += sorted(glob.glob(os.path.join(pattern, "*.ply") if os.path.isdir(pattern) else pattern))
+        run_batch(files, args.csv, args.voxel_size, args.workers)
+        raise SystemExit
+
+    # Load your point cloud
+    points = ply_io.xyz(ply_io.read_vertices(args.inputs[0]))
+
+    # Skeletonize the point cloud, as in batch mode
+    skeleton, min_bound, voxel_size = skeletonize_points(points, args.voxel_size)
+
+    # Convert the skeleton back to a point cloud for visualization
+    skeleton_pcd = skeleton_to_point_cloud(skeleton, min_bound, voxel_size)
+
+    # Visualize the skeleton
+    o3d.visualization.draw_geometries([skeleton_pcd])
+
+    # Count leaf tips: the skeleton voxels with a single neighbour voxel (same count as count_tips_file)
+    tips = skeleton_tips(skeleton)
+    tip_pcd = skeleton_to_point_cloud(tips, min_bound, voxel_size)
+
+    # Print results
+    print(f"Number of leaf tips: {len(tips)}")
+
+    # Visualize the tip points
+    pcd = o3d.geometry.PointCloud()
+    pcd.points = o3d.utility.Vector3dVector(np.asarray(points, dtype=np.float64))
+    o3d.visualization.draw_geometries([pcd, tip_pcd.paint_uniform_color([1, 0, 0])])
@@ -0,0 +1,123 @@
+import hashlib
+import json
+import os
+import tempfile
+
+import numpy as np
+
+
+def file_hash(path, block_size=2**24):
+    """
+    Return the SHA-256 of the content of a file.
+
+    Args:
+        path (str): Path to the file.
+        block_size (int, optional): Bytes read at a time. Defaults to 16 MB.
+
+    Returns:
+        str: Hexadecimal digest.
+    """
+    digest = hashlib.sha256()
+    with open(path, "rb") as file:
+        for block in iter(lambda: file.read(block_size), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class FeatureCache:
+    """
+    On-disk cache of arrays computed from an input file, e.g. the downsampled points, normals and
+    FPFH features of a scan.
+
+    Entries are .npz files named after a hash of the input file content and of the parameters
+    used to compute them, so a renamed or copied scan still hits the cache and a modified one
+    does not. When the cache grows over max_bytes, the least recently used entries are removed.
+    """
+
+    def __init__(self, directory=".feature_cache", max_bytes=2 * 2**30):
+        """
+        Args:
+            directory (str, optional): Directory of the cache. Defaults to ".feature_cache".
+            max_bytes (int, optional): Size above which old entries are evicted. Defaults to 2 GB.
+        """
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._hashes = {}
+        os.makedirs(directory, exist_ok=True)
+
+    def key(self, path, params):
+        """
+        Return the cache key of a file and a set of parameters.
+
+        Args:
+            path (str): Path to the input file.
+            params (dict): JSON serializable parameters the cached arrays depend on.
+
+        Returns:
+            str: Hexadecimal key.
+        """
+        stat = os.stat(path)
+        # The content hash is only recomputed if the file changed during this run
+        signature = (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+        if signature not in self._hashes:
+            self._hashes[signature] = file_hash(path)
+        text = json.dumps({"file": self._hashes[signature], "params": params}, sort_keys=True)
+        return hashlib.sha256(text.encode()).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + ".npz")
+
+    def load(self, key):
+        """
+        Return the arrays stored under key, or None if there are none.
+
+        Args:
+            key (str): Cache key (see key).
+
+        Returns:
+            dict[str, np.ndarray] | None: The cached arrays.
+        """
+        path = self._path(key)
+        try:
+            with np.load(path) as data:
+                arrays = {name: data[name] for name in data.files}
+            # The modification time is the last use of the entry, for the eviction
+            os.utime(path)
+        except (FileNotFoundError, OSError, ValueError):
+            return None
+        return arrays
+
+    def store(self, key, arrays):
+        """
+        Store arrays under key, then evict old entries if the cache is too big.
+
+        Args:
+            key (str): Cache key (see key).
+            arrays (dict[str, np.ndarray]): Arrays to store.
+        """
+        # Write to a temporary file first so other processes never read a partial entry
+        handle, temporary = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        with os.fdopen(handle, "wb") as file:
+            np.savez(file, **arrays)
+        os.replace(temporary, self._path(key))
+        self.evict()
+
+    def evict(self):
+        """Remove the least recently used entries until the cache is under max_bytes."""
+        entries = []
+        for name in os.listdir(self.directory):
+            if name.endswith(".npz"):
+                try:
+                    stat = os.stat(os.path.join(self.directory, name))
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, name))
+        total = sum(size for _, size, _ in entries)
+        for _, size, name in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except FileNotFoundError:
+                pass
+            total -= size
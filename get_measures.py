@@ -9,9 +9,13 @@ bl_info = {
     "category" : "Add Mesh",
 }
 
+import hashlib
+import json
+import os
+import sys
+
 import bpy
 import numpy as np
-from scipy.spatial import ConvexHull
 # To get the volume
 import math
 
@@ -25,6 +29,16 @@ from bpy.app.translations import pgettext_tip as tip_
 from object_print3d_utils import report
 from mathutils import Vector
 
+# Helper modules of the repository (leaf_geometry, ...) sit next to this script
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+from blender_io import mesh_colors, world_vertices
+from calibration import calibrate_cloud, calibrate_cube, find_stick
+from leaf_geometry import leaf_midrib, leaf_table
+from reference_cube import box_extents, pick_cube_part
+
+# Objects drawn by the Measure Leaf operator, never the cube nor a part of the plant
+VISUAL_OBJECTS = ("Point_A", "Point_B", "Leaf_Length_Line")
+
 
 def clean_float(value: float, precision: int = 0) -> str:
     """
@@ -96,6 +110,81 @@ def get_unit(unit_system: str, unit: str) -> tuple[float, str]:
         return units[unit_system][fallback_unit]
 
 
+def scan_objects(scene):
+    """Mesh objects of the scene, without the objects drawn by the Measure Leaf operator."""
+    return [obj for obj in scene.objects if obj.type == 'MESH' and not obj.name.startswith(VISUAL_OBJECTS)]
+
+
+def object_volume(obj):
+    """Volume of a mesh object in world space, as computed by the 3D-Print Toolbox."""
+    from object_print3d_utils import mesh_helpers
+
+    bm = mesh_helpers.bmesh_copy_from_object(obj, apply_modifiers=True)
+    volume = bm.calc_volume()
+    bm.free()
+    return volume
+
+
+def scan_key(objects, points):
+    """Hash of the names and world vertices of the scan objects, to know if a stored calibration still applies."""
+    key = hashlib.sha1()
+    for obj, vertices in zip(objects, points):
+        key.update(obj.name.encode())
+        key.update(np.ascontiguousarray(vertices, dtype=np.float64).tobytes())
+    return key.hexdigest()
+
+
+def calibrate_scene(scene, force=False):
+    """
+    Find the reference cube of the scan and return the calibration of the scene (see calibration.py).
+
+    The calibration is computed once and stored in the scene (saved with the .blend file), so the
+    volume and leaf operators reuse it. It is stored with the hash of the scan objects (see scan_key)
+    and computed again when they change (objects separated, renamed, moved or edited). The cube is the smallest cube-like mesh once the scan is
+    separated by loose parts; before that, it is found by its colour.
+
+    Args:
+        scene (bpy.types.Scene): The scene of the scan.
+        force (bool, optional): Recompute the calibration even if the scene has one. Defaults to False.
+
+    Returns:
+        dict | None: The calibration, with the name of the cube object in "cube_object",
+                     or None if no cube was found.
+    """
+    objects = scan_objects(scene)
+    points = [world_vertices(obj) for obj in objects]
+    key = scan_key(objects, points)
+    if not force and "calibration" in scene and scene.get("calibration_key") == key:
+        return json.loads(scene["calibration"])
+
+    parts = [{"volume": object_volume(obj), "vertices": len(vertices),
+              "extents": box_extents(vertices) if len(vertices) >= 4 else np.zeros(3)}
+             for obj, vertices in zip(objects, points)]
+    cube = pick_cube_part(parts)
+
+    calibration = None
+    if cube is not None:
+        calibration = calibrate_cube(points[cube], parts[cube]["volume"])
+        calibration["cube_object"] = objects[cube].name
+        others = [vertices for i, vertices in enumerate(points) if i != cube]
+        if others:
+            find_stick(np.vstack(others), calibration)
+    else:
+        # Scan not separated yet: find the cube by its colour
+        for obj, vertices in zip(objects, points):
+            colors = mesh_colors(obj.data)
+            if colors is not None:
+                calibration = calibrate_cloud(vertices, colors)
+                if calibration is not None:
+                    calibration["cube_object"] = None
+                    break
+
+    if calibration is not None:
+        scene["calibration"] = json.dumps(calibration)
+        scene["calibration_key"] = key
+    return calibration
+
+
 # ------
 
 
@@ -150,6 +239,32 @@ class OBJECT_check_quantity(bpy.types.Operator):
             return {'CANCELLED'}
 
 
+class OBJECT_calibrate(bpy.types.Operator):
+    bl_idname = "object.calibrate_scale"
+    bl_label = "Calibrate scale"
+    bl_description = "find the reference cube, fit a box on it and store the scale of the scan"
+    bl_options = {'REGISTER', 'UNDO'}
+
+    def execute(self, context):
+        """
+        Computes the calibration of the scan again (e.g. after deleting chunks of mesh) and reports it.
+        Args:
+            context (bpy.types.Context): The context in which the operator is called.
+        Returns:
+            dict: A dictionary indicating the result of the operation, either {'FINISHED'} or {'CANCELLED'}.
+        """
+        calibration = calibrate_scene(context.scene, force=True)
+        if calibration is None:
+            self.report({'WARNING'}, "No reference cube found!")
+            return {'CANCELLED'}
+
+        report.update((tip_("Cube: {}").format(calibration["cube_object"] or calibration["method"]), None),
+        (tip_("Cube edge: {}").format(clean_float(calibration["cube_edge"], 4)), None),
+        (tip_("Scale: {} cm/unit").format(clean_float(calibration["cm_per_unit"], 6)), None))
+
+        return {'FINISHED'}
+
+
 class OBJECT_volumePlant(bpy.types.Operator):
     bl_idname = "object.plant_volume"
     bl_label = "Get plant volume"
@@ -164,43 +279,32 @@ class OBJECT_volumePlant(bpy.types.Operator):
         Returns:
         dict: A dictionary indicating the result of the operation, either {'FINISHED'} or {'CANCELLED'}.
         The function performs the following steps:
-        1. Checks if exactly one object (the cube) is selected.
-        2. Calculates the volume of the selected cube.
-        3. Computes the ratio of a theoretical volume to the calculated volume of the cube.
-        4. Selects all objects and deselects the cube to isolate the plant object.
-        5. Checks if exactly one object (the plant) is selected.
-        6. Calculates the total volume of the plant object.
-        7. Adjusts the plant volume based on the previously computed ratio.
-        8. Updates the report with the calculated volumes and ratio.
+        1. Gets the calibration of the scene (see calibrate_scene), which finds the cube.
+        2. Takes the volume of the cube and the ratio of the theoretical volume to it from the calibration.
+        3. Takes all the other meshes as the plant.
+        4. Checks if there is exactly one plant object.
+        5. Calculates the total volume of the plant object.
+        6. Adjusts the plant volume based on the ratio.
+        7. Updates the report with the calculated volumes and ratio.
         Raises:
-        Warning: If more than one object is selected at any point or if the plant mesh is split into multiple meshes.
+        Warning: If no cube is found or if the plant mesh is split into multiple meshes.
         """
         
         ### 4
-        # check if one object is selected (the cube)
-        selected_obj = bpy.context.selected_objects
-        if len(selected_obj) != 1:
-            self.report({'WARNING'}, "Select only the cube!")
+        # find the cube with the calibration of the scan (computed once per scene)
+        scene = context.scene
+        calibration = calibrate_scene(scene)
+        if calibration is None or calibration.get("cube_object") not in scene.objects.keys():
+            self.report({'WARNING'}, "No reference cube found! Separate the mesh by loose parts first.")
             return {'CANCELLED'}
-        
-        # get the volume of the selected object
-        obj = selected_obj[0]
-        bpy.context.view_layer.objects.active = obj
-        
-        
-        from object_print3d_utils import mesh_helpers
+        cube = scene.objects[calibration["cube_object"]]
 
-        scene = context.scene
         unit = scene.unit_settings
         scale = 1.0 if unit.system == 'NONE' else unit.scale_length
-        obj = context.active_object
-
-        bm = mesh_helpers.bmesh_copy_from_object(obj, apply_modifiers=True)
-        volume = bm.calc_volume()
-        bm.free()
 
+        volume = calibration["cube_volume"]
         if unit.system == 'NONE':
-            volume_fmt = clean_float(volume, 8)
+            volumeCube_fmt = clean_float(volume, 8)
         else:
             length, symbol = get_unit(unit.system, unit.length_unit)
 
@@ -208,18 +312,15 @@ class OBJECT_volumePlant(bpy.types.Operator):
             volume_str = clean_float(volume_unit, 2)
             volumeCube_fmt = f"{volume_str} "
 
-        # calculate the ratio realVol : theoVol
-        ratio = 3.765/volume_unit
-        ratio_str = clean_float(ratio, 2)
+        # ratio realVol : theoVol (3.765 cm³ / cube volume), from the calibration
+        ratio = calibration["volume_ratio"]
         
-        # select the other object (the plant)
-        bpy.ops.object.select_all(action='SELECT')
-        obj.select_set(False)
+        # the other objects are the plant
+        selected_obj = [obj for obj in scan_objects(scene) if obj != cube]
         
         #####################################################
 
         # check if it's only one object
-        selected_obj = bpy.context.selected_objects
         if len(selected_obj) != 1:
             self.report({'WARNING'}, "The plant mesh is splitted in more than one mesh! Please, check if they're all belonging to the plant.")
         
@@ -227,27 +328,12 @@ class OBJECT_volumePlant(bpy.types.Operator):
 
         for obj in selected_obj:
             # calculate the volume of the plant
-            bpy.context.view_layer.objects.active = obj
-            
-            scene = context.scene
-            obj = context.active_object
+            tot_volume += object_volume(obj)
 
-            bm = mesh_helpers.bmesh_copy_from_object(obj, apply_modifiers=True)
-            volume = bm.calc_volume()
-            bm.free()
-            tot_volume += volume
-
-        if unit.system == 'NONE':
-            volume_fmt = clean_float(tot_volume, 8)
-        else:
-            length, symbol = get_unit(unit.system, unit.length_unit)
-
-            volume_unit = tot_volume * (scale ** 3.0) / (length ** 3.0)
-            volPlant_str = clean_float(tot_volume, 2)
-            volPlant_fmt = f"{volPlant_str}"
-            volumeReal_unit = volume_unit*ratio
-            volume_str = clean_float(volumeReal_unit, 2)
-            volumePlant_fmt = f"{volume_str} cm"
+        # the ratio converts the volumes of the scan to cm³, whatever the unit settings
+        volumeReal_unit = tot_volume * ratio
+        volPlant_fmt = clean_float(tot_volume, 2)
+        volumePlant_fmt = f"{clean_float(volumeReal_unit, 2)} cm"
         
         
         
@@ -271,11 +357,11 @@ class OBJECT_measureLeaf(bpy.types.Operator):
         This function performs the following steps:
         1. Ensures only one object is selected and it is of type 'MESH'.
         2. Extracts the vertices of the selected object.
-        3. Computes the Convex Hull of the vertices.
-        4. Finds the two farthest points on the Convex Hull to determine the leaf length.
-        5. Projects the vertices onto a plane defined by the longest span to determine the leaf width.
-        6. Computes the 2D Convex Hull of the projected points to determine the leaf area.
-        7. Converts the measurements to real-world values using a scale factor.
+        3. Measures the leaf length along its midrib, the width (orthogonal to the length) in the PCA
+           frame of the leaf, the area of the 2D Convex Hull in the plane of the leaf and the surface
+           area of the leaf, as the pipeline does (see leaf_geometry.leaf_table).
+        4. Draws the midrib and its two tips.
+        7. Converts the measurements to real-world values using the scale of the calibration (see calibrate_scene).
         8. Reports the leaf length, width, and area.
         Args:
             context (bpy.types.Context): The context in which the operator is called.
@@ -295,76 +381,45 @@ class OBJECT_measureLeaf(bpy.types.Operator):
             self.report({'WARNING'}, "The selected object is not in MESH format.")
             return {'CANCELLED'}
         
-        bm = bmesh.new()
-        bm.from_mesh(obj.data)
-        vertices = [v.co for v in bm.verts]
-        bm.free()
-
-        # Convert vertices to NumPy array
-        points = np.array([(v.x, v.y, v.z) for v in vertices])
-        
-        # Compute Convex Hull
-        hull = ConvexHull(points)
-        hull_points = points[hull.vertices]
+        # Vertices in world space (like the cube of the calibration), read in one call
+        points = world_vertices(obj)
         
-        # Find the two farthest points on the Convex Hull
-        max_dist = 0
-        point_a = point_b = None
-        for i, p1 in enumerate(hull_points):
-            for p2 in hull_points[i + 1:]:
-                dist = np.linalg.norm(p1 - p2)
-                if dist > max_dist:
-                    max_dist = dist
-                    point_a, point_b = p1, p2
+        # Length along the midrib, width, projected area and surface area in the PCA frame of the leaf
+        leaf = leaf_table(points, np.zeros(len(points), dtype=np.int64))[0]
+        max_dist = leaf['length']
         
-        # Draw the points and line for the longest span
-        if point_a is not None and point_b is not None:
-            # Convert back to Blender Vector for visualization
-            point_a = Vector(point_a)
-            point_b = Vector(point_b)
-            
+        # Draw the tips and the midrib the length is measured along
+        if max_dist > 0:
             #bpy.ops.object.mode_set(mode='OBJECT')  # Ensure we're in OBJECT mode
-            self.create_visual_point(context, point_a, name="Point_A")
-            self.create_visual_point(context, point_b, name="Point_B")
+            midrib = leaf_midrib(points)
+            self.create_visual_point(context, Vector(midrib[0]), name="Point_A")
+            self.create_visual_point(context, Vector(midrib[-1]), name="Point_B")
             
-            self.create_visual_line(context, point_a, point_b, name="Leaf_Length_Line")
+            self.create_visual_line(context, [Vector(node) for node in midrib], name="Leaf_Length_Line")
             
-            # Project vertices onto the plane defined by the longest span
-            length_dir = (point_b - point_a).normalized()
-            perp_dir = Vector((-length_dir.y, length_dir.x, length_dir.z))  # Perpendicular direction in 3D
-        
-            projections = [Vector((v.dot(length_dir), v.dot(perp_dir), 0)) for v in vertices]
-            proj_points = np.array([(p.x, p.y) for p in projections])
-
-            # Find the bounding box of the projected points
-            min_proj = min(projections, key=lambda p: p.dot(perp_dir))
-            max_proj = max(projections, key=lambda p: p.dot(perp_dir))
-        
-            # Calculate the full width
-            max_width = (max_proj - min_proj).length
-
-            # Compute 2D Convex Hull for the projected points
-            area_hull = ConvexHull(proj_points)
-            leaf_area = area_hull.volume  # The volume of the 2D hull is the area
+            max_width, leaf_area, surface_area = leaf['width'], leaf['projected_area'], leaf['surface_area']
         
             # Draw the points and line for the width
 #            self.create_visual_point(context, min_proj + point_a, name="Width_Point_1")
 #            self.create_visual_point(context, max_proj + point_a, name="Width_Point_2")
 #            self.create_visual_line(context, min_proj + point_a, max_proj + point_a, name="Leaf_Width_Line")
 #            
-            # set the scale factor, conversion to real value
-            real_cube_length = 0.036 # Cube diagonal + stick (in m)
-            blender_cube_length = 34 # blender measure (in m)
+            # scale factor of the scan (cm per unit), from the reference cube
+            calibration = calibrate_scene(context.scene)
+            if calibration is None:
+                self.report({'WARNING'}, "No reference cube found to calibrate the scan!")
+                return {'CANCELLED'}
+            scale_factor = calibration["cm_per_unit"]
             
-            scale_factor = real_cube_length / blender_cube_length
-            
-            real_max_distance = max_dist * scale_factor * 100 # * 100 to convert in centimeters
-            real_max_width = max_width * scale_factor * 100
-            real_leaf_area = leaf_area * (scale_factor ** 2) * 10000  # Convert to cm^2
+            real_max_distance = max_dist * scale_factor
+            real_max_width = max_width * scale_factor
+            real_leaf_area = leaf_area * (scale_factor ** 2)
+            real_surface_area = surface_area * (scale_factor ** 2)
             
             dist_str = clean_float(real_max_distance, 3)
             width_str = clean_float(real_max_width, 3)
             area_str = clean_float(real_leaf_area, 3)
+            surface_str = clean_float(real_surface_area, 3)
             
     
         else:
@@ -375,10 +430,9 @@ class OBJECT_measureLeaf(bpy.types.Operator):
         report.update(
         (tip_("Leaf length: {}cm").format(dist_str), None),
         (tip_("Leaf width: {}cm").format(width_str), None),
-        (tip_("Leaf area: {}cm²").format(area_str), None)
+        (tip_("Leaf area: {}cm²").format(area_str), None),
+        (tip_("Leaf surface: {}cm²").format(surface_str), None)
         )
-
-        bm.free()
         
         return {'FINISHED'}
 
@@ -400,13 +454,12 @@ class OBJECT_measureLeaf(bpy.types.Operator):
         point.display_type = 'WIRE'
         point.show_in_front = True  # Rendre visible même derrière d'autres objets
     
-    def create_visual_line(self, context, start, end, name="Visual_Line"):
+    def create_visual_line(self, context, points, name="Visual_Line"):
         """
-        Creates a visual line in the Blender context between two points.
+        Creates a visual line in the Blender context through a list of points (a polyline).
         Args:
             context (bpy.types.Context): The Blender context in which to create the line.
-            start (tuple): A tuple of three floats representing the starting coordinates of the line.
-            end (tuple): A tuple of three floats representing the ending coordinates of the line.
+            points (list): The points of the line, each one a tuple of three floats.
             name (str, optional): The name of the new line object. Defaults to "Visual_Line".
         Returns:
             None
@@ -416,9 +469,9 @@ class OBJECT_measureLeaf(bpy.types.Operator):
         context.collection.objects.link(line_obj)
         
         bm = bmesh.new()
-        v1 = bm.verts.new(start)
-        v2 = bm.verts.new(end)
-        bm.edges.new([v1, v2])
+        verts = [bm.verts.new(point) for point in points]
+        for v1, v2 in zip(verts[:-1], verts[1:]):
+            bm.edges.new([v1, v2])
         bm.to_mesh(mesh)
         bm.free()
         line_obj.display_type = 'WIRE'
@@ -468,6 +521,7 @@ class OBJECT_PT_GetPlantMeasures_panel(bpy.types.Panel):
         layout = self.layout
         layout.operator("object.separate")
         #layout.operator("object.check_quantity")
+        layout.operator("object.calibrate_scale")
         layout.operator("object.plant_volume")
         layout.operator("object.measure_leaf")
         self.draw_report(context)
@@ -476,6 +530,7 @@ class OBJECT_PT_GetPlantMeasures_panel(bpy.types.Panel):
 classes = [
     OBJECT_separate,
     OBJECT_check_quantity,
+    OBJECT_calibrate,
     OBJECT_volumePlant,
     OBJECT_measureLeaf,
     OBJECT_PT_GetPlantMeasures_panel
@@ -0,0 +1,270 @@
+import numpy as np
+from scipy.spatial import ConvexHull, Delaunay
+
+
+def farthest_pair(points, block_size=256):
+    """
+    Find the two points farthest apart (the diameter of the set), exactly.
+
+    Only the convex hull vertices can be the farthest pair, and their pairwise distances are
+    computed in blocks of block_size rows, so memory stays at block_size x hull size. The squared
+    distances are summed from the coordinate differences, not expanded as |a|² + |b|² - 2a.b, which
+    loses its precision to cancellation for points far from the origin.
+
+    Args:
+        points (np.ndarray): (n, d) array of points, d = 2 or 3.
+        block_size (int, optional): Number of hull vertices compared at a time. Defaults to 256.
+
+    Returns:
+        tuple[np.ndarray, np.ndarray, float]: The two points and their distance.
+    """
+    points = np.asarray(points, dtype=np.float64)
+    try:
+        candidates = points[ConvexHull(points).vertices]
+    except Exception:
+        # Flat or degenerate sets (e.g. fewer than d + 1 points): compare all the points
+        candidates = points
+    best, best_i, best_j = -1.0, 0, 0
+    for start in range(0, len(candidates), block_size):
+        differences = candidates[start:start + block_size, None, :] - candidates[None, :, :]
+        squared = np.einsum("ijk,ijk->ij", differences, differences)
+        i, j = np.unravel_index(np.argmax(squared), squared.shape)
+        if squared[i, j] > best:
+            best, best_i, best_j = squared[i, j], start + i, j
+    point_a, point_b = candidates[best_i], candidates[best_j]
+    return point_a, point_b, float(np.sqrt(best))
+
+
+LEAF_DTYPE = np.dtype([
+    ('leaf', np.int64),
+    ('points', np.int64),
+    ('centroid', np.float64, 3),
+    ('axes', np.float64, (3, 3)),
+    ('length', np.float64),
+    ('width', np.float64),
+    ('thickness', np.float64),
+    ('projected_area', np.float64),
+    ('surface_area', np.float64),
+])
+
+
+def leaf_frames(points, labels):
+    """
+    PCA frame of every label in one pass: segmented covariance reductions and one batched eigh.
+
+    Args:
+        points (np.ndarray): (n, 3) point coordinates.
+        labels (np.ndarray): (n,) label of every point, 0, 1, ... or -1 for none.
+
+    Returns:
+        tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]: (k, 3) centroids, (k, 3, 3) axes
+        (rows: length, width and normal directions, a right-handed frame), (k,) point counts and
+        the (n, 3) coordinates of every point in the frame of its label (0 for unlabelled points).
+    """
+    points = np.asarray(points, dtype=np.float64)
+    labels = np.asarray(labels)
+    n_labels = int(labels.max()) + 1 if len(labels) else 0
+    labelled = labels >= 0
+    counts = np.bincount(labels[labelled], minlength=n_labels)
+    safe_counts = np.maximum(counts, 1)[:, None]
+    centroids = np.stack([np.bincount(labels[labelled], weights=points[labelled, i], minlength=n_labels)
+                          for i in range(3)], axis=1) / safe_counts
+
+    centred = np.zeros_like(points)
+    centred[labelled] = points[labelled] - centroids[labels[labelled]]
+    # The 6 distinct entries of every covariance matrix, each one a weighted bincount
+    rows, cols = np.triu_indices(3)
+    covariance = np.zeros((n_labels, 3, 3))
+    for i, j in zip(rows, cols):
+        covariance[:, i, j] = covariance[:, j, i] = np.bincount(
+            labels[labelled], weights=centred[labelled, i] * centred[labelled, j], minlength=n_labels)
+    covariance /= safe_counts[:, :, None]
+
+    # eigh sorts the eigenvalues in increasing order: the largest axis is the last column
+    _, vectors = np.linalg.eigh(covariance)
+    axes = np.swapaxes(vectors[:, :, ::-1], 1, 2)
+    axes[:, 2] = np.cross(axes[:, 0], axes[:, 1])
+
+    local = np.zeros_like(points)
+    local[labelled] = np.einsum("nij,nj->ni", axes[labels[labelled]], centred[labelled])
+    return centroids, axes, counts, local
+
+
+def _triangle_areas(corners):
+    # (m, 3, 3) triangle corners -> (m,) areas
+    return 0.5 * np.linalg.norm(np.cross(corners[:, 1] - corners[:, 0], corners[:, 2] - corners[:, 0]), axis=1)
+
+
+def midrib_nodes(sorted_local, counts, low, high, bins=20, bin_points=20):
+    """
+    Midrib of every leaf, as a polyline in the frame of the leaf: the points are binned along the
+    first axis, the mean point of every bin is a node, and the midrib is extended from its end
+    nodes to the tips of the leaf along its end segments. All the leaves are binned at once; a
+    leaf curled back past its first axis (bent by more than about 2.5 rad) is measured short.
+
+    Args:
+        sorted_local (np.ndarray): (n, 3) coordinates of the points in the frame of their leaf, sorted by leaf.
+        counts (np.ndarray): (k,) number of points of every leaf.
+        low (np.ndarray): (k,) smallest first coordinate of every leaf.
+        high (np.ndarray): (k,) largest first coordinate of every leaf.
+        bins (int, optional): Maximal number of bins of a leaf. Defaults to 20.
+        bin_points (int, optional): Minimal mean number of points per bin, fewer bins on small leaves. Defaults to 20.
+
+    Returns:
+        tuple[np.ndarray, np.ndarray]: (m, 3) nodes, tips included, sorted by leaf then along the
+        first axis, and (m,) leaf of every node. Leaves without points have no node.
+    """
+    n_bins = np.clip(counts // bin_points, 1, bins)
+    offsets = np.concatenate([[0], np.cumsum(n_bins)])
+    leaf = np.repeat(np.arange(len(counts)), counts)
+    extent = high - low
+    step = np.where(extent > 0, extent / n_bins, 1.0)
+    position = np.floor((sorted_local[:, 0] - low[leaf]) / step[leaf]).astype(np.int64)
+    node = offsets[leaf] + np.clip(position, 0, n_bins[leaf] - 1)
+
+    # Mean point of every non-empty bin, in the order of the bins of every leaf
+    node_count = np.bincount(node, minlength=offsets[-1])
+    filled = np.flatnonzero(node_count)
+    nodes = np.stack([np.bincount(node, weights=sorted_local[:, i], minlength=offsets[-1])[filled]
+                      for i in range(3)], axis=1) / node_count[filled, None]
+    node_leaf = np.searchsorted(offsets, filled, side="right") - 1
+
+    # Tips: the end segments extended to the extreme points (flat for leaves of one node)
+    present = np.unique(node_leaf)
+    first = np.searchsorted(node_leaf, present)
+    last = np.searchsorted(node_leaf, present, side="right") - 1
+    second = np.where(last > first, first + 1, first)
+    before_last = np.where(last > first, last - 1, last)
+    start_slope = _slope(nodes[second] - nodes[first])
+    end_slope = _slope(nodes[last] - nodes[before_last])
+    start = nodes[first] + (low[present] - nodes[first, 0])[:, None] * start_slope
+    end = nodes[last] + (high[present] - nodes[last, 0])[:, None] * end_slope
+
+    # Between the bins of a leaf: its start tip just before them, its end tip just after them
+    keys = np.concatenate([filled, offsets[present] - 0.25, offsets[present + 1] - 0.75])
+    order = np.argsort(keys)
+    return (np.concatenate([nodes, start, end])[order],
+            np.concatenate([node_leaf, present, present])[order])
+
+
+def leaf_midrib(points, bins=20):
+    """
+    Midrib of a single leaf in the coordinates of its points, e.g. to draw it: the polyline whose
+    length is the length of leaf_table.
+
+    Args:
+        points (np.ndarray): (n, 3) point coordinates of the leaf.
+        bins (int, optional): Maximal number of nodes (see midrib_nodes). Defaults to 20.
+
+    Returns:
+        np.ndarray: (m, 3) nodes of the midrib, from tip to tip.
+    """
+    centroids, axes, counts, local = leaf_frames(points, np.zeros(len(points), dtype=np.int64))
+    nodes, _ = midrib_nodes(local, counts, local[:, 0].min(keepdims=True), local[:, 0].max(keepdims=True), bins)
+    return centroids[0] + nodes @ axes[0]
+
+
+def _slope(segments):
+    # Segments scaled to a unit step along the first axis, (1, 0, 0) where they have none
+    run = segments[:, :1]
+    return np.where(run > 1e-12, segments / np.where(run > 1e-12, run, 1), [1.0, 0.0, 0.0])
+
+
+def _unroll(leaf_local, nodes):
+    # Coordinates of the points of one leaf along its midrib: arc length, second axis, and
+    # offset from the midrib in the plane of the first axis and the normal
+    run = nodes[:, [0, 2]]
+    segments = np.diff(run, axis=0)
+    lengths = np.linalg.norm(segments, axis=1)
+    tangents = segments / np.maximum(lengths, 1e-12)[:, None]
+    arc = np.concatenate([[0.0], np.cumsum(lengths)])
+    segment = np.clip(np.searchsorted(run[:, 0], leaf_local[:, 0]) - 1, 0, len(segments) - 1)
+    relative = leaf_local[:, [0, 2]] - run[segment]
+    along = arc[segment] + np.einsum("ij,ij->i", relative, tangents[segment])
+    offset = relative[:, 1] * tangents[segment, 0] - relative[:, 0] * tangents[segment, 1]
+    return np.column_stack([along, leaf_local[:, 1], offset])
+
+
+def leaf_table(points, labels, cm_per_unit=1.0, edge_factor=3.0, surface_cells=400, length_bins=20):
+    """
+    Measure all the leaves of a plant at once, from the labels of its points (e.g. segment_leaves).
+
+    Each leaf is measured in its PCA frame (see leaf_frames): the length follows its midrib (see
+    midrib_nodes), so a drooping leaf is not measured by its chord; the width is its extent along
+    the second axis and the thickness its extent along the normal. The projected area is the area
+    of the 2D convex hull of the points in the plane of the leaf. The surface area follows the
+    curvature of the leaf: the points are unrolled along the midrib (arc length, width and offset
+    from the midrib), triangulated on the first two (Delaunay, 2.5D), and the 3D areas of the
+    triangles are summed, leaving out the triangles having an edge longer than edge_factor times
+    the median edge of the leaf (they span the notches of the outline). The offsets are first
+    averaged over about surface_cells cells of the leaf, otherwise the noise of the scanner folds
+    the surface and inflates its area. The hulls and triangulations are the only per-leaf steps.
+
+    Args:
+        points (np.ndarray): (n, 3) point coordinates.
+        labels (np.ndarray): (n,) leaf of every point, 0, 1, ... or -1 for none.
+        cm_per_unit (float, optional): Scale of the scan (see calibration.py); lengths are then in
+                                       cm and areas in cm². Defaults to 1 (units of the scan).
+        edge_factor (float, optional): Longest triangle edge of the surface, in median edges. Defaults to 3.
+        surface_cells (int, optional): Number of cells the heights are averaged over. Defaults to 400.
+        length_bins (int, optional): Maximal number of nodes of the midrib (see midrib_nodes). Defaults to 20.
+
+    Returns:
+        np.ndarray: Structured array (LEAF_DTYPE) with one row per label: leaf, points, centroid,
+                    axes (rows: length, width and normal directions), length, width, thickness,
+                    projected_area and surface_area. Leaves of fewer than 3 points have no area.
+    """
+    centroids, axes, counts, local = leaf_frames(points, labels)
+    labels = np.asarray(labels)
+    n_leaves = len(counts)
+    table = np.zeros(n_leaves, dtype=LEAF_DTYPE)
+    table['leaf'] = np.arange(n_leaves)
+    table['points'] = counts
+    table['centroid'] = centroids
+    table['axes'] = axes
+    if n_leaves == 0:
+        return table
+
+    # Extents along the three axes, as segmented min/max reductions over the points sorted by leaf
+    labelled = np.flatnonzero(labels >= 0)
+    order = labelled[np.argsort(labels[labelled], kind="stable")]
+    starts = np.searchsorted(labels[order], np.arange(n_leaves))
+    present = counts > 0
+    sorted_local = local[order]
+    low, high = np.zeros((n_leaves, 3)), np.zeros((n_leaves, 3))
+    low[present] = np.minimum.reduceat(sorted_local, starts[present], axis=0)
+    high[present] = np.maximum.reduceat(sorted_local, starts[present], axis=0)
+    extents = high - low
+    nodes, node_leaf = midrib_nodes(sorted_local, counts, low[:, 0], high[:, 0], length_bins)
+    inner = node_leaf[1:] == node_leaf[:-1]
+    table['length'] = np.bincount(node_leaf[1:][inner], weights=np.linalg.norm(np.diff(nodes, axis=0)[inner], axis=1),
+                                  minlength=n_leaves) * cm_per_unit
+    node_starts = np.searchsorted(node_leaf, np.arange(n_leaves + 1))
+    table['width'] = extents[:, 1] * cm_per_unit
+    table['thickness'] = extents[:, 2] * cm_per_unit
+
+    triangles, triangle_leaf = [], []
+    for leaf in np.flatnonzero(counts >= 3):
+        leaf_local = sorted_local[starts[leaf]:starts[leaf] + counts[leaf]]
+        unrolled = _unroll(leaf_local, nodes[node_starts[leaf]:node_starts[leaf + 1]])
+        try:
+            hull_area = ConvexHull(leaf_local[:, :2]).volume
+            simplices = Delaunay(unrolled[:, :2]).simplices
+            unrolled_area = ConvexHull(unrolled[:, :2]).volume
+        except Exception:
+            # Collinear points (a flat hull has no area)
+            continue
+        table['projected_area'][leaf] = hull_area * cm_per_unit ** 2
+        cell = np.sqrt(unrolled_area / surface_cells)
+        cells = np.unique(np.floor(unrolled[:, :2] / cell), axis=0, return_inverse=True)[1].ravel()
+        offset = np.bincount(cells, weights=unrolled[:, 2]) / np.bincount(cells)
+        corners = np.column_stack([unrolled[:, :2], offset[cells]])[simplices]
+        edges = np.linalg.norm(corners - np.roll(corners, 1, axis=1), axis=2)
+        longest = edges.max(axis=1)
+        keep = longest <= edge_factor * np.median(edges)
+        triangles.append(corners[keep])
+        triangle_leaf.append(np.full(int(keep.sum()), leaf))
+    if triangles:
+        areas = _triangle_areas(np.concatenate(triangles))
+        table['surface_area'] = np.bincount(np.concatenate(triangle_leaf), weights=areas, minlength=n_leaves) * cm_per_unit ** 2
+    return table
@@ -0,0 +1,288 @@
+import argparse
+import csv
+import glob
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+
+import ply_io
+from mesh_volume import mesh_volume
+from reference_cube import point_spacing
+from stage_timer import StageTimer
+
+# Suffix of the mesh written for every cloud, e.g. Merge_01_pc_Plant_Filtered_mesh.ply
+OUTPUT_SUFFIX = "_mesh.ply"
+
+METHODS = ("poisson", "ball_pivoting")
+
+# Default meshing parameters. Lengths are in multiples of the point spacing of the cloud, so they
+# do not depend on the units of the scan.
+DEFAULT_PARAMS = {
+    'method': 'poisson',
+    'voxel_size': 0.0,              # Downsampling before meshing, in point spacings (0: none)
+    'normal_radius': 4.0,           # Normal estimation radius
+    'normal_max_nn': 30,
+    'orient_k': 15,                 # Neighbours of the consistent normal orientation
+    'depth': 9,                     # Octree depth of the Poisson reconstruction
+    'density_quantile': 0.02,       # Poisson vertices of the lowest densities removed (surface extrapolated far from the points)
+    'radii': (1.5, 3.0, 6.0),       # Ball radii of the ball pivoting
+    'hole_size': 20.0,              # Largest hole filled (0: none)
+}
+
+CSV_FIELDS = ["file", "output", "status", "points", "vertices", "faces", "watertight", "volume", "seconds"]
+
+
+def load_cloud(path, voxel_size=0.0):
+    """
+    Read a point cloud file into an Open3D cloud (points, colours and normals if any).
+
+    Args:
+        path (str): Path to the .ply point cloud.
+        voxel_size (float, optional): Voxel downsampling in point spacings, 0 for none. Defaults to 0.
+
+    Returns:
+        tuple: The o3d.geometry.PointCloud and its point spacing (after downsampling).
+    """
+    import open3d as o3d
+
+    vertices = ply_io.read_vertices(path)
+    points = np.asarray(ply_io.xyz(vertices), dtype=np.float64)
+    pcd = o3d.geometry.PointCloud(o3d.utility.Vector3dVector(points))
+    colors, normals = ply_io.colors(vertices), ply_io.normals(vertices)
+    if colors is not None:
+        pcd.colors = o3d.utility.Vector3dVector(np.asarray(colors, dtype=np.float64))
+    if normals is not None:
+        pcd.normals = o3d.utility.Vector3dVector(np.asarray(normals, dtype=np.float64))
+    spacing = point_spacing(points)
+    if voxel_size:
+        pcd = pcd.voxel_down_sample(voxel_size * spacing)
+        spacing = point_spacing(np.asarray(pcd.points))
+    return pcd, spacing
+
+
+def prepare_normals(pcd, spacing, params):
+    """Estimate the normals of a cloud (if it has none) and orient them consistently, as Poisson needs."""
+    import open3d as o3d
+
+    if not pcd.has_normals():
+        pcd.estimate_normals(search_param=o3d.geometry.KDTreeSearchParamHybrid(
+            radius=params['normal_radius'] * spacing, max_nn=params['normal_max_nn']))
+    pcd.orient_normals_consistent_tangent_plane(params['orient_k'])
+
+
+def poisson_mesh(pcd, depth=9, density_quantile=0.02):
+    """
+    Screened Poisson reconstruction, trimmed by density.
+
+    Poisson closes the surface everywhere, also far from the points (between the leaves, under
+    the pot rim). Those vertices are supported by few points: the vertices of the lowest
+    densities are removed, then the mesh is cropped to the bounding box of the cloud.
+
+    Args:
+        pcd (o3d.geometry.PointCloud): Cloud with oriented normals.
+        depth (int, optional): Octree depth, the resolution of the mesh. Defaults to 9.
+        density_quantile (float, optional): Share of the vertices removed, lowest densities first. Defaults to 0.02.
+
+    Returns:
+        o3d.geometry.TriangleMesh: The mesh.
+    """
+    import open3d as o3d
+
+    mesh, densities = o3d.geometry.TriangleMesh.create_from_point_cloud_poisson(pcd, depth=depth)
+    if density_quantile:
+        densities = np.asarray(densities)
+        mesh.remove_vertices_by_mask(densities < np.quantile(densities, density_quantile))
+    return mesh.crop(pcd.get_axis_aligned_bounding_box())
+
+
+def ball_pivoting_mesh(pcd, radii):
+    """Ball pivoting reconstruction with the given ball radii (in the units of the cloud)."""
+    import open3d as o3d
+
+    return o3d.geometry.TriangleMesh.create_from_point_cloud_ball_pivoting(pcd, o3d.utility.DoubleVector(list(radii)))
+
+
+def clean_mesh(mesh, hole_size=0.0):
+    """
+    Remove the degenerate and duplicated triangles and the non-manifold edges, then fill the
+    holes smaller than hole_size (units of the mesh), so the volume of the mesh is defined.
+
+    Returns:
+        o3d.geometry.TriangleMesh: The cleaned mesh.
+    """
+    import open3d as o3d
+
+    mesh.remove_degenerate_triangles()
+    mesh.remove_duplicated_triangles()
+    mesh.remove_duplicated_vertices()
+    mesh.remove_non_manifold_edges()
+    mesh.remove_unreferenced_vertices()
+    if hole_size:
+        mesh = o3d.t.geometry.TriangleMesh.from_legacy(mesh).fill_holes(hole_size=hole_size).to_legacy()
+    return mesh
+
+
+def write_mesh(path, mesh):
+    """Write an Open3D mesh as a binary PLY file (vertices, colours, faces) that Blender and ply_io read."""
+    colors = np.asarray(mesh.vertex_colors) if mesh.has_vertex_colors() else None
+    vertices = ply_io.points_to_vertices(np.asarray(mesh.vertices, dtype=np.float32), colors)
+    ply_io.write_ply(path, vertices, np.asarray(mesh.triangles, dtype=np.int32))
+
+
+def mesh_file(input_file, output_file, params=None, verbose=False):
+    """
+    Turn a point cloud into a mesh: normals, Poisson or ball pivoting reconstruction, trimming and hole filling.
+
+    Args:
+        input_file (str): Path to the .ply point cloud (e.g. a *_Plant_Filtered.ply of clustering_algo.py).
+        output_file (str): Path of the .ply mesh.
+        params (dict, optional): Meshing parameters overriding DEFAULT_PARAMS.
+        verbose (bool, optional): Print the time of each stage. Defaults to False.
+
+    Returns:
+        dict: One CSV row (see CSV_FIELDS) and the stage timings.
+    """
+    params = {**DEFAULT_PARAMS, **(params or {})}
+    if params['method'] not in METHODS:
+        raise ValueError(f"Unknown meshing method {params['method']!r}, expected {', '.join(METHODS)}")
+    timer = StageTimer(verbose=verbose)
+
+    with timer.stage("load") as stage:
+        pcd, spacing = load_cloud(input_file, params['voxel_size'])
+        stage["points"] = len(pcd.points)
+
+    with timer.stage("normals", len(pcd.points)):
+        prepare_normals(pcd, spacing, params)
+
+    with timer.stage(params['method'], len(pcd.points)):
+        if params['method'] == 'poisson':
+            mesh = poisson_mesh(pcd, params['depth'], params['density_quantile'])
+        else:
+            mesh = ball_pivoting_mesh(pcd, [radius * spacing for radius in params['radii']])
+
+    with timer.stage("clean"):
+        mesh = clean_mesh(mesh, params['hole_size'] * spacing)
+
+    with timer.stage("save") as stage:
+        write_mesh(output_file, mesh)
+        stage["points"] = len(mesh.vertices)
+
+    vertices, faces = np.asarray(mesh.vertices), np.asarray(mesh.triangles)
+    return {
+        'file': os.path.basename(input_file),
+        'output': output_file,
+        'status': 'done',
+        'points': len(pcd.points),
+        'vertices': len(vertices),
+        'faces': len(faces),
+        'watertight': bool(mesh.is_watertight()),
+        'volume': mesh_volume(vertices, faces) if len(faces) else 0.0,
+        'seconds': timer.total,
+        'stages': {record['stage']: record['seconds'] for record in timer.stages},
+    }
+
+
+def output_path_for(input_file, output_dir):
+    """Path of the mesh written for input_file, e.g. Merge_01_pc_Plant_Filtered.ply -> Merge_01_pc_Plant_Filtered_mesh.ply."""
+    stem = os.path.splitext(os.path.basename(input_file))[0]
+    return os.path.join(output_dir, stem + OUTPUT_SUFFIX)
+
+
+def _init_worker(threads):
+    # Runs first in every worker process, before Open3D is imported: its OpenMP pool is sized then
+    for name in ("OMP_NUM_THREADS", "OPENBLAS_NUM_THREADS", "MKL_NUM_THREADS"):
+        os.environ[name] = str(threads)
+    import open3d as o3d
+
+    o3d.utility.set_verbosity_level(o3d.utility.VerbosityLevel.Error)
+
+
+def _mesh_job(input_file, output_file, params):
+    # Runs in a worker process
+    try:
+        return mesh_file(input_file, output_file, params)
+    except Exception as error:
+        return {'file': os.path.basename(input_file), 'output': output_file, 'status': f'failed: {error}'}
+
+
+def run_batch(inputs, output_dir, params=None, workers=None, threads=None, force=False, output_csv=None):
+    """
+    Mesh many point clouds on a pool of worker processes, each one with a limited number of threads.
+
+    Poisson and the normal estimation use all the cores of the machine by default, and several
+    of them in parallel fight for them. Every worker is started (spawn) with OMP_NUM_THREADS set
+    to threads before Open3D is loaded.
+
+    Args:
+        inputs (list[str]): Paths of the .ply point clouds.
+        output_dir (str): Directory of the meshes (see output_path_for).
+        params (dict, optional): Meshing parameters overriding DEFAULT_PARAMS.
+        workers (int, optional): Number of worker processes. Defaults to the number of CPUs // threads.
+        threads (int, optional): Threads per worker. Defaults to the number of CPUs // workers.
+        force (bool, optional): Mesh clouds even if their mesh is up to date. Defaults to False.
+        output_csv (str, optional): CSV file of the results (see CSV_FIELDS).
+
+    Returns:
+        list[dict]: One result per input, in input order.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    cpus = os.cpu_count() or 1
+    if workers is None:
+        workers = max(1, cpus // (threads or 1))
+    threads = threads or max(1, cpus // workers)
+
+    results, jobs = {}, []
+    for input_file in inputs:
+        output_file = output_path_for(input_file, output_dir)
+        if not force and os.path.exists(output_file) and os.path.getmtime(output_file) >= os.path.getmtime(input_file):
+            results[input_file] = {'file': os.path.basename(input_file), 'output': output_file, 'status': 'skipped'}
+        else:
+            jobs.append((input_file, output_file))
+
+    print(f"{len(inputs)} files, {len(jobs)} to mesh, {len(inputs) - len(jobs)} up to date "
+          f"({workers} workers x {threads} threads).")
+    if jobs:
+        context = multiprocessing.get_context("spawn")
+        with ProcessPoolExecutor(max_workers=workers, mp_context=context, initializer=_init_worker,
+                                 initargs=(threads,)) as pool:
+            futures = {pool.submit(_mesh_job, input_file, output_file, params): input_file
+                       for input_file, output_file in jobs}
+            for done, future in enumerate(as_completed(futures), 1):
+                results[futures[future]] = result = future.result()
+                print(f"[{done}/{len(jobs)}] {result['file']}: {result['status']}")
+
+    ordered = [results[input_file] for input_file in inputs]
+    if output_csv:
+        with open(output_csv, "w", newline="") as file:
+            writer = csv.DictWriter(file, fieldnames=CSV_FIELDS, extrasaction="ignore")
+            writer.writeheader()
+            writer.writerows(ordered)
+        print(f"Results saved to {output_csv}")
+    return ordered
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Mesh point clouds (Poisson or ball pivoting, trimming, hole filling) into PLY meshes for get_measures.py.")
+    parser.add_argument("inputs", type=str, help="Point cloud (.ply), directory, or (quoted) glob pattern of point clouds.")
+    parser.add_argument("output_dir", type=str, help="Directory of the meshes (<cloud>_mesh.ply).")
+    parser.add_argument("--method", type=str, default=DEFAULT_PARAMS['method'], choices=METHODS, help="Reconstruction (default: poisson)")
+    parser.add_argument("--depth", type=int, default=DEFAULT_PARAMS['depth'], help="Poisson octree depth (default: 9)")
+    parser.add_argument("--density_quantile", type=float, default=DEFAULT_PARAMS['density_quantile'], help="Share of the Poisson vertices of lowest density removed (default: 0.02)")
+    parser.add_argument("--radii", type=float, nargs="+", default=list(DEFAULT_PARAMS['radii']), help="Ball pivoting radii, in point spacings (default: 1.5 3 6)")
+    parser.add_argument("--hole_size", type=float, default=DEFAULT_PARAMS['hole_size'], help="Largest hole filled, in point spacings, 0 for none (default: 20)")
+    parser.add_argument("--voxel_size", type=float, default=DEFAULT_PARAMS['voxel_size'], help="Downsample the clouds first, in point spacings (default: no downsampling)")
+    parser.add_argument("--workers", type=int, default=None, help="Number of worker processes (default: CPUs / threads)")
+    parser.add_argument("--threads", type=int, default=None, help="Threads per worker (default: CPUs / workers)")
+    parser.add_argument("--force", action="store_true", help="Mesh the clouds even if their mesh is up to date")
+    parser.add_argument("--csv", type=str, default=None, help="Save the results (faces, watertight, volume, time) to this CSV file")
+
+    args = parser.parse_args()
+    pattern = os.path.join(args.inputs, "*.ply") if os.path.isdir(args.inputs) else args.inputs
+    inputs = [path for path in sorted(glob.glob(pattern)) if not path.endswith(OUTPUT_SUFFIX)]
+    if not inputs:
+        raise SystemExit(f"No .ply file matches {args.inputs}")
+    params = {'method': args.method, 'depth': args.depth, 'density_quantile': args.density_quantile,
+              'radii': tuple(args.radii), 'hole_size': args.hole_size, 'voxel_size': args.voxel_size}
+    run_batch(inputs, args.output_dir, params, args.workers, args.threads, args.force, args.csv)
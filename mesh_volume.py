@@ -0,0 +1,220 @@
+import argparse
+import csv
+import glob
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+import ply_io
+from reference_cube import CUBE_VOLUME_CM3, box_extents, pick_cube_part
+from trait_store import TraitStore, record_rows
+
+CSV_FIELDS = ["file", "status", "parts", "cube_volume", "ratio", "plant_volume_raw", "plant_volume_cm3"]
+# Columns recorded in the trait store
+STORED_TRAITS = ["plant_volume_cm3", "plant_volume_raw", "cube_volume", "ratio"]
+
+
+def signed_volumes(vertices, faces):
+    """
+    Signed volume of the tetrahedron (origin, v0, v1, v2) of every triangle.
+
+    Their sum is the volume enclosed by a closed mesh, positive if the normals point outwards,
+    which is what bmesh calc_volume() computes.
+
+    Args:
+        vertices (np.ndarray): (n, 3) vertex coordinates.
+        faces (np.ndarray): (m, 3) triangle vertex indices.
+
+    Returns:
+        np.ndarray: (m,) signed volumes.
+    """
+    v0, v1, v2 = (np.asarray(vertices[faces[:, i]], dtype=np.float64) for i in range(3))
+    return np.einsum("ij,ij->i", v0, np.cross(v1, v2)) / 6
+
+
+def triangle_areas(vertices, faces):
+    """(m,) area of every triangle."""
+    v0, v1, v2 = (np.asarray(vertices[faces[:, i]], dtype=np.float64) for i in range(3))
+    return np.linalg.norm(np.cross(v1 - v0, v2 - v0), axis=1) / 2
+
+
+def mesh_volume(vertices, faces):
+    """Volume enclosed by a mesh, like bmesh calc_volume(signed=False)."""
+    return abs(float(signed_volumes(vertices, faces).sum()))
+
+
+def surface_area(vertices, faces):
+    """Surface area of a mesh."""
+    return float(triangle_areas(vertices, faces).sum())
+
+
+def union_find(n, a, b):
+    """
+    Vectorized union-find: merge the sets of a[i] and b[i] for every i.
+
+    Each round hooks every root onto the smallest root it is linked to (np.minimum.at), then
+    compresses the paths by pointer jumping until every element points to its root.
+
+    Args:
+        n (int): Number of elements.
+        a (np.ndarray): (k,) first element of every link.
+        b (np.ndarray): (k,) second element of every link.
+
+    Returns:
+        np.ndarray: (n,) root of every element, the smallest element of its set.
+    """
+    parent = np.arange(n)
+    while True:
+        root_a, root_b = parent[a], parent[b]
+        apart = root_a != root_b
+        if not apart.any():
+            return parent
+        root_a, root_b = root_a[apart], root_b[apart]
+        np.minimum.at(parent, np.maximum(root_a, root_b), np.minimum(root_a, root_b))
+        while True:
+            grand_parent = parent[parent]
+            if np.array_equal(grand_parent, parent):
+                break
+            parent = grand_parent
+
+
+def connected_components(n_vertices, faces):
+    """
+    Split a mesh in loose parts, like Blender's Separate by Loose Parts.
+
+    Args:
+        n_vertices (int): Number of vertices.
+        faces (np.ndarray): (m, 3) triangle vertex indices.
+
+    Returns:
+        tuple[int, np.ndarray]: Number of parts and (n_vertices,) part of every vertex.
+                                Vertices used by no face get -1.
+    """
+    roots = union_find(n_vertices, np.concatenate([faces[:, 0], faces[:, 1]]), np.concatenate([faces[:, 1], faces[:, 2]]))
+    used = np.zeros(n_vertices, dtype=bool)
+    used[faces.ravel()] = True
+    labels = np.full(n_vertices, -1, dtype=np.int64)
+    unique_roots, labels[used] = np.unique(roots[used], return_inverse=True)
+    return len(unique_roots), labels
+
+
+def component_measures(vertices, faces, min_vertices=100, components=None):
+    """
+    Volume, area and size of every loose part of a mesh.
+
+    Args:
+        vertices (np.ndarray): (n, 3) vertex coordinates.
+        faces (np.ndarray): (m, 3) triangle vertex indices.
+        min_vertices (int, optional): Box extents are only computed for parts having at least
+                                      this many vertices (the cube candidates). Defaults to 100.
+        components (tuple[int, np.ndarray], optional): Result of connected_components, when the
+                                                        caller already has it.
+
+    Returns:
+        list[dict]: One dict per part with "volume", "area", "vertices" and "extents" (see reference_cube.box_extents).
+    """
+    n_parts, labels = connected_components(len(vertices), faces) if components is None else components
+    face_part = labels[faces[:, 0]]
+    volumes = np.abs(np.bincount(face_part, weights=signed_volumes(vertices, faces), minlength=n_parts))
+    areas = np.bincount(face_part, weights=triangle_areas(vertices, faces), minlength=n_parts)
+    counts = np.bincount(labels[labels >= 0], minlength=n_parts)
+
+    # Vertices grouped by part, for the extents of the big parts
+    order = np.argsort(labels, kind="stable")
+    starts = np.searchsorted(labels[order], np.arange(n_parts + 1))
+    parts = []
+    for part in range(n_parts):
+        extents = np.zeros(3)
+        if counts[part] >= min_vertices:
+            extents = box_extents(np.asarray(vertices[order[starts[part]:starts[part + 1]]], dtype=np.float64))
+        parts.append({"volume": float(volumes[part]), "area": float(areas[part]),
+                      "vertices": int(counts[part]), "extents": extents})
+    return parts
+
+
+def plant_volume(path):
+    """
+    Cube-calibrated plant volume of a PLY mesh, without Blender.
+
+    Same computation as batch_volume.plant_volume (and the "Get plant volume" operator): the
+    loose parts are found with a union-find on the triangles, the cube is the smallest cube-like
+    part, and the plant volume is the sum of the other parts times CUBE_VOLUME_CM3 / cube volume.
+
+    Args:
+        path (str): Path to the .ply mesh (plant and reference cube).
+
+    Returns:
+        dict: One CSV row (see CSV_FIELDS).
+    """
+    vertices, faces = ply_io.read_ply(path)
+    row = {"file": os.path.basename(path)}
+    if faces is None or len(faces) == 0:
+        row["status"] = "no faces"
+        return row
+    parts = component_measures(ply_io.xyz(vertices), np.asarray(faces, dtype=np.int64))
+    row["parts"] = len(parts)
+
+    cube = pick_cube_part(parts)
+    if cube is None:
+        row["status"] = "no cube found"
+        return row
+
+    ratio = CUBE_VOLUME_CM3 / parts[cube]["volume"]
+    plant_raw = sum(part["volume"] for i, part in enumerate(parts) if i != cube)
+    row.update({
+        "status": "done" if len(parts) == 2 else f"done, plant in {len(parts) - 1} parts",
+        "cube_volume": parts[cube]["volume"],
+        "ratio": ratio,
+        "plant_volume_raw": plant_raw,
+        "plant_volume_cm3": plant_raw * ratio,
+    })
+    return row
+
+
+def _volume_job(path):
+    # Runs in a worker process
+    try:
+        return plant_volume(path)
+    except Exception as error:
+        return {"file": os.path.basename(path), "status": f"failed: {error}"}
+
+
+def run_batch(folder, output_csv, workers=None, store=None, date=None):
+    """
+    Compute the plant volume of every PLY mesh of folder on a process pool and save them to a CSV file.
+
+    Args:
+        folder (str): Folder of the .ply meshes.
+        output_csv (str): Path of the CSV file of the results.
+        workers (int, optional): Number of worker processes. Defaults to the number of CPUs.
+        store (str, optional): SQLite trait store the volumes are also recorded in (see trait_store.py).
+        date (str, optional): Date of the scan session recorded in the store. Defaults to the date in the path of the files.
+
+    Returns:
+        list[dict]: The rows of the CSV file, sorted by file name.
+    """
+    files = sorted(glob.glob(os.path.join(folder, "*.ply")))
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        rows = list(pool.map(_volume_job, files))
+    with open(output_csv, "w", newline="") as file:
+        writer = csv.DictWriter(file, fieldnames=CSV_FIELDS)
+        writer.writeheader()
+        writer.writerows(rows)
+    print(f"{len(rows)} files measured, results saved to {output_csv}")
+    if store:
+        with TraitStore(store) as traits:
+            print(f"{record_rows(traits, rows, STORED_TRAITS, folder, date=date)} values recorded in {store}")
+    return rows
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Cube-calibrated plant volume of every PLY mesh of a folder, without Blender.")
+    parser.add_argument("folder", type=str, help="Folder of the .ply meshes.")
+    parser.add_argument("output_csv", type=str, help="Path of the CSV file of the results.")
+    parser.add_argument("--workers", type=int, default=None, help="Number of worker processes (default: number of CPUs)")
+    parser.add_argument("--store", type=str, default=None, help="SQLite trait store the volumes are also recorded in")
+    parser.add_argument("--date", type=str, default=None, help="Date of the scan session recorded with --store, YYYY-MM-DD (default: the date in the path of the scans)")
+
+    args = parser.parse_args()
+    run_batch(args.folder, args.output_csv, args.workers, args.store, args.date)
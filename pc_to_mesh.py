@@ -2,11 +2,12 @@ from sklearn.cluster import DBSCAN
 import numpy as np
 import open3d as o3d
 import pyvista as pv
+import ply_io
 
 # Charger le fichier PLY
 ply_file = r'filtered_plants.ply'
-pcd_pv = pv.read(ply_file)
-points = np.array(pcd_pv.points)
+points = ply_io.xyz(ply_io.read_vertices(ply_file))
+pcd_pv = pv.PolyData(np.asarray(points, dtype=np.float32))
 
 # Appliquer DBSCAN avec les param'e8tres ajust'e9s
 dbscan = DBSCAN(eps=0.75, min_samples=20).fit(points)
@@ -0,0 +1,414 @@
+import argparse
+import csv
+import hashlib
+import json
+import os
+import shutil
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+
+import ply_io
+from feature_cache import file_hash
+from trait_store import MERGED, TraitStore, parse_scan_name, split_scan_name
+
+# Directory of the stage outputs: <cache>/<stage>/<key>/, see stage_key
+DEFAULT_CACHE = "pipeline_cache"
+
+# Name of the JSON summary written in every stage directory; its presence marks a complete output
+RESULT_FILE = "result.json"
+
+# Traits of the measure and volume stages recorded in the trait store and in the summary CSV
+TRAITS = ["leaf_count", "leaf_length_max_cm", "leaf_length_mean_cm", "leaf_area_total_cm2", "leaf_surface_total_cm2",
+          "plant_height_cm", "plant_volume_voxel_cm3", "plant_volume_alpha_cm3", "plant_volume_hull_cm3"]
+
+# Stages run by default, with everything upstream of them
+DEFAULT_TARGETS = ("measure", "volume")
+
+
+# ------ Stages
+# Every stage reads the main files of its inputs (paths by input name) and writes its own main
+# file in output_dir. The returned dict is saved as the result of the stage (JSON).
+
+
+def merge_stage(inputs, params, output_dir):
+    # Only this stage needs Open3D
+    from align_merge import register_pair
+
+    output_file = os.path.join(output_dir, "merged.ply")
+    result = register_pair(inputs["scan_0"], inputs["scan_8"], output_file, params)
+    return {key: result[key] for key in ("transformation", "fitness", "inlier_rmse", "prior", "ransac_fitness")}
+
+
+def calibration_stage(inputs, params, output_dir):
+    from calibration import calibrate_cloud
+
+    vertices = ply_io.read_vertices(inputs["merge"])
+    colors = ply_io.colors(vertices)
+    calibration = calibrate_cloud(ply_io.xyz(vertices), colors, params["trim"]) if colors is not None else None
+    with open(os.path.join(output_dir, "calibration.json"), "w") as file:
+        json.dump(calibration, file, indent=2)
+    if calibration is None:
+        return {"found": False}
+    return {"found": True, "cm_per_unit": calibration["cm_per_unit"], "stick": "stick_axis" in calibration}
+
+
+def pot_removal_stage(inputs, params, output_dir):
+    from clustering_algo import main as remove_pot
+
+    result = remove_pot(inputs["merge"], os.path.join(output_dir, "plant.ply"), params["eps"], params["min_samples"],
+                        visualize=False, verbose=False, engine=params["engine"], prefilter=params["prefilter"])
+    return {key: result[key] for key in ("points", "kept", "prefiltered", "clusters", "selected")}
+
+
+def color_filter_stage(inputs, params, output_dir):
+    # Same filter as PC_ColorFilter.PY: drop the points close to one colour (red by default)
+    vertices = ply_io.read_vertices(inputs["pot_removal"])
+    colors = ply_io.colors(vertices)
+    if colors is None:
+        keep = np.ones(len(vertices), dtype=bool)
+    else:
+        keep = np.linalg.norm(colors - np.asarray(params["color"], dtype=np.float32), axis=1) > params["tolerance"]
+    ply_io.write_ply(os.path.join(output_dir, "filtered.ply"), vertices[keep])
+    return {"points": len(vertices), "kept": int(keep.sum())}
+
+
+def leaves_stage(inputs, params, output_dir):
+    from skeleton_graph import segment_leaves
+
+    points = ply_io.xyz(ply_io.read_vertices(inputs["color_filter"]))
+    calibration = _read_json(inputs["calibration"])
+    up = calibration.get("stick_axis") if calibration else None
+    leaf_labels, graph = segment_leaves(points, params["voxel_size"], params["min_spur"], params["closing"], up)
+    np.save(os.path.join(output_dir, "leaf_labels.npy"), leaf_labels)
+    return {"leaves": int(leaf_labels.max()) + 1 if len(leaf_labels) else 0,
+            "branches": len(graph["branch_length"]), "skeleton": len(graph["skeleton"])}
+
+
+def measure_stage(inputs, params, output_dir):
+    from skeleton_graph import LEAF_FIELDS, measure_leaves
+
+    calibration = _read_json(inputs["calibration"])
+    if calibration is None:
+        raise ValueError("no reference cube, the scan has no scale")
+    cm_per_unit = calibration["cm_per_unit"]
+    points = ply_io.xyz(ply_io.read_vertices(inputs["color_filter"]))
+    leaves = measure_leaves(points, np.load(inputs["leaves"]), cm_per_unit)
+    with open(os.path.join(output_dir, "leaves.csv"), "w", newline="") as file:
+        writer = csv.DictWriter(file, fieldnames=LEAF_FIELDS)
+        writer.writeheader()
+        writer.writerows(leaves)
+
+    lengths = [leaf["length_cm"] for leaf in leaves if "length_cm" in leaf]
+    up = np.asarray(calibration.get("stick_axis", (0.0, 0.0, 1.0)))
+    height = points @ up
+    return {"traits": {
+        "leaf_count": len(leaves),
+        "leaf_length_max_cm": max(lengths) if lengths else None,
+        "leaf_length_mean_cm": float(np.mean(lengths)) if lengths else None,
+        "leaf_area_total_cm2": sum(leaf.get("area_cm2", 0.0) for leaf in leaves),
+        "leaf_surface_total_cm2": sum(leaf.get("surface_area_cm2", 0.0) for leaf in leaves),
+        "plant_height_cm": float(np.ptp(height)) * cm_per_unit if len(points) else None,
+    }}
+
+
+def volume_stage(inputs, params, output_dir):
+    from pointcloud_volume import cloud_volumes
+
+    calibration = _read_json(inputs["calibration"])
+    if calibration is None:
+        raise ValueError("no reference cube, the scan has no scale")
+    vertices = ply_io.read_vertices(inputs["color_filter"])
+    result = cloud_volumes(ply_io.xyz(vertices), ply_io.colors(vertices), calibration, tuple(params["methods"]),
+                           params["voxel_size_cm"], params["alpha_cm"])
+    with open(os.path.join(output_dir, "volume.json"), "w") as file:
+        json.dump(result, file, indent=2)
+    return {"plant_points": result["plant_points"],
+            "traits": {name: value for name, value in result.items() if name.startswith("plant_volume_")}}
+
+
+def mesh_stage(inputs, params, output_dir):
+    from mesh_stage import mesh_file
+
+    result = mesh_file(inputs["color_filter"], os.path.join(output_dir, "mesh.ply"), params)
+    return {"mesh_faces": result["faces"], "watertight": result["watertight"]}
+
+
+# The stage graph, in a valid run order. inputs are the stages (or source files) read by the
+# stage, output its main file, params its defaults. Bump the version of a stage when its code
+# changes its output: its outputs and the ones of the stages after it are then recomputed.
+STAGES = {
+    "merge": {"run": merge_stage, "inputs": ("scan_0", "scan_8"), "output": "merged.ply", "version": 1,
+              # Registration parameters overriding align_merge.DEFAULT_PARAMS
+              "params": {}},
+    "calibration": {"run": calibration_stage, "inputs": ("merge",), "output": "calibration.json", "version": 1,
+                    "params": {"trim": 2.0}},
+    "pot_removal": {"run": pot_removal_stage, "inputs": ("merge",), "output": "plant.ply", "version": 1,
+                    "params": {"eps": 0.5, "min_samples": 20, "engine": "voxel", "prefilter": None}},
+    "color_filter": {"run": color_filter_stage, "inputs": ("pot_removal",), "output": "filtered.ply", "version": 1,
+                     "params": {"color": [1.0, 0.0, 0.0], "tolerance": 0.1}},
+    "leaves": {"run": leaves_stage, "inputs": ("color_filter", "calibration"), "output": "leaf_labels.npy",
+               "version": 1, "params": {"voxel_size": 2.1, "min_spur": None, "closing": 1}},
+    "measure": {"run": measure_stage, "inputs": ("color_filter", "leaves", "calibration"), "output": "leaves.csv",
+                "version": 2, "params": {}},
+    "volume": {"run": volume_stage, "inputs": ("color_filter", "calibration"), "output": "volume.json", "version": 1,
+               "params": {"methods": ["voxel", "alpha", "hull"], "voxel_size_cm": 0.2, "alpha_cm": 0.5}},
+    # Not a default target (Open3D, slow): --until mesh for get_measures.py
+    "mesh": {"run": mesh_stage, "inputs": ("color_filter",), "output": "mesh.ply", "version": 1,
+             "params": {"method": "poisson", "depth": 9, "density_quantile": 0.02, "hole_size": 20.0}},
+}
+
+
+def _read_json(path):
+    with open(path) as file:
+        return json.load(file)
+
+
+def stage_params(overrides=None):
+    """
+    Parameters of every stage: the defaults of STAGES updated with overrides.
+
+    Args:
+        overrides (dict[str, dict], optional): Stage name -> parameters, e.g. {"pot_removal": {"eps": 0.6}}.
+
+    Returns:
+        dict[str, dict]: Stage name -> parameters.
+    """
+    overrides = overrides or {}
+    unknown = set(overrides) - set(STAGES)
+    if unknown:
+        raise ValueError(f"Unknown stage(s): {', '.join(sorted(unknown))}")
+    return {name: {**stage["params"], **overrides.get(name, {})} for name, stage in STAGES.items()}
+
+
+def stage_key(name, params, input_keys):
+    """
+    Content address of the output of a stage: SHA-256 of the stage, its version, its parameters
+    and the keys of its inputs.
+
+    The key of a source file is the hash of its content, so the key of a stage changes when a
+    scan, a parameter or a stage version anywhere upstream changes, and only then.
+
+    Args:
+        name (str): Stage name.
+        params (dict): Parameters of the stage.
+        input_keys (dict[str, str]): Input name -> key of the input.
+
+    Returns:
+        str: Hexadecimal key.
+    """
+    record = {"stage": name, "version": STAGES[name]["version"], "params": params, "inputs": input_keys}
+    return hashlib.sha256(json.dumps(record, sort_keys=True).encode()).hexdigest()
+
+
+def needed_stages(targets, sources=()):
+    """
+    Stages to run to get the targets, in run order: the targets and everything upstream of them,
+    except the stages given as source files.
+    """
+    needed = set()
+    pending = list(targets)
+    while pending:
+        name = pending.pop()
+        if name in needed or name in sources or name not in STAGES:
+            continue
+        needed.add(name)
+        pending.extend(STAGES[name]["inputs"])
+    return [name for name in STAGES if name in needed]
+
+
+def run_stage(name, params, inputs, key, cache_dir):
+    """
+    Run one stage in a temporary directory, then move it to its place in the cache.
+
+    Returns:
+        dict: The result of the stage, with its run time in seconds.
+    """
+    output_dir = os.path.join(cache_dir, name, key)
+    temp_dir = f"{output_dir}.tmp{os.getpid()}"
+    shutil.rmtree(temp_dir, ignore_errors=True)
+    os.makedirs(temp_dir)
+    start = time.perf_counter()
+    try:
+        result = STAGES[name]["run"](inputs, params, temp_dir)
+        result["seconds"] = time.perf_counter() - start
+        with open(os.path.join(temp_dir, RESULT_FILE), "w") as file:
+            json.dump(result, file, indent=2)
+        # Another process may have produced the same output meanwhile: keep the first one
+        try:
+            os.rename(temp_dir, output_dir)
+        except OSError:
+            pass
+    finally:
+        shutil.rmtree(temp_dir, ignore_errors=True)
+    return result
+
+
+def run_scan(scan, params, cache_dir=DEFAULT_CACHE, targets=DEFAULT_TARGETS, force=()):
+    """
+    Run the stages of one scan, reusing the outputs already in the cache.
+
+    Args:
+        scan (dict): name and sources, source name -> file: scan_0 and scan_8 for a pair of raw
+                     scans, or the output of a stage to start from, e.g. {"merge": "Merge_01_pc.ply"}.
+        params (dict[str, dict]): Parameters of every stage (see stage_params).
+        cache_dir (str, optional): Directory of the stage outputs. Defaults to DEFAULT_CACHE.
+        targets (tuple[str], optional): Stages to get; the stages they depend on are run first.
+                                        Defaults to DEFAULT_TARGETS.
+        force (tuple[str], optional): Stages recomputed even if their output is cached.
+
+    Returns:
+        dict: name, status ("done" or "failed: ..."), and stages: stage name -> key, status
+              ("cached" or "run"), output (path of its main file) and result.
+    """
+    sources = scan["sources"]
+    keys = {name: file_hash(path) for name, path in sources.items()}
+    paths = dict(sources)
+    report = {"name": scan["name"], "status": "done", "stages": {}}
+    for name in needed_stages(targets, sources):
+        stage = STAGES[name]
+        try:
+            missing = [source for source in stage["inputs"] if source not in paths]
+            if missing:
+                raise ValueError(f"missing input {', '.join(missing)}")
+            key = stage_key(name, params[name], {source: keys[source] for source in stage["inputs"]})
+            output_dir = os.path.join(cache_dir, name, key)
+            result_file = os.path.join(output_dir, RESULT_FILE)
+            if os.path.exists(result_file) and name not in force:
+                status, result = "cached", _read_json(result_file)
+            else:
+                if os.path.exists(output_dir):
+                    shutil.rmtree(output_dir)
+                inputs = {source: paths[source] for source in stage["inputs"]}
+                status, result = "run", run_stage(name, params[name], inputs, key, cache_dir)
+        except Exception as error:
+            report["status"] = f"failed at {name}: {error}"
+            break
+        keys[name] = key
+        paths[name] = os.path.join(output_dir, stage["output"])
+        report["stages"][name] = {"key": key, "status": status, "output": paths[name], "result": result}
+    return report
+
+
+def find_scans(directory, merged=False):
+    """
+    List the scans of a directory.
+
+    Args:
+        directory (str): Directory of the scans.
+        merged (bool, optional): Take the merged clouds (Merge_<plant>_pc.ply, merge stage
+                                 skipped) instead of the 0°/-8° pairs. Defaults to False.
+
+    Returns:
+        list[dict]: One scan per plant, see run_scan.
+    """
+    if merged:
+        files = sorted(name for name in os.listdir(directory) if name.startswith("Merge_") and name.endswith("_pc.ply"))
+        return [{"name": split_scan_name(name)[0], "sources": {"merge": os.path.join(directory, name)}}
+                for name in files]
+    from align_merge import find_pairs
+
+    return [{"name": name, "sources": {"scan_0": source, "scan_8": target}}
+            for name, source, target in find_pairs(directory)]
+
+
+def run_pipeline(scans, params, cache_dir=DEFAULT_CACHE, targets=DEFAULT_TARGETS, workers=None, force=(),
+                 output_csv=None, store=None, date=None):
+    """
+    Run the pipeline on many scans, one scan per worker process.
+
+    Args:
+        scans (list[dict]): The scans (see find_scans).
+        params (dict[str, dict]): Parameters of every stage (see stage_params).
+        cache_dir (str, optional): Directory of the stage outputs. Defaults to DEFAULT_CACHE.
+        targets (tuple[str], optional): Stages to get. Defaults to DEFAULT_TARGETS.
+        workers (int, optional): Number of worker processes. Defaults to the number of CPUs.
+        force (tuple[str], optional): Stages recomputed even if their output is cached.
+        output_csv (str, optional): CSV file of the traits, one row per scan.
+        store (str, optional): Trait store (SQLite file) the traits are recorded in.
+        date (str, optional): Date of the scan session recorded in the store. Defaults to the date in the
+                              path of the scan files.
+
+    Returns:
+        list[dict]: One report per scan (see run_scan), in the order of scans.
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    # Dates from the scan files, the merged scan is one plant at one date. Found before the run,
+    # to fail early on a scan without date
+    dates = {}
+    if store:
+        dates = {scan["name"]: parse_scan_name(next(iter(scan["sources"].values())), date)["date"] for scan in scans}
+    reports = {}
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = {pool.submit(run_scan, scan, params, cache_dir, targets, force): scan["name"] for scan in scans}
+        for future in as_completed(futures):
+            report = future.result()
+            reports[futures[future]] = report
+            stages = ", ".join(f"{name} {stage['status']}" for name, stage in report["stages"].items())
+            print(f"{report['name']}: {report['status']} ({stages})")
+    reports = [reports[scan["name"]] for scan in scans]
+
+    rows = []
+    for scan, report in zip(scans, reports):
+        traits = {}
+        for stage in report["stages"].values():
+            traits.update(stage["result"].get("traits", {}))
+        if traits:
+            rows.append({"scan": scan, "name": report["name"], **traits})
+    if output_csv:
+        with open(output_csv, "w", newline="") as file:
+            writer = csv.DictWriter(file, fieldnames=["name"] + TRAITS, extrasaction="ignore")
+            writer.writeheader()
+            writer.writerows(rows)
+    if store:
+        records = []
+        for row in rows:
+            source = next(iter(row["scan"]["sources"].values()))
+            records += [{"plant": row["name"], "date": dates[row["name"]], "angle": MERGED, "trait": trait,
+                         "value": float(row[trait]), "source": os.path.basename(source)}
+                        for trait in TRAITS if row.get(trait) is not None]
+        with TraitStore(store) as traits:
+            traits.record_many(records)
+    return reports
+
+
+def parse_overrides(settings):
+    """Parse stage.param=value settings of the command line, e.g. pot_removal.eps=0.6 (values in JSON)."""
+    overrides = {}
+    for setting in settings:
+        target, _, text = setting.partition("=")
+        name, _, param = target.partition(".")
+        if not param or not text:
+            raise ValueError(f"Expected stage.param=value, got {setting}")
+        try:
+            value = json.loads(text)
+        except json.JSONDecodeError:
+            value = text
+        overrides.setdefault(name, {})[param] = value
+    return overrides
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run the processing chain (merge, pot removal, colour filter, leaves, measures, volume) on a scan session, reusing the outputs already computed.")
+    parser.add_argument("directory", type=str, help="Directory of the scans (0°/-8° pairs, or merged clouds with --merged).")
+    parser.add_argument("--merged", action="store_true", help="Start from the merged clouds (Merge_<plant>_pc.ply) of the directory")
+    parser.add_argument("--cache", type=str, default=DEFAULT_CACHE, help=f"Directory of the stage outputs (default: {DEFAULT_CACHE})")
+    parser.add_argument("--set", dest="settings", action="append", default=[], metavar="STAGE.PARAM=VALUE", help="Change a parameter, e.g. --set pot_removal.eps=0.6 (repeatable)")
+    parser.add_argument("--until", nargs="+", default=list(DEFAULT_TARGETS), choices=list(STAGES), help="Stages to get (default: measure volume)")
+    parser.add_argument("--force", nargs="+", default=[], choices=list(STAGES), help="Recompute these stages even if cached")
+    parser.add_argument("--workers", type=int, default=None, help="Number of worker processes (default: number of CPUs)")
+    parser.add_argument("--csv", type=str, default=None, help="Save the traits to this CSV file, one row per scan")
+    parser.add_argument("--store", type=str, default=None, help="Record the traits in this trait store (SQLite file)")
+    parser.add_argument("--date", type=str, default=None, help="Date of the scan session recorded with --store, YYYY-MM-DD (default: the date in the path of the scans)")
+
+    args = parser.parse_args()
+    scans = find_scans(args.directory, args.merged)
+    if not scans:
+        raise SystemExit(f"No scan found in {args.directory}")
+    params = stage_params(parse_overrides(args.settings))
+    reports = run_pipeline(scans, params, args.cache, tuple(args.until), args.workers, tuple(args.force), args.csv, args.store, args.date)
+    runs = sum(stage["status"] == "run" for report in reports for stage in report["stages"].values())
+    cached = sum(stage["status"] == "cached" for report in reports for stage in report["stages"].values())
+    failed = sum(report["status"] != "done" for report in reports)
+    print(f"{len(reports)} scans: {runs} stage outputs computed, {cached} reused, {failed} failed.")
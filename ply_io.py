@@ -0,0 +1,386 @@
+import numpy as np
+
+# PLY scalar types and their NumPy equivalent (without byte order)
+PLY_TYPES = {
+    "char": "i1", "int8": "i1",
+    "uchar": "u1", "uint8": "u1",
+    "short": "i2", "int16": "i2",
+    "ushort": "u2", "uint16": "u2",
+    "int": "i4", "int32": "i4",
+    "uint": "u4", "uint32": "u4",
+    "float": "f4", "float32": "f4",
+    "double": "f8", "float64": "f8",
+}
+NUMPY_TYPES = {"i1": "char", "u1": "uchar", "i2": "short", "u2": "ushort",
+               "i4": "int", "u4": "uint", "f4": "float", "f8": "double"}
+BYTE_ORDER = {"binary_little_endian": "<", "binary_big_endian": ">", "ascii": "="}
+
+
+def read_header(path):
+    """
+    Parse the header of a PLY file.
+
+    Args:
+        path (str): Path to the .ply file.
+
+    Returns:
+        dict: "format" (ascii, binary_little_endian or binary_big_endian), "size" (bytes of the header)
+              and "elements", a list of dicts with "name", "count" and "properties". A property is a
+              tuple (name, type) for scalars and (name, "list", count type, item type) for lists.
+
+    Raises:
+        ValueError: If the file is not a PLY file.
+    """
+    with open(path, "rb") as file:
+        if file.readline().strip() != b"ply":
+            raise ValueError(f"{path} is not a PLY file")
+        header = {"format": None, "elements": [], "comments": []}
+        for line in file:
+            words = line.decode("ascii", errors="replace").split()
+            if not words:
+                continue
+            if words[0] == "format":
+                header["format"] = words[1]
+            elif words[0] == "comment":
+                header["comments"].append(" ".join(words[1:]))
+            elif words[0] == "element":
+                header["elements"].append({"name": words[1], "count": int(words[2]), "properties": []})
+            elif words[0] == "property":
+                if words[1] == "list":
+                    header["elements"][-1]["properties"].append((words[4], "list", words[2], words[3]))
+                else:
+                    header["elements"][-1]["properties"].append((words[2], words[1]))
+            elif words[0] == "end_header":
+                header["size"] = file.tell()
+                return header
+    raise ValueError(f"{path} has no end_header line")
+
+
+def element_dtype(element, byte_order="<"):
+    """
+    Return the NumPy structured dtype of an element made of scalar properties only.
+
+    Args:
+        element (dict): Element description from read_header.
+        byte_order (str, optional): "<" or ">". Defaults to "<".
+
+    Returns:
+        np.dtype: Packed structured dtype matching the binary layout of one element.
+
+    Raises:
+        ValueError: If the element has list properties.
+    """
+    fields = []
+    for prop in element["properties"]:
+        if prop[1] == "list":
+            raise ValueError(f"Element {element['name']} has list properties")
+        fields.append((prop[0], byte_order + PLY_TYPES[prop[1]]))
+    return np.dtype(fields)
+
+
+def _face_dtype(element, byte_order, corners=3):
+    # Binary layout of faces having `corners` vertices: count, then the vertex indices
+    name, _, count_type, item_type = element["properties"][0]
+    return np.dtype([("count", byte_order + PLY_TYPES[count_type]),
+                     (name, byte_order + PLY_TYPES[item_type], corners)])
+
+
+def read_ply(path, mmap=True):
+    """
+    Read the vertices, and the triangles if any, of a PLY file.
+
+    Binary files are memory-mapped: the vertex array is a view on the file and nothing is read
+    before it is used. ASCII files are parsed into memory.
+
+    Args:
+        path (str): Path to the .ply file.
+        mmap (bool, optional): Memory-map binary files instead of reading them. Defaults to True.
+
+    Returns:
+        tuple[np.ndarray, np.ndarray | None]: Structured vertex array (fields named after the PLY
+        properties, e.g. x, y, z, red, green, blue, nx, ny, nz) and the (m, 3) triangle vertex
+        indices, or None if the file has no face element.
+
+    Raises:
+        ValueError: If the file has no vertex element, or faces that are not all triangles.
+    """
+    header = read_header(path)
+    names = [element["name"] for element in header["elements"]]
+    if "vertex" not in names:
+        raise ValueError(f"{path} has no vertex element")
+    if header["format"] == "ascii":
+        return _read_ascii(path, header)
+
+    byte_order = BYTE_ORDER[header["format"]]
+    offset = header["size"]
+    vertices = faces = None
+    for element in header["elements"]:
+        if element["name"] == "vertex":
+            dtype = element_dtype(element, byte_order)
+            vertices = _map(path, dtype, offset, element["count"], mmap)
+            offset += dtype.itemsize * element["count"]
+        elif element["name"] == "face":
+            dtype = _face_dtype(element, byte_order)
+            data = _map(path, dtype, offset, element["count"], mmap)
+            if np.any(data["count"] != 3):
+                raise ValueError(f"{path}: only triangle faces are supported")
+            faces = data[element["properties"][0][0]]
+            offset += dtype.itemsize * element["count"]
+        elif element["count"]:
+            # Elements of unknown layout can only be skipped if they come last
+            break
+    return vertices, faces
+
+
+def read_vertices(path, mmap=True):
+    """Read the structured vertex array of a PLY file (see read_ply)."""
+    header = read_header(path)
+    if header["format"] != "ascii" and header["elements"] and header["elements"][0]["name"] == "vertex":
+        # Common case, no need to look at the faces
+        element = header["elements"][0]
+        dtype = element_dtype(element, BYTE_ORDER[header["format"]])
+        return _map(path, dtype, header["size"], element["count"], mmap)
+    return read_ply(path, mmap)[0]
+
+
+def vertex_layout(path):
+    """
+    Return the dtype, count and byte offset of the vertex block of a binary PLY file.
+
+    Raises:
+        ValueError: If the file is ASCII or has no vertex element, or an element of unknown size
+                    comes before the vertices.
+    """
+    header = read_header(path)
+    if header["format"] == "ascii":
+        raise ValueError(f"{path} is an ASCII PLY file, its vertices cannot be read in chunks")
+    byte_order = BYTE_ORDER[header["format"]]
+    offset = header["size"]
+    for element in header["elements"]:
+        if element["name"] == "vertex":
+            return element_dtype(element, byte_order), element["count"], offset
+        # Other elements must have a fixed size to be skipped
+        offset += element_dtype(element, byte_order).itemsize * element["count"]
+    raise ValueError(f"{path} has no vertex element")
+
+
+def iter_vertex_chunks(path, chunk_size=1_000_000):
+    """
+    Read the vertices of a binary PLY file chunk by chunk.
+
+    Every chunk is read with np.fromfile (offset and count), so only one chunk is in memory at
+    a time, whatever the size of the file.
+
+    Args:
+        path (str): Path to the .ply file.
+        chunk_size (int, optional): Vertices per chunk. Defaults to 1 000 000.
+
+    Yields:
+        np.ndarray: Structured vertex arrays of at most chunk_size vertices, in file order.
+    """
+    dtype, count, offset = vertex_layout(path)
+    for start in range(0, count, chunk_size):
+        yield np.fromfile(path, dtype=dtype, count=min(chunk_size, count - start), offset=offset + start * dtype.itemsize)
+
+
+def _map(path, dtype, offset, count, mmap):
+    if count == 0:
+        return np.zeros(0, dtype=dtype)
+    if mmap:
+        return np.memmap(path, dtype=dtype, mode="r", offset=offset, shape=(count,))
+    return np.fromfile(path, dtype=dtype, count=count, offset=offset)
+
+
+def _read_ascii(path, header):
+    vertices = faces = None
+    with open(path, "rb") as file:
+        file.seek(header["size"])
+        for element in header["elements"]:
+            lines = [file.readline() for _ in range(element["count"])]
+            if element["name"] == "vertex":
+                vertices = np.loadtxt(lines, dtype=element_dtype(element, "="), ndmin=1)
+            elif element["name"] == "face":
+                data = np.loadtxt(lines, dtype=np.int64, ndmin=2)
+                if data.shape[1] != 4 or np.any(data[:, 0] != 3):
+                    raise ValueError(f"{path}: only triangle faces are supported")
+                faces = data[:, 1:]
+    return vertices, faces
+
+
+def field_block(vertices, names):
+    """
+    Return the given fields of a structured array as a (n, len(names)) array.
+
+    If the fields have the same type and are stored next to each other (e.g. x, y, z), the result
+    is a strided view on the same memory (no copy, the file is not read for a memory-mapped array).
+    Otherwise the fields are copied.
+
+    Args:
+        vertices (np.ndarray): Structured vertex array.
+        names (tuple[str]): Field names, e.g. ("x", "y", "z").
+
+    Returns:
+        np.ndarray: (n, len(names)) array.
+
+    Raises:
+        KeyError: If one of the fields is missing.
+    """
+    fields = [vertices.dtype.fields[name] for name in names]
+    dtype, first = fields[0][0], fields[0][1]
+    contiguous = all(f[0] == dtype and f[1] == first + i * dtype.itemsize for i, f in enumerate(fields))
+    if contiguous and vertices.flags.c_contiguous:
+        return np.ndarray((len(vertices), len(names)), dtype=dtype, buffer=vertices, offset=first,
+                          strides=(vertices.dtype.itemsize, dtype.itemsize))
+    return np.stack([vertices[name] for name in names], axis=1)
+
+
+def has_fields(vertices, names):
+    """True if the structured array has all the given fields."""
+    return vertices.dtype.names is not None and all(name in vertices.dtype.names for name in names)
+
+
+def xyz(vertices):
+    """(n, 3) point coordinates of a vertex array, as a view when possible (see field_block)."""
+    return field_block(vertices, ("x", "y", "z"))
+
+
+def rgb(vertices):
+    """(n, 3) vertex colours as stored in the file (usually uint8), or None if there are none."""
+    if not has_fields(vertices, ("red", "green", "blue")):
+        return None
+    return field_block(vertices, ("red", "green", "blue"))
+
+
+def colors(vertices):
+    """(n, 3) vertex colours as floats in [0, 1] like Open3D, or None if there are none."""
+    values = rgb(vertices)
+    if values is None:
+        return None
+    if np.issubdtype(values.dtype, np.integer):
+        return values / np.float32(np.iinfo(values.dtype).max)
+    return values
+
+
+def normals(vertices):
+    """(n, 3) vertex normals, as a view when possible, or None if there are none."""
+    if not has_fields(vertices, ("nx", "ny", "nz")):
+        return None
+    return field_block(vertices, ("nx", "ny", "nz"))
+
+
+def points_to_vertices(points, colors=None, normals=None):
+    """
+    Build a structured vertex array from plain arrays.
+
+    Args:
+        points (np.ndarray): (n, 3) coordinates, written as float32 unless they are float64.
+        colors (np.ndarray, optional): (n, 3) colours, uint8 or floats in [0, 1].
+        normals (np.ndarray, optional): (n, 3) normals.
+
+    Returns:
+        np.ndarray: Structured array with x, y, z[, nx, ny, nz][, red, green, blue] fields.
+    """
+    point_type = "<f8" if points.dtype == np.float64 else "<f4"
+    fields = [("x", point_type), ("y", point_type), ("z", point_type)]
+    if normals is not None:
+        fields += [("nx", "<f4"), ("ny", "<f4"), ("nz", "<f4")]
+    if colors is not None:
+        fields += [("red", "u1"), ("green", "u1"), ("blue", "u1")]
+    vertices = np.empty(len(points), dtype=fields)
+    for i, name in enumerate("xyz"):
+        vertices[name] = points[:, i]
+    if normals is not None:
+        for i, name in enumerate(("nx", "ny", "nz")):
+            vertices[name] = normals[:, i]
+    if colors is not None:
+        if not np.issubdtype(colors.dtype, np.integer):
+            colors = np.clip(np.rint(colors * 255), 0, 255)
+        for i, name in enumerate(("red", "green", "blue")):
+            vertices[name] = colors[:, i]
+    return vertices
+
+
+def ply_header(vertex_dtype, vertex_count, face_count=None, comments=()):
+    """Return the header of a binary little endian PLY file (see write_ply)."""
+    lines = ["ply", "format binary_little_endian 1.0"]
+    lines += [f"comment {comment}" for comment in comments]
+    lines.append(f"element vertex {vertex_count}")
+    for name in vertex_dtype.names:
+        lines.append(f"property {NUMPY_TYPES[vertex_dtype.fields[name][0].str[1:]]} {name}")
+    if face_count is not None:
+        lines.append(f"element face {face_count}")
+        lines.append("property list uchar int vertex_indices")
+    lines.append("end_header")
+    return ("\n".join(lines) + "\n").encode("ascii")
+
+
+def write_ply(path, vertices, faces=None, comments=()):
+    """
+    Write a binary little endian PLY file from a structured vertex array.
+
+    A filtered subset of a file read with read_ply can be written back directly, e.g.
+    write_ply(output, vertices[mask]), keeping all its properties.
+
+    Args:
+        path (str): Path of the .ply file to write.
+        vertices (np.ndarray): Structured vertex array (see read_ply or points_to_vertices).
+        faces (np.ndarray, optional): (m, 3) triangle vertex indices.
+        comments (tuple[str], optional): Comment lines added to the header.
+    """
+    dtype = np.dtype([(name, vertices.dtype.fields[name][0].newbyteorder("<")) for name in vertices.dtype.names])
+    with open(path, "wb") as file:
+        file.write(ply_header(dtype, len(vertices), None if faces is None else len(faces), comments))
+        np.asarray(vertices, dtype=dtype).tofile(file)
+        if faces is not None:
+            data = np.empty(len(faces), dtype=[("count", "u1"), ("vertex_indices", "<i4", 3)])
+            data["count"] = 3
+            data["vertex_indices"] = faces
+            data.tofile(file)
+
+
+class PlyWriter:
+    """
+    Write a binary PLY file chunk by chunk, when the number of vertices is not known in advance.
+
+    The vertex count of the header is written with room for any count and set when the file is closed.
+
+        with PlyWriter(path, vertices.dtype) as writer:
+            for chunk in iter_vertex_chunks(input_path):
+                writer.write(chunk[mask_of(chunk)])
+    """
+
+    # Width of the vertex count in the header, padded with spaces
+    COUNT_WIDTH = 20
+
+    def __init__(self, path, vertex_dtype, comments=()):
+        self.dtype = np.dtype([(name, vertex_dtype.fields[name][0].newbyteorder("<")) for name in vertex_dtype.names])
+        self.count = 0
+        self.file = open(path, "wb")
+        header = ply_header(self.dtype, 0, comments=comments)
+        # Position of the count in the header, to patch it at the end
+        self.count_offset = header.index(b"element vertex 0") + len(b"element vertex ")
+        self.file.write(header.replace(b"element vertex 0", b"element vertex " + b"0".ljust(self.COUNT_WIDTH)))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def write(self, vertices):
+        """Append a structured vertex array with the fields of the writer."""
+        np.asarray(vertices, dtype=self.dtype).tofile(self.file)
+        self.count += len(vertices)
+
+    def close(self):
+        """Write the final vertex count in the header and close the file."""
+        if self.file.closed:
+            return
+        self.file.seek(self.count_offset)
+        self.file.write(str(self.count).ljust(self.COUNT_WIDTH).encode("ascii"))
+        self.file.close()
+
+
+def write_points(path, points, colors=None, normals=None):
+    """Write plain point, colour and normal arrays to a binary PLY file (see points_to_vertices)."""
+    write_ply(path, points_to_vertices(points, colors, normals))
@@ -0,0 +1,295 @@
+import argparse
+import csv
+import glob
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from scipy import ndimage
+from scipy.spatial import ConvexHull, Delaunay, QhullError
+
+import ply_io
+from calibration import calibrate_cloud
+from color_segmentation import class_mask
+from reference_cube import STICK_LENGTH_CM
+from trait_store import TraitStore, record_rows
+from voxel_grid import dense_boxes, sparse_voxelize, voxel_downsample
+
+# Volume estimators, see cloud_volumes
+METHODS = ("voxel", "alpha", "hull")
+
+# Default voxel size of the occupancy volume and alpha radius of the alpha shape, in cm so that
+# they do not depend on the units of the scan
+DEFAULT_VOXEL_CM = 0.2
+DEFAULT_ALPHA_CM = 0.5
+
+# The points within this many cube extents of the cube centre are the reference object, not the plant
+CUBE_MARGIN = 0.6
+
+CSV_FIELDS = ["file", "status", "points", "plant_points", "cm_per_unit", "plant_volume_voxel_cm3",
+              "plant_volume_alpha_cm3", "plant_volume_hull_cm3", "seconds"]
+# Columns recorded in the trait store
+STORED_TRAITS = ["plant_volume_voxel_cm3", "plant_volume_alpha_cm3", "plant_volume_hull_cm3"]
+
+
+def voxel_volume(points, voxel_size, closing=1):
+    """
+    Volume of the occupied voxels of a cloud, after closing the gaps of the scanned surfaces and
+    filling the enclosed cavities.
+
+    A scan only samples the surface of the plant: the binary closing joins the voxels of the
+    surface and the hole filling adds the inside of closed parts (stems, fruits, pot-free soil
+    clumps). The surface crosses the boundary voxels, which are counted as half full.
+    Every connected part is processed in its own box (see voxel_grid.dense_boxes).
+
+    Args:
+        points (np.ndarray): (n, 3) point coordinates.
+        voxel_size (float): Edge of the voxels, in the units of the points.
+        closing (int, optional): Iterations of the binary closing, 0 for none. Defaults to 1.
+
+    Returns:
+        float: Volume in units³.
+    """
+    if len(points) == 0:
+        return 0.0
+    coords, _, _ = sparse_voxelize(points, voxel_size)
+    filled = 0.0
+    for _, box, _ in dense_boxes(coords, padding=closing + 1):
+        if closing:
+            box = ndimage.binary_closing(box, iterations=closing)
+        box = ndimage.binary_fill_holes(box)
+        boundary = np.count_nonzero(box & ~ndimage.binary_erosion(box))
+        filled += np.count_nonzero(box) - 0.5 * boundary
+    return float(filled) * voxel_size ** 3
+
+
+def tetrahedra(points, simplices):
+    """
+    Volume and circumradius of tetrahedra.
+
+    Args:
+        points (np.ndarray): (n, 3) point coordinates.
+        simplices (np.ndarray): (m, 4) vertex indices of the tetrahedra.
+
+    Returns:
+        tuple[np.ndarray, np.ndarray]: (m,) volumes and (m,) circumradii (inf for flat tetrahedra).
+    """
+    a = points[simplices[:, 0]]
+    u, v, w = (points[simplices[:, i]] - a for i in (1, 2, 3))
+    cross_vw, cross_wu, cross_uv = np.cross(v, w), np.cross(w, u), np.cross(u, v)
+    determinant = np.einsum("ij,ij->i", u, cross_vw)
+    # Circumcentre relative to a: (|u|² v×w + |v|² w×u + |w|² u×v) / (2 u·(v×w))
+    numerator = ((u * u).sum(axis=1)[:, None] * cross_vw + (v * v).sum(axis=1)[:, None] * cross_wu
+                 + (w * w).sum(axis=1)[:, None] * cross_uv)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        radii = np.linalg.norm(numerator, axis=1) / np.abs(2 * determinant)
+    return np.abs(determinant) / 6, np.where(np.isfinite(radii), radii, np.inf)
+
+
+def alpha_volume(points, alpha):
+    """
+    Volume of the alpha shape of a cloud: the Delaunay tetrahedra whose circumscribed sphere is
+    smaller than alpha.
+
+    alpha is the size of the cavities that are filled: tetrahedra spanning larger empty
+    regions (between the leaves, or inside a part thicker than 2 alpha) are left out.
+
+    Args:
+        points (np.ndarray): (n, 3) point coordinates.
+        alpha (float): Largest circumradius of the kept tetrahedra, in the units of the points.
+
+    Returns:
+        float: Volume in units³.
+    """
+    points = np.asarray(points, dtype=np.float64)
+    if len(points) < 4:
+        return 0.0
+    try:
+        simplices = Delaunay(points).simplices
+    except QhullError:
+        # Flat or degenerate cloud
+        return 0.0
+    volumes, radii = tetrahedra(points, simplices)
+    return float(volumes[radii <= alpha].sum())
+
+
+def hull_volume(points):
+    """Volume of the convex hull of a cloud in units³ (0 for flat or tiny clouds)."""
+    points = np.asarray(points, dtype=np.float64)
+    if len(points) < 4:
+        return 0.0
+    try:
+        return float(ConvexHull(points).volume)
+    except QhullError:
+        return 0.0
+
+
+def reference_mask(points, calibration, colors=None, radius_factor=0.5):
+    """
+    Select the points of the reference object (cube and stick) from a calibration.
+
+    The cube is the box of the calibration grown by CUBE_MARGIN, the stick a cylinder of radius
+    radius_factor x cube edge below it along the stick axis (see calibration.find_stick). With
+    colours, the plant-coloured points of these regions are kept: leaves often touch the cube.
+
+    Args:
+        points (np.ndarray): (n, 3) point coordinates.
+        calibration (dict): Calibration of the scan (see calibration.calibrate_cube).
+        colors (np.ndarray, optional): (n, 3) RGB colours, uint8 or floats in [0, 1].
+        radius_factor (float, optional): Radius of the stick cylinder in cube edges. Defaults to 0.5.
+
+    Returns:
+        np.ndarray: (n,) boolean mask.
+    """
+    relative = np.asarray(points, dtype=np.float64) - calibration["cube_center"]
+    local = relative @ np.asarray(calibration["cube_axes"]).T
+    mask = np.all(np.abs(local) <= CUBE_MARGIN * np.asarray(calibration["cube_extents"]), axis=1)
+    if "stick_axis" in calibration:
+        down = -np.asarray(calibration["stick_axis"])
+        along = relative @ down
+        radial = np.linalg.norm(relative - along[:, None] * down, axis=1)
+        length = 1.2 * STICK_LENGTH_CM / calibration["cm_per_unit"]
+        mask |= (along > 0) & (along <= length) & (radial <= radius_factor * calibration["cube_edge"])
+    if colors is not None:
+        mask &= ~class_mask(colors, "plant")
+    return mask
+
+
+def cloud_volumes(points, colors=None, calibration=None, methods=METHODS, voxel_size_cm=DEFAULT_VOXEL_CM,
+                  alpha_cm=DEFAULT_ALPHA_CM):
+    """
+    Cube-calibrated plant volume of a point cloud (e.g. the output of clustering_algo.py), without meshing.
+
+    - voxel: occupied voxels after closing and hole filling (voxel_volume); thin leaves count
+      about half a voxel thick, so the voxel size bounds the error
+    - alpha: alpha shape of the voxel downsampled cloud (alpha_volume)
+    - hull: convex hull (hull_volume), an upper bound that includes the air between the leaves
+
+    Args:
+        points (np.ndarray): (n, 3) point coordinates.
+        colors (np.ndarray, optional): (n, 3) RGB colours, to find the cube when no calibration is given
+                                       and to keep the leaves touching the reference object.
+        calibration (dict, optional): Calibration of the scan (e.g. the calibration stage of pipeline.py).
+                                      Defaults to calibrate_cloud on this cloud.
+        methods (tuple[str], optional): Estimators to run. Defaults to METHODS.
+        voxel_size_cm (float, optional): Voxel size in cm. Defaults to DEFAULT_VOXEL_CM.
+        alpha_cm (float, optional): Alpha radius in cm. Defaults to DEFAULT_ALPHA_CM.
+
+    Returns:
+        dict: plant_points (the cube and stick left out), cm_per_unit and plant_volume_<method>_cm3.
+
+    Raises:
+        ValueError: If no calibration is given and the cube is not found in the cloud.
+    """
+    unknown = set(methods) - set(METHODS)
+    if unknown:
+        raise ValueError(f"Unknown volume method(s): {', '.join(sorted(unknown))}, expected {', '.join(METHODS)}")
+    points = np.asarray(points, dtype=np.float64)
+    if calibration is None:
+        calibration = calibrate_cloud(points, colors) if colors is not None else None
+        if calibration is None:
+            raise ValueError("no reference cube found, the cloud has no scale")
+    cm_per_unit = calibration["cm_per_unit"]
+    # A calibration without cube (a given scale) has no reference object to leave out
+    plant = points[~reference_mask(points, calibration, colors)] if "cube_center" in calibration else points
+    voxel_size = voxel_size_cm / cm_per_unit
+
+    result = {"plant_points": len(plant), "cm_per_unit": cm_per_unit}
+    # cm³ per unit³ from the cube edge (the cloud has no enclosed cube volume)
+    volume_ratio = cm_per_unit ** 3
+    if "voxel" in methods:
+        result["plant_volume_voxel_cm3"] = voxel_volume(plant, voxel_size) * volume_ratio
+    if "alpha" in methods:
+        # Delaunay on one point per voxel: its cost no longer depends on the scan density
+        down = voxel_downsample(plant, voxel_size)[0] if len(plant) else plant
+        result["plant_volume_alpha_cm3"] = alpha_volume(down, alpha_cm / cm_per_unit) * volume_ratio
+    if "hull" in methods:
+        result["plant_volume_hull_cm3"] = hull_volume(plant) * volume_ratio
+    return result
+
+
+def volume_file(path, methods=METHODS, voxel_size_cm=DEFAULT_VOXEL_CM, alpha_cm=DEFAULT_ALPHA_CM, cm_per_unit=None):
+    """
+    Plant volumes of one point cloud file, calibrated with the cube found in it.
+
+    Args:
+        path (str): Path to the .ply point cloud.
+        methods, voxel_size_cm, alpha_cm: See cloud_volumes.
+        cm_per_unit (float, optional): Scale used when the cube is not in the cloud (the cube and
+                                       stick are then not removed). Defaults to None (no volume).
+
+    Returns:
+        dict: One CSV row (see CSV_FIELDS).
+    """
+    start = time.perf_counter()
+    vertices = ply_io.read_vertices(path)
+    points, colors = ply_io.xyz(vertices), ply_io.colors(vertices)
+    row = {"file": os.path.basename(path), "points": len(points)}
+    calibration = calibrate_cloud(points, colors) if colors is not None else None
+    if calibration is None and cm_per_unit:
+        calibration = {"cm_per_unit": cm_per_unit}
+    if calibration is None:
+        row["status"] = "no cube found"
+        return row
+    row.update(cloud_volumes(points, colors, calibration, methods, voxel_size_cm, alpha_cm))
+    row["status"] = "done"
+    row["seconds"] = time.perf_counter() - start
+    return row
+
+
+def _volume_job(path, methods, voxel_size_cm, alpha_cm, cm_per_unit):
+    # Runs in a worker process
+    try:
+        return volume_file(path, methods, voxel_size_cm, alpha_cm, cm_per_unit)
+    except Exception as error:
+        return {"file": os.path.basename(path), "status": f"failed: {error}"}
+
+
+def run_batch(files, output_csv, methods=METHODS, voxel_size_cm=DEFAULT_VOXEL_CM, alpha_cm=DEFAULT_ALPHA_CM,
+              cm_per_unit=None, workers=None, store=None, date=None):
+    """
+    Compute the plant volumes of many point clouds on a process pool and save them to a CSV file.
+
+    Args:
+        files (list[str]): Paths of the .ply point clouds.
+        output_csv (str): Path of the CSV file of the results.
+        methods, voxel_size_cm, alpha_cm, cm_per_unit: See volume_file.
+        workers (int, optional): Number of worker processes. Defaults to the number of CPUs.
+        store (str, optional): SQLite trait store the volumes are also recorded in (see trait_store.py).
+        date (str, optional): Date of the scan session recorded in the store. Defaults to the date in the path of the files.
+
+    Returns:
+        list[dict]: The rows of the CSV file, in the order of files.
+    """
+    n = len(files)
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        rows = list(pool.map(_volume_job, files, [methods] * n, [voxel_size_cm] * n, [alpha_cm] * n, [cm_per_unit] * n))
+    with open(output_csv, "w", newline="") as file:
+        writer = csv.DictWriter(file, fieldnames=CSV_FIELDS)
+        writer.writeheader()
+        writer.writerows(rows)
+    print(f"{len(rows)} files measured, results saved to {output_csv}")
+    if store and files:
+        with TraitStore(store) as traits:
+            print(f"{record_rows(traits, rows, STORED_TRAITS, os.path.dirname(files[0]), date=date)} values recorded in {store}")
+    return rows
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Cube-calibrated plant volume of point clouds (voxels, alpha shape, convex hull), without meshing.")
+    parser.add_argument("inputs", nargs="+", help="Point clouds (.ply), or folders of point clouds.")
+    parser.add_argument("output_csv", type=str, help="Path of the CSV file of the results.")
+    parser.add_argument("--methods", nargs="+", default=list(METHODS), choices=METHODS, help="Volume estimators (default: all)")
+    parser.add_argument("--voxel_size", type=float, default=DEFAULT_VOXEL_CM, help=f"Voxel size in cm (default: {DEFAULT_VOXEL_CM})")
+    parser.add_argument("--alpha", type=float, default=DEFAULT_ALPHA_CM, help=f"Alpha radius in cm (default: {DEFAULT_ALPHA_CM})")
+    parser.add_argument("--scale", type=float, default=None, help="cm per unit of the clouds without cube (default: no volume for them)")
+    parser.add_argument("--workers", type=int, default=None, help="Number of worker processes (default: number of CPUs)")
+    parser.add_argument("--store", type=str, default=None, help="SQLite trait store the volumes are also recorded in")
+    parser.add_argument("--date", type=str, default=None, help="Date of the scan session recorded with --store, YYYY-MM-DD (default: the date in the path of the scans)")
+
+    args = parser.parse_args()
+    files = []
+    for item in args.inputs:
+        files += sorted(glob.glob(os.path.join(item, "*.ply"))) if os.path.isdir(item) else [item]
+    run_batch(files, args.output_csv, tuple(args.methods), args.voxel_size, args.alpha, args.scale, args.workers, args.store, args.date)
@@ -0,0 +1,261 @@
+import numpy as np
+from scipy.spatial import ConvexHull, cKDTree
+
+from color_segmentation import class_mask
+from voxel_dbscan import voxel_dbscan
+
+# Reference object: 3D printed blue cube (1.5 x 1.5 x 1.5 cm) on a 8.5 cm stick
+CUBE_EDGE_CM = 1.5
+STICK_LENGTH_CM = 8.5
+# Theoretical volume (cm³) of the cube part of a scanned mesh, used by the "Get plant volume"
+# operator to calibrate the scans. The stem is cut to its limit before scanning, so the cube part
+# is the cube (1.5³ = 3.375 cm³) and the stub of stick left under it (0.39 cm³).
+CUBE_VOLUME_CM3 = 3.765
+
+
+def point_spacing(points, sample=2000, seed=0):
+    """Median distance between a point and its nearest neighbour, estimated on a sample of the points."""
+    rng = np.random.default_rng(seed)
+    sample_points = points[rng.choice(len(points), min(sample, len(points)), replace=False)]
+    distances, _ = cKDTree(points).query(sample_points, k=2)
+    return float(np.median(distances[:, 1]))
+
+
+def segment_cube(points, colors, min_points=50, spacing_factor=4.0, mask=None):
+    """
+    Find the points of the reference cube in a scan.
+
+    The points of the cube colour are clustered with DBSCAN (eps is a few times the point
+    spacing, so the result does not depend on the units of the scan) and the largest compact
+    cluster is kept, which removes isolated blue points on the plant or the background.
+
+    Args:
+        points (np.ndarray): (n, 3) point coordinates.
+        colors (np.ndarray): (n, 3) RGB colours, uint8 or floats in [0, 1].
+        min_points (int, optional): Minimal number of points of the cube. Defaults to 50.
+        spacing_factor (float, optional): DBSCAN eps in multiples of the point spacing. Defaults to 4.
+        mask (np.ndarray, optional): Precomputed (n,) colour mask. Defaults to the cube class of the
+                                     colour lookup table (see color_segmentation.py), one gather per point.
+
+    Returns:
+        np.ndarray | None: Indices of the cube points, or None if no cube was found.
+    """
+    candidates = np.flatnonzero(class_mask(colors, "cube") if mask is None else mask)
+    if len(candidates) < min_points:
+        return None
+    candidate_points = np.asarray(points[candidates], dtype=np.float64)
+    eps = spacing_factor * point_spacing(candidate_points)
+    labels = voxel_dbscan(candidate_points, eps=eps, min_samples=5)
+    if labels.max() < 0:
+        return None
+    sizes = np.bincount(labels[labels >= 0])
+    best = int(np.argmax(sizes))
+    if sizes[best] < min_points:
+        return None
+    return candidates[labels == best]
+
+
+def rotation_between(a, b):
+    """
+    Return the rotation matrix turning the direction a onto the direction b (Rodrigues formula).
+
+    Args:
+        a (np.ndarray): (3,) vector.
+        b (np.ndarray): (3,) vector.
+
+    Returns:
+        np.ndarray: (3, 3) rotation matrix.
+    """
+    a = a / np.linalg.norm(a)
+    b = b / np.linalg.norm(b)
+    axis = np.cross(a, b)
+    sin = np.linalg.norm(axis)
+    cos = np.dot(a, b)
+    if sin < 1e-12:
+        if cos > 0:
+            return np.eye(3)
+        # Half turn around any axis perpendicular to a
+        perpendicular = np.cross(a, [1.0, 0.0, 0.0] if abs(a[0]) < 0.9 else [0.0, 1.0, 0.0])
+        return rotation_about(perpendicular, np.pi)
+    return rotation_about(axis, np.arctan2(sin, cos))
+
+
+def rotation_about(axis, angle):
+    """Return the (3, 3) matrix of the rotation by angle (radians) about axis."""
+    axis = axis / np.linalg.norm(axis)
+    cross = np.array([[0, -axis[2], axis[1]], [axis[2], 0, -axis[0]], [-axis[1], axis[0], 0]])
+    return np.eye(3) + np.sin(angle) * cross + (1 - np.cos(angle)) * cross @ cross
+
+
+def cube_prior_candidates(source_cube, source_center, target_cube, target_center, steps=36):
+    """
+    Candidate rigid transformations of the source scan onto the target scan, from their cubes.
+
+    The cube centroids give the translation, and the direction from the centre of the scan to
+    the cube gives two of the three rotation angles. The cube is symmetric, so the rotation
+    about that direction is left open and sampled every 360 / steps degrees; the caller keeps
+    the candidate that fits the whole scans best.
+
+    Args:
+        source_cube (np.ndarray): (m, 3) cube points of the source scan.
+        source_center (np.ndarray): (3,) centre of the source scan.
+        target_cube (np.ndarray): (k, 3) cube points of the target scan.
+        target_center (np.ndarray): (3,) centre of the target scan.
+        steps (int, optional): Number of sampled angles. Defaults to 36.
+
+    Returns:
+        list[np.ndarray]: (4, 4) transformations.
+    """
+    source_anchor = source_cube.mean(axis=0)
+    target_anchor = target_cube.mean(axis=0)
+    direction = target_anchor - target_center
+    align = rotation_between(source_anchor - source_center, direction)
+    candidates = []
+    for angle in np.linspace(0, 2 * np.pi, steps, endpoint=False):
+        rotation = rotation_about(direction, angle) @ align
+        transformation = np.eye(4)
+        transformation[:3, :3] = rotation
+        transformation[:3, 3] = target_anchor - rotation @ source_anchor
+        candidates.append(transformation)
+    return candidates
+
+
+def oriented_box(points, trim=0.0):
+    """
+    Fit an oriented bounding box to a set of points, along its principal axes.
+
+    Args:
+        points (np.ndarray): (n, 3) array of points.
+        trim (float, optional): Percentage of the points ignored at each end of every axis, so a
+                                few stray points do not inflate the box. Defaults to 0 (exact box).
+
+    Returns:
+        tuple[np.ndarray, np.ndarray, np.ndarray]: (3,) centre of the box, (3, 3) axes (one per
+        column) and (3,) extents along them, largest first.
+    """
+    points = np.asarray(points, dtype=np.float64)
+    mean = points.mean(axis=0)
+    centered = points - mean
+    _, axes = np.linalg.eigh(centered.T @ centered)
+    projected = centered @ axes
+    low, high = np.percentile(projected, [trim, 100 - trim], axis=0) if trim else (projected.min(axis=0), projected.max(axis=0))
+    order = np.argsort(high - low)[::-1]
+    center = mean + axes @ ((low + high) / 2)
+    return center, axes[:, order], (high - low)[order]
+
+
+def minimum_box(points, trim=0.0, max_normals=512):
+    """
+    Fit the (nearly) smallest oriented bounding box to a set of points.
+
+    The principal axes of a cube are undefined (its covariance is isotropic), so the axes of
+    oriented_box are arbitrary on the reference cube. Here the first axis is taken among the
+    face normals of the convex hull and the two others from the minimum-area rectangle of the
+    points projected along it (rotating calipers); the smallest box is kept. This is exact
+    when a face of the optimal box lies on a face of the hull, which is the case for a cube.
+
+    Args:
+        points (np.ndarray): (n, 3) array of points.
+        trim (float, optional): Percentage of the points ignored at each end of every axis of
+                                the final box. Defaults to 0.
+        max_normals (int, optional): Maximal number of hull normals tried, the largest faces
+                                     first. Defaults to 512.
+
+    Returns:
+        tuple[np.ndarray, np.ndarray, np.ndarray]: Like oriented_box, (3,) centre, (3, 3) axes
+        (one per column) and (3,) extents, largest first.
+    """
+    points = np.asarray(points, dtype=np.float64)
+    try:
+        hull = ConvexHull(points)
+    except Exception:
+        return oriented_box(points, trim)
+    hull_points = points[hull.vertices]
+
+    # Distinct normals (up to the sign), the largest faces first
+    normals = hull.equations[:, :3] * np.where(hull.equations[:, :1] < 0, -1, 1)
+    corners = points[hull.simplices]
+    areas = np.linalg.norm(np.cross(corners[:, 1] - corners[:, 0], corners[:, 2] - corners[:, 0]), axis=1)
+    _, first = np.unique(np.round(normals, 2), axis=0, return_index=True)
+    first = first[np.argsort(areas[first])[::-1]][:max_normals]
+
+    best_volume, best_axes = np.inf, None
+    for normal in normals[first]:
+        # Orthonormal basis (u, v) of the plane perpendicular to the normal
+        u = np.cross(normal, [1.0, 0.0, 0.0] if abs(normal[0]) < 0.9 else [0.0, 1.0, 0.0])
+        u /= np.linalg.norm(u)
+        v = np.cross(normal, u)
+        height = np.ptp(hull_points @ normal)
+        flat = np.stack([hull_points @ u, hull_points @ v], axis=1)
+        try:
+            ring = flat[ConvexHull(flat).vertices]
+        except Exception:
+            continue
+        # One rectangle per hull edge direction
+        edges = np.roll(ring, -1, axis=0) - ring
+        angles = np.arctan2(edges[:, 1], edges[:, 0])
+        cos, sin = np.cos(angles), np.sin(angles)
+        along = ring @ np.stack([cos, sin])
+        across = ring @ np.stack([-sin, cos])
+        rectangle_areas = np.ptp(along, axis=0) * np.ptp(across, axis=0)
+        best = int(np.argmin(rectangle_areas))
+        if rectangle_areas[best] * height < best_volume:
+            best_volume = rectangle_areas[best] * height
+            best_axes = np.stack([normal, cos[best] * u + sin[best] * v, -sin[best] * u + cos[best] * v], axis=1)
+    if best_axes is None:
+        return oriented_box(points, trim)
+
+    projected = points @ best_axes
+    low, high = np.percentile(projected, [trim, 100 - trim], axis=0) if trim else (projected.min(axis=0), projected.max(axis=0))
+    order = np.argsort(high - low)[::-1]
+    return best_axes @ ((low + high) / 2), best_axes[:, order], (high - low)[order]
+
+
+def box_extents(points):
+    """
+    Return the extents of the smallest oriented bounding box of a set of points (see minimum_box).
+    The box along the principal axes would be arbitrary on the cube itself.
+
+    Args:
+        points (np.ndarray): (n, 3) array of points.
+
+    Returns:
+        np.ndarray: (3,) extents, largest first.
+    """
+    return minimum_box(points)[2]
+
+
+def is_cube_like(extents, volume, min_aspect=0.5, min_fill=0.3):
+    """
+    Tell if a closed part looks like the reference cube.
+
+    Args:
+        extents (np.ndarray): (3,) extents of the part, largest first (see box_extents).
+        volume (float): Enclosed volume of the part.
+        min_aspect (float, optional): Minimal ratio of the smallest to the largest extent. Defaults to 0.5.
+        min_fill (float, optional): Minimal ratio of the volume to the box volume. Open or flat
+                                    fragments enclose almost nothing. Defaults to 0.3.
+
+    Returns:
+        bool: True if the part is cube-like.
+    """
+    box = float(np.prod(extents))
+    return extents[0] > 0 and extents[2] / extents[0] >= min_aspect and box > 0 and abs(volume) / box >= min_fill
+
+
+def pick_cube_part(parts, min_vertices=100):
+    """
+    Pick the reference cube among the loose parts of a mesh: the smallest cube-like part.
+
+    Args:
+        parts (list[dict]): One dict per part with "extents" (see box_extents), "volume" and "vertices" (count).
+        min_vertices (int, optional): Parts with fewer vertices (scan debris) are ignored. Defaults to 100.
+
+    Returns:
+        int | None: Index of the cube in parts, or None if no part is cube-like.
+    """
+    candidates = [i for i, part in enumerate(parts)
+                  if part["vertices"] >= min_vertices and is_cube_like(part["extents"], part["volume"])]
+    if not candidates:
+        return None
+    return min(candidates, key=lambda i: abs(parts[i]["volume"]))
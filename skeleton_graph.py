@@ -0,0 +1,305 @@
+import argparse
+import csv
+
+import numpy as np
+from scipy import ndimage
+from scipy.sparse import coo_matrix, csr_matrix
+from scipy.sparse.csgraph import connected_components
+from scipy.spatial import cKDTree
+from skimage.morphology import skeletonize
+
+import ply_io
+from leaf_geometry import leaf_table
+from voxel_grid import dense_boxes, sparse_voxelize, voxel_neighbor_pairs
+
+# Columns of the leaf measures (see measure_leaves)
+LEAF_FIELDS = ["leaf", "points", "length_cm", "width_cm", "area_cm2", "surface_area_cm2"]
+
+
+def _labels(n, a, b, mask):
+    # Connected components of the n nodes linked by the edges (a, b) selected by mask
+    graph = coo_matrix((np.ones(int(mask.sum()), dtype=np.int8), (a[mask], b[mask])), shape=(n, n))
+    return connected_components(graph, directed=False)[1]
+
+
+def _compact(labels, selected):
+    # Renumber labels[selected] as 0, 1, ...; -1 elsewhere
+    compact = np.full(len(labels), -1, dtype=np.int64)
+    unique, compact[selected] = np.unique(labels[selected], return_inverse=True)
+    return len(unique), compact
+
+
+def skeletonize_voxels(coords, closing=1):
+    """
+    Skeletonize a sparse voxel set, one connected part at a time (see voxel_grid.dense_boxes).
+
+    Scanned surfaces leave empty voxels inside the occupied ones, which the skeleton would
+    circle around; a morphological closing and hole filling first remove them.
+
+    Args:
+        coords (np.ndarray): (k, 3) int coordinates of the occupied voxels.
+        closing (int, optional): Iterations of the binary closing, 0 for none. Defaults to 1.
+
+    Returns:
+        np.ndarray: (s, 3) int coordinates of the skeleton voxels.
+    """
+    parts = []
+    for corner, box, _ in dense_boxes(coords, padding=closing + 1):
+        if closing:
+            box = ndimage.binary_fill_holes(ndimage.binary_closing(box, iterations=closing))
+        parts.append(corner + np.argwhere(skeletonize(box)))
+    return np.concatenate(parts) if parts else np.empty((0, 3), dtype=np.int64)
+
+
+def skeleton_graph(coords, voxel_size=1.0):
+    """
+    Turn skeleton voxels into a graph of branches.
+
+    Voxels are linked to their 26 neighbours, without the shortcut links of the corners
+    (see voxel_grid.voxel_neighbor_pairs). Voxels of degree 2 are chain voxels; the other
+    ones are nodes, and touching nodes are merged into one node cluster. A cluster linked to
+    exactly two chains is only a thick spot of a chain and is merged into it. Each remaining
+    chain is a branch, between at most two clusters: tips (one branch) or branch points (three
+    or more).
+
+    Args:
+        coords (np.ndarray): (k, 3) int coordinates of the skeleton voxels.
+        voxel_size (float, optional): Edge of the voxels, the unit of the lengths. Defaults to 1.
+
+    Returns:
+        dict: The graph:
+            - "adjacency": (k, k) CSR matrix of the voxel links, weighted by their length.
+            - "degrees": (k,) number of neighbours of every voxel.
+            - "endpoints", "branch_points": voxel rows of degree 1 and of degree >= 3.
+            - "voxel_branch": (k,) branch of every voxel, -1 for node clusters.
+            - "voxel_cluster": (k,) node cluster of every voxel, -1 for branches.
+            - "branch_length": (b,) length of every branch, links to its end clusters included.
+            - "branch_ends": (b, 2) clusters at the ends of every branch, -1 if none.
+            - "cluster_branches": (c,) number of branches linked to every cluster.
+            - "terminal": (b,) True for the branches ending at a tip (leaves).
+            - "spur": (b,) True for terminal branches whose other end is a branch point.
+    """
+    coords = np.asarray(coords, dtype=np.int64)
+    k = len(coords)
+    if k == 0:
+        empty = np.empty(0, dtype=np.int64)
+        return {
+            "adjacency": csr_matrix((0, 0)),
+            "degrees": empty,
+            "endpoints": empty,
+            "branch_points": empty,
+            "voxel_branch": empty,
+            "voxel_cluster": empty,
+            "branch_length": np.empty(0),
+            "branch_ends": np.empty((0, 2), dtype=np.int64),
+            "cluster_branches": empty,
+            "terminal": np.empty(0, dtype=bool),
+            "spur": np.empty(0, dtype=bool),
+        }
+    a, b = voxel_neighbor_pairs(coords, simplify=True)
+    weights = np.linalg.norm(coords[a] - coords[b], axis=1) * voxel_size
+    adjacency = csr_matrix((np.concatenate([weights, weights]), (np.concatenate([a, b]), np.concatenate([b, a]))), shape=(k, k))
+    degrees = np.diff(adjacency.indptr)
+
+    # First pass: clusters of touching nodes and the number of chains linked to them
+    chain = degrees == 2
+    _, cluster = _compact(_labels(k, a, b, ~chain[a] & ~chain[b]), ~chain)
+    mixed = chain[a] != chain[b]
+    node_end = np.where(chain[a], b, a)[mixed]
+    links = np.bincount(cluster[node_end], minlength=cluster.max() + 1)
+    # Clusters in the middle of a chain become part of it
+    chain |= (cluster >= 0) & (links[np.maximum(cluster, 0)] == 2)
+
+    # Second pass: branches (chains) and node clusters
+    n_branches, voxel_branch = _compact(_labels(k, a, b, chain[a] & chain[b]), chain)
+    n_clusters, voxel_cluster = _compact(_labels(k, a, b, ~chain[a] & ~chain[b]), ~chain)
+
+    inner = chain[a] & chain[b]
+    branch_length = np.bincount(voxel_branch[a[inner]], weights=weights[inner], minlength=n_branches)
+    mixed = chain[a] != chain[b]
+    link_branch = np.where(chain[a], voxel_branch[a], voxel_branch[b])[mixed]
+    link_cluster = np.where(chain[a], voxel_cluster[b], voxel_cluster[a])[mixed]
+    branch_length += np.bincount(link_branch, weights=weights[mixed], minlength=n_branches)
+
+    # Ends of the branches: the distinct (branch, cluster) links
+    pairs = np.unique(np.stack([link_branch, link_cluster], axis=1), axis=0)
+    branch_ends = np.full((n_branches, 2), -1, dtype=np.int64)
+    first = np.searchsorted(pairs[:, 0], np.arange(n_branches))
+    last = np.searchsorted(pairs[:, 0], np.arange(n_branches), side="right") - 1
+    has_end = last >= first
+    branch_ends[has_end, 0] = pairs[first[has_end], 1]
+    has_two = last > first
+    branch_ends[has_two, 1] = pairs[last[has_two], 1]
+
+    cluster_branches = np.bincount(pairs[:, 1], minlength=n_clusters)
+    end_links = np.where(branch_ends >= 0, cluster_branches[np.maximum(branch_ends, 0)], 0)
+    terminal = (end_links == 1).any(axis=1)
+    spur = terminal & (end_links >= 3).any(axis=1)
+
+    return {
+        "adjacency": adjacency,
+        "degrees": degrees,
+        "endpoints": np.flatnonzero(degrees == 1),
+        "branch_points": np.flatnonzero(degrees >= 3),
+        "voxel_branch": voxel_branch,
+        "voxel_cluster": voxel_cluster,
+        "branch_length": branch_length,
+        "branch_ends": branch_ends,
+        "cluster_branches": cluster_branches,
+        "terminal": terminal,
+        "spur": spur,
+    }
+
+
+def prune_spurs(coords, min_length, voxel_size=1.0, max_rounds=10):
+    """
+    Remove the short spurs of a skeleton: terminal branches shorter than min_length that leave a branch point.
+
+    Removing a spur can turn its branch point into a chain voxel and reveal new short spurs, so
+    the pruning is repeated until nothing changes (at most max_rounds times).
+
+    Args:
+        coords (np.ndarray): (k, 3) int coordinates of the skeleton voxels.
+        min_length (float): Minimal length of a spur (in the unit of voxel_size).
+        voxel_size (float, optional): Edge of the voxels. Defaults to 1.
+        max_rounds (int, optional): Maximal number of pruning passes. Defaults to 10.
+
+    Returns:
+        tuple[np.ndarray, dict]: The (s, 3) coordinates kept and their graph (see skeleton_graph).
+    """
+    coords = np.asarray(coords, dtype=np.int64)
+    graph = skeleton_graph(coords, voxel_size)
+    for _ in range(max_rounds):
+        short = graph["spur"] & (graph["branch_length"] < min_length)
+        if not short.any():
+            break
+        # The voxels of the spurs and their tip clusters
+        tips = graph["branch_ends"][short]
+        tips = tips[(tips >= 0) & (graph["cluster_branches"][np.maximum(tips, 0)] == 1)]
+        voxel_branch, voxel_cluster = graph["voxel_branch"], graph["voxel_cluster"]
+        remove = ((voxel_branch >= 0) & short[np.maximum(voxel_branch, 0)]) | np.isin(voxel_cluster, tips)
+        coords = coords[~remove]
+        graph = skeleton_graph(coords, voxel_size)
+    return coords, graph
+
+
+def assign_points(points, coords, voxel_branch, origin, voxel_size, max_distance=np.inf):
+    """
+    Assign every point of the cloud to its nearest skeleton branch, in one batched query.
+
+    Args:
+        points (np.ndarray): (n, 3) point coordinates.
+        coords (np.ndarray): (k, 3) int coordinates of the skeleton voxels.
+        voxel_branch (np.ndarray): (k,) branch of every voxel, -1 for node clusters (not assigned).
+        origin (np.ndarray): (3,) corner of voxel (0, 0, 0) (see voxel_grid.voxel_indices).
+        voxel_size (float): Edge of the voxels.
+        max_distance (float, optional): Points farther from every branch get -1. Defaults to no limit.
+
+    Returns:
+        np.ndarray: (n,) branch of every point, -1 if none.
+    """
+    on_branch = np.flatnonzero(voxel_branch >= 0)
+    labels = np.full(len(points), -1, dtype=np.int64)
+    if len(on_branch) == 0:
+        return labels
+    centres = (coords[on_branch] + 0.5) * voxel_size + origin
+    distances, nearest = cKDTree(centres).query(np.asarray(points, dtype=np.float64), distance_upper_bound=max_distance, workers=-1)
+    found = np.isfinite(distances)
+    labels[found] = voxel_branch[on_branch[nearest[found]]]
+    return labels
+
+
+def segment_leaves(points, voxel_size=2.1, min_spur=None, closing=1, up=None):
+    """
+    Split a plant point cloud in leaves from its skeleton.
+
+    The cloud is voxelized (sparse), skeletonized, pruned of its short spurs, and every point
+    is assigned to its nearest branch; the points of the terminal branches are the leaves.
+    The bottom of the stem also ends at a tip: when the up direction is known (e.g. the stick
+    axis of the calibration), the terminal branch with the lowest tip is left out.
+
+    Args:
+        points (np.ndarray): (n, 3) point coordinates.
+        voxel_size (float, optional): Edge of the voxels. Defaults to 2.1.
+        min_spur (float, optional): Spurs shorter than this are pruned. Defaults to 3 voxels.
+        closing (int, optional): See skeletonize_voxels. Defaults to 1.
+        up (np.ndarray, optional): (3,) up direction of the plant. Defaults to None (all the
+                                   terminal branches are leaves).
+
+    Returns:
+        tuple[np.ndarray, dict]: (n,) leaf of every point (0, 1, ... or -1 for the stem and
+        unassigned points) and the graph of the pruned skeleton.
+    """
+    points = np.asarray(points, dtype=np.float64)
+    voxels, _, origin = sparse_voxelize(points, voxel_size)
+    skeleton = skeletonize_voxels(voxels, closing)
+    skeleton, graph = prune_spurs(skeleton, 3 * voxel_size if min_spur is None else min_spur, voxel_size)
+    branch = assign_points(points, skeleton, graph["voxel_branch"], origin, voxel_size)
+
+    # Leaves are numbered 0, 1, ... in the order of the terminal branches; the extra last
+    # entry maps the unassigned points (branch -1) to -1
+    leaves = np.flatnonzero(graph["terminal"])
+    if up is not None and len(leaves):
+        # Height of the tip cluster of every terminal branch
+        ends = graph["branch_ends"][leaves]
+        first_is_tip = (ends[:, 0] >= 0) & (graph["cluster_branches"][np.maximum(ends[:, 0], 0)] == 1)
+        tip = np.where(first_is_tip, ends[:, 0], ends[:, 1])
+        voxel_cluster = graph["voxel_cluster"]
+        in_cluster = voxel_cluster >= 0
+        height = np.bincount(voxel_cluster[in_cluster], weights=skeleton[in_cluster] @ np.asarray(up, dtype=np.float64))
+        size = np.bincount(voxel_cluster[in_cluster])
+        leaves = np.delete(leaves, np.argmin(height[tip] / size[tip]))
+    leaf_of_branch = np.full(len(graph["terminal"]) + 1, -1, dtype=np.int64)
+    leaf_of_branch[leaves] = np.arange(len(leaves))
+    graph["skeleton"] = skeleton
+    graph["origin"] = origin
+    return leaf_of_branch[branch], graph
+
+
+def measure_leaves(points, leaf_labels, cm_per_unit=1.0):
+    """
+    Length, width, projected area and surface area of every leaf, in one call (see leaf_geometry.leaf_table).
+
+    Args:
+        points (np.ndarray): (n, 3) point coordinates.
+        leaf_labels (np.ndarray): (n,) leaf of every point, -1 for none (see segment_leaves).
+        cm_per_unit (float, optional): Scale of the scan (see calibration.py). Defaults to 1.
+
+    Returns:
+        list[dict]: One dict per leaf with leaf, points, length_cm, width_cm, area_cm2 (projected)
+                    and surface_area_cm2; the measures are left out for leaves of fewer than 3 points,
+                    which have no area in leaf_table.
+    """
+    table = leaf_table(points, leaf_labels, cm_per_unit)
+    leaves = []
+    for row in table:
+        leaf = {"leaf": int(row["leaf"]), "points": int(row["points"])}
+        if row["points"] >= 3 and row["length"] > 0:
+            leaf.update({"length_cm": float(row["length"]), "width_cm": float(row["width"]),
+                         "area_cm2": float(row["projected_area"]), "surface_area_cm2": float(row["surface_area"])})
+        leaves.append(leaf)
+    return leaves
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Split a plant point cloud in leaves from its skeleton and measure them.")
+    parser.add_argument("input_file", type=str, help="Path to the plant point cloud (.ply, pot and cube removed).")
+    parser.add_argument("--voxel_size", type=float, default=2.1, help="Edge of the voxels (default: 2.1)")
+    parser.add_argument("--min_spur", type=float, default=None, help="Prune the spurs shorter than this (default: 3 voxels)")
+    parser.add_argument("--scale", type=float, default=1.0, help="Scale of the scan in cm per unit, see calibration.py (default: 1)")
+    parser.add_argument("--up", type=float, nargs=3, default=None, metavar=("X", "Y", "Z"), help="Up direction of the plant, the stem base is then not counted as a leaf")
+    parser.add_argument("--csv", type=str, default=None, help="Save the leaf measures to this CSV file")
+
+    args = parser.parse_args()
+    points = ply_io.xyz(ply_io.read_vertices(args.input_file))
+    leaf_labels, graph = segment_leaves(points, args.voxel_size, args.min_spur, up=args.up)
+    leaves = measure_leaves(points, leaf_labels, args.scale)
+    print(f"{len(graph['branch_length'])} branches, {len(leaves)} leaves, "
+          f"{len(graph['branch_points'])} branch point voxels")
+    for row in leaves:
+        print(", ".join(f"{key}: {value:.3f}" if isinstance(value, float) else f"{key}: {value}" for key, value in row.items()))
+    if args.csv:
+        with open(args.csv, "w", newline="") as file:
+            writer = csv.DictWriter(file, fieldnames=LEAF_FIELDS)
+            writer.writeheader()
+            writer.writerows(leaves)
@@ -0,0 +1,122 @@
+import json
+import os
+import platform
+import time
+from contextlib import contextmanager
+from datetime import datetime
+
+try:
+    import resource  # Not available on Windows
+except ImportError:
+    resource = None
+
+try:
+    import psutil  # Optional, gives the current memory use on every platform
+except ImportError:
+    psutil = None
+
+
+def current_memory_mb():
+    """
+    Return the resident memory of the current process in MB.
+
+    Returns:
+        float | None: Resident set size in MB, or None if it cannot be measured on this platform.
+    """
+    if psutil is not None:
+        return psutil.Process().memory_info().rss / 2**20
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2**20
+    except (OSError, ValueError, AttributeError):
+        return None
+
+
+def peak_memory_mb():
+    """
+    Return the peak resident memory of the current process in MB.
+
+    Returns:
+        float | None: Peak resident set size in MB, or None if it cannot be measured on this platform.
+    """
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    return peak / 2**20 if platform.system() == "Darwin" else peak / 2**10
+
+
+class StageTimer:
+    """
+    Measure the real elapsed time, point count and memory of each stage of a processing run.
+
+    Usage:
+        timer = StageTimer()
+        with timer.stage("load") as stage:
+            points = ...
+            stage["points"] = len(points)
+        timer.write_json("timing.json", input="scan.ply")
+    """
+
+    def __init__(self, verbose=True):
+        self.verbose = verbose
+        self.stages = []
+        self.started = datetime.now().isoformat(timespec="seconds")
+
+    @contextmanager
+    def stage(self, name, points=None):
+        """
+        Time the enclosed block as one stage.
+
+        Args:
+            name (str): Name of the stage (e.g. "load", "dbscan").
+            points (int, optional): Number of points handled by the stage. It can also be set
+                                    inside the block through the yielded record.
+
+        Yields:
+            dict: The record of the stage, completed when the block exits.
+        """
+        record = {"stage": name, "points": points}
+        if self.verbose:
+            print(f"{name}...", end="", flush=True)
+        start = time.perf_counter()
+        try:
+            yield record
+        finally:
+            record["seconds"] = time.perf_counter() - start
+            record["memory_mb"] = current_memory_mb()
+            record["peak_memory_mb"] = peak_memory_mb()
+            self.stages.append(record)
+            if self.verbose:
+                print(" " + self.format_record(record))
+
+    @staticmethod
+    def format_record(record):
+        """Format a stage record as "1.23 s, 1,234,567 points, 512 MB"."""
+        parts = [f"{record['seconds']:.2f} s"]
+        if record["points"] is not None:
+            parts.append(f"{record['points']:,} points")
+        if record["memory_mb"] is not None:
+            parts.append(f"{record['memory_mb']:.0f} MB")
+        return ", ".join(parts)
+
+    @property
+    def total(self):
+        """Total elapsed seconds over all the stages."""
+        return sum(record["seconds"] for record in self.stages)
+
+    def as_dict(self, **extra):
+        """Return the timing record as a JSON serializable dict, extra keys are added at the top level."""
+        return {
+            **extra,
+            "started": self.started,
+            "host": platform.node(),
+            "total_seconds": self.total,
+            "peak_memory_mb": peak_memory_mb(),
+            "stages": self.stages,
+        }
+
+    def write_json(self, path, **extra):
+        """Write the timing record to path (see as_dict)."""
+        with open(path, "w") as file:
+            json.dump(self.as_dict(**extra), file, indent=2, default=str)
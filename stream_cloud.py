@@ -0,0 +1,224 @@
+import argparse
+import json
+
+import numpy as np
+
+import ply_io
+
+# Default memory budget of the chunks, in MB
+DEFAULT_BUDGET_MB = 512
+
+# Bytes of working arrays per vertex of a chunk, on top of the vertex record itself: float64
+# coordinates and colours, voxel keys and the temporaries of the NumPy expressions
+WORK_BYTES_PER_POINT = 160
+
+
+def chunk_size_for(path, memory_budget_mb=DEFAULT_BUDGET_MB):
+    """
+    Number of vertices per chunk so that one chunk and its working arrays fit in the memory budget.
+
+    Args:
+        path (str): Path to the binary .ply file.
+        memory_budget_mb (float, optional): Memory budget in MB. Defaults to DEFAULT_BUDGET_MB.
+
+    Returns:
+        int: Vertices per chunk (at least 1024).
+    """
+    dtype, _, _ = ply_io.vertex_layout(path)
+    return max(1024, int(memory_budget_mb * 2**20) // (dtype.itemsize + WORK_BYTES_PER_POINT))
+
+
+def cloud_stats(path, chunk_size=None, memory_budget_mb=DEFAULT_BUDGET_MB):
+    """
+    Bounds, centroid and colour statistics of a point cloud, computed one chunk at a time.
+
+    Args:
+        path (str): Path to the binary .ply file.
+        chunk_size (int, optional): Vertices per chunk. Defaults to the size given by memory_budget_mb.
+        memory_budget_mb (float, optional): See chunk_size_for.
+
+    Returns:
+        dict: points, min and max (bounds), centroid, and if the cloud has colours color_mean,
+              color_std (floats in [0, 1] like Open3D) and color_histogram (256 bins per channel).
+    """
+    chunk_size = chunk_size or chunk_size_for(path, memory_budget_mb)
+    count = 0
+    low = np.full(3, np.inf)
+    high = np.full(3, -np.inf)
+    total = np.zeros(3)
+    color_total = color_squares = histogram = None
+    for chunk in ply_io.iter_vertex_chunks(path, chunk_size):
+        points = ply_io.xyz(chunk)
+        count += len(chunk)
+        low = np.minimum(low, points.min(axis=0))
+        high = np.maximum(high, points.max(axis=0))
+        total += points.sum(axis=0, dtype=np.float64)
+        colors = ply_io.colors(chunk)
+        if colors is not None:
+            colors = colors.astype(np.float64)
+            if color_total is None:
+                color_total, color_squares, histogram = np.zeros(3), np.zeros(3), np.zeros((3, 256), dtype=np.int64)
+            color_total += colors.sum(axis=0)
+            color_squares += (colors ** 2).sum(axis=0)
+            bins = np.minimum((colors * 256).astype(np.int64), 255)
+            for channel in range(3):
+                histogram[channel] += np.bincount(bins[:, channel], minlength=256)
+
+    stats = {"points": count}
+    if count:
+        stats.update({"min": low.tolist(), "max": high.tolist(), "centroid": (total / count).tolist()})
+    if color_total is not None and count:
+        mean = color_total / count
+        stats.update({"color_mean": mean.tolist(),
+                      "color_std": np.sqrt(np.maximum(color_squares / count - mean ** 2, 0)).tolist(),
+                      "color_histogram": histogram.tolist()})
+    return stats
+
+
+def stream_filter(path, output_file, keep, chunk_size=None, memory_budget_mb=DEFAULT_BUDGET_MB, comments=()):
+    """
+    Write the vertices of a point cloud that pass a filter, one chunk at a time, all properties kept.
+
+    Args:
+        path (str): Path to the binary .ply file.
+        output_file (str): Path of the filtered .ply file.
+        keep (callable | np.ndarray): Function of a vertex chunk returning the boolean mask of the
+                                      vertices to keep, or a boolean mask of all the vertices.
+        chunk_size (int, optional): Vertices per chunk. Defaults to the size given by memory_budget_mb.
+        memory_budget_mb (float, optional): See chunk_size_for.
+        comments (tuple[str], optional): Comment lines added to the header of output_file.
+
+    Returns:
+        dict: points (read) and kept (written).
+    """
+    chunk_size = chunk_size or chunk_size_for(path, memory_budget_mb)
+    dtype, count, _ = ply_io.vertex_layout(path)
+    start = 0
+    with ply_io.PlyWriter(output_file, dtype, comments) as writer:
+        for chunk in ply_io.iter_vertex_chunks(path, chunk_size):
+            mask = keep(chunk) if callable(keep) else keep[start:start + len(chunk)]
+            writer.write(chunk[mask])
+            start += len(chunk)
+    return {"points": count, "kept": writer.count}
+
+
+def color_distance_filter(color, tolerance):
+    """
+    Filter of stream_filter dropping the points close to one colour, as PC_ColorFilter.PY.
+
+    Args:
+        color (tuple[float]): RGB colour to remove, in [0, 1].
+        tolerance (float): Points closer than this to the colour (Euclidean RGB distance) are dropped.
+
+    Returns:
+        callable: Vertex chunk -> boolean mask of the points to keep.
+    """
+    color = np.asarray(color, dtype=np.float32)
+
+    def keep(chunk):
+        colors = ply_io.colors(chunk)
+        if colors is None:
+            return np.ones(len(chunk), dtype=bool)
+        return np.linalg.norm(colors - color, axis=1) > tolerance
+
+    return keep
+
+
+def _merge_voxels(keys, sums, counts, chunk_keys, chunk_sums, chunk_counts):
+    # Add the sums and counts of a chunk to the running ones of the voxels
+    merged, inverse = np.unique(np.concatenate([keys, chunk_keys]), return_inverse=True)
+    inverse = inverse.ravel()
+    merged_sums = np.zeros((len(merged), sums.shape[1]))
+    np.add.at(merged_sums, inverse, np.concatenate([sums, chunk_sums]))
+    merged_counts = np.bincount(inverse, weights=np.concatenate([counts, chunk_counts]), minlength=len(merged))
+    return merged, merged_sums, merged_counts
+
+
+def stream_voxel_downsample(path, output_file, voxel_size, chunk_size=None, memory_budget_mb=DEFAULT_BUDGET_MB):
+    """
+    Voxel downsampling of a point cloud read one chunk at a time, as Open3D's voxel_down_sample:
+    one point per occupied voxel, at the mean position (and colour, and normal) of its points.
+
+    Memory holds one chunk and the running sums of the occupied voxels, never the whole cloud.
+    A first pass over the file gives the bounds of the voxel grid.
+
+    Args:
+        path (str): Path to the binary .ply file.
+        output_file (str): Path of the downsampled .ply file.
+        voxel_size (float): Edge of the voxels.
+        chunk_size (int, optional): Vertices per chunk. Defaults to the size given by memory_budget_mb.
+        memory_budget_mb (float, optional): See chunk_size_for.
+
+    Returns:
+        dict: points (read) and kept (voxels written).
+    """
+    chunk_size = chunk_size or chunk_size_for(path, memory_budget_mb)
+    stats = cloud_stats(path, chunk_size)
+    if not stats["points"]:
+        dtype, _, _ = ply_io.vertex_layout(path)
+        ply_io.write_ply(output_file, np.zeros(0, dtype=dtype))
+        return {"points": 0, "kept": 0}
+    origin = np.asarray(stats["min"])
+    dims = np.floor((np.asarray(stats["max"]) - origin) / voxel_size).astype(np.int64) + 1
+
+    keys = np.zeros(0, dtype=np.int64)
+    sums = counts = None
+    has_colors = has_normals = False
+    for chunk in ply_io.iter_vertex_chunks(path, chunk_size):
+        points = ply_io.xyz(chunk).astype(np.float64)
+        indices = np.minimum(np.floor((points - origin) / voxel_size).astype(np.int64), dims - 1)
+        # Values averaged per voxel: coordinates, then colours and normals if any
+        blocks = [points]
+        colors, normals = ply_io.colors(chunk), ply_io.normals(chunk)
+        has_colors, has_normals = colors is not None, normals is not None
+        if has_colors:
+            blocks.append(colors)
+        if has_normals:
+            blocks.append(normals)
+        values = np.concatenate(blocks, axis=1, dtype=np.float64)
+        chunk_keys, inverse = np.unique(np.ravel_multi_index(tuple(indices.T), dims), return_inverse=True)
+        inverse = inverse.ravel()
+        chunk_sums = np.zeros((len(chunk_keys), values.shape[1]))
+        np.add.at(chunk_sums, inverse, values)
+        if sums is None:
+            sums, counts = np.zeros((0, values.shape[1])), np.zeros(0)
+        keys, sums, counts = _merge_voxels(keys, sums, counts, chunk_keys, chunk_sums,
+                                           np.bincount(inverse, minlength=len(chunk_keys)))
+
+    means = sums / counts[:, None]
+    colors = means[:, 3:6] if has_colors else None
+    normals = means[:, -3:] if has_normals else None
+    if normals is not None:
+        length = np.linalg.norm(normals, axis=1, keepdims=True)
+        normals = np.divide(normals, length, out=np.zeros_like(normals), where=length > 0)
+    ply_io.write_points(output_file, means[:, :3], colors, normals)
+    return {"points": stats["points"], "kept": len(keys)}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Process point clouds too large for memory, one chunk of vertices at a time.")
+    parser.add_argument("input_file", type=str, help="Path to the point cloud (binary .ply).")
+    parser.add_argument("--output", type=str, default=None, help="Path of the output .ply file (with --voxel_size or --remove_color)")
+    parser.add_argument("--voxel_size", type=float, default=None, help="Voxel downsample the cloud to this voxel size")
+    parser.add_argument("--remove_color", type=float, nargs=3, default=None, metavar=("R", "G", "B"), help="Remove the points of this colour (in [0, 1]), as PC_ColorFilter.PY")
+    parser.add_argument("--tolerance", type=float, default=0.1, help="Colour distance of --remove_color (default: 0.1)")
+    parser.add_argument("--memory_budget", type=float, default=DEFAULT_BUDGET_MB, help=f"Memory budget of a chunk in MB (default: {DEFAULT_BUDGET_MB})")
+    parser.add_argument("--chunk_size", type=int, default=None, help="Vertices per chunk (default: from the memory budget)")
+
+    args = parser.parse_args()
+    chunk_size = args.chunk_size or chunk_size_for(args.input_file, args.memory_budget)
+    if args.voxel_size is None and args.remove_color is None:
+        stats = cloud_stats(args.input_file, chunk_size)
+        stats.pop("color_histogram", None)
+        print(json.dumps(stats, indent=2))
+    elif args.output is None:
+        parser.error("--output is needed with --voxel_size or --remove_color")
+    elif args.voxel_size is not None and args.remove_color is not None:
+        parser.error("Give either --voxel_size or --remove_color")
+    elif args.voxel_size is not None:
+        result = stream_voxel_downsample(args.input_file, args.output, args.voxel_size, chunk_size)
+        print(f"{result['points']} points -> {result['kept']} voxels, saved to {args.output}")
+    else:
+        keep = color_distance_filter(args.remove_color, args.tolerance)
+        result = stream_filter(args.input_file, args.output, keep, chunk_size)
+        print(f"{result['points']} points -> {result['kept']} kept, saved to {args.output}")
@@ -0,0 +1,253 @@
+import argparse
+import os
+
+import numpy as np
+
+import ply_io
+from mesh_volume import connected_components, signed_volumes
+
+# Parts of a synthetic scan, the ground truth class of every point
+PARTS = ("plant", "soil", "pot", "cube", "stick")
+PLANT, SOIL, POT, CUBE, STICK = range(len(PARTS))
+
+# Share of the points of every part (the rest of the plant is the stem)
+PART_SHARES = {"leaves": 0.33, "stem": 0.02, SOIL: 0.15, POT: 0.35, CUBE: 0.08, STICK: 0.07}
+
+# Colours (uint8 RGB) of the parts, jittered per point
+PART_COLORS = {PLANT: (60, 150, 50), SOIL: (105, 70, 40), POT: (38, 38, 40), CUBE: (30, 60, 200), STICK: (200, 200, 195)}
+
+# The scans are in mm, like the reference object
+CM_PER_UNIT = 0.1
+
+# Mean of the width profile of the leaf blades, sin(pi t)^0.8 over [0, 1]
+BLADE_FILL = float(np.mean(np.sin(np.pi * (np.arange(100_000) + 0.5) / 100_000) ** 0.8))
+
+REFERENCE_STL = os.path.join(os.path.dirname(os.path.abspath(__file__)), "ReferenceObject.stl")
+
+
+def read_stl(path):
+    """
+    Read the triangles of an STL file (binary or ASCII), with the shared vertices merged.
+
+    Args:
+        path (str): Path to the .stl file.
+
+    Returns:
+        tuple[np.ndarray, np.ndarray]: (n, 3) float64 vertices and (m, 3) triangle vertex indices.
+    """
+    size = os.path.getsize(path)
+    with open(path, "rb") as file:
+        head = file.read(84)
+    count = int(np.frombuffer(head[80:84], dtype="<u4")[0]) if len(head) == 84 else -1
+    if size == 84 + 50 * count:
+        dtype = np.dtype([("normal", "<f4", 3), ("corners", "<f4", (3, 3)), ("attribute", "<u2")])
+        corners = np.fromfile(path, dtype=dtype, offset=84)["corners"].reshape(-1, 3)
+    else:
+        with open(path) as file:
+            corners = np.array([line.split()[1:4] for line in file if line.strip().startswith("vertex")], dtype=np.float64)
+    vertices, inverse = np.unique(corners.astype(np.float64), axis=0, return_inverse=True)
+    return vertices, inverse.reshape(-1, 3)
+
+
+def sample_triangles(vertices, faces, n, rng):
+    """Sample n points uniformly over the surface of a triangle mesh."""
+    corners = vertices[faces]
+    areas = 0.5 * np.linalg.norm(np.cross(corners[:, 1] - corners[:, 0], corners[:, 2] - corners[:, 0]), axis=1)
+    chosen = rng.choice(len(faces), n, p=areas / areas.sum())
+    u, v = rng.random((2, n))
+    flip = u + v > 1
+    u[flip], v[flip] = 1 - u[flip], 1 - v[flip]
+    a, b, c = corners[chosen, 0], corners[chosen, 1], corners[chosen, 2]
+    return a + u[:, None] * (b - a) + v[:, None] * (c - a)
+
+
+def reference_object(path=REFERENCE_STL):
+    """
+    The reference object of ReferenceObject.stl (mm), standing upright: cube on top, stick down,
+    the bottom of the stick at the origin.
+
+    Returns:
+        dict: vertices, faces, part of every face (CUBE or STICK), cube_edge and cube_volume.
+    """
+    vertices, faces = read_stl(path)
+    n_parts, labels = connected_components(len(vertices), faces)
+    # The cube is the part with 8 vertices, the stub and the stick are the others
+    sizes = np.bincount(labels[labels >= 0], minlength=n_parts)
+    cube = int(np.flatnonzero(sizes == 8)[0])
+    face_part = np.where(labels[faces[:, 0]] == cube, CUBE, STICK)
+
+    # The stick runs along x with the cube at -x: turn +x down to -z
+    rotation = np.array([[0.0, 0.0, -1.0], [0.0, 1.0, 0.0], [1.0, 0.0, 0.0]]).T
+    vertices = vertices @ rotation.T
+    vertices -= [*vertices[:, :2].mean(axis=0), vertices[:, 2].min()]
+    cube_faces = faces[face_part == CUBE]
+    return {"vertices": vertices, "faces": faces, "face_part": face_part,
+            "cube_edge": float(np.cbrt(abs(signed_volumes(vertices, cube_faces).sum()))),
+            "cube_volume": float(abs(signed_volumes(vertices, cube_faces).sum()))}
+
+
+def _leaf_points(n, length, width, azimuth, elevation, droop, base, rng):
+    # Points of one lanceolate leaf blade: width profile sin(pi t)^0.8, bent down along its length.
+    # The midrib is an arc of curvature 2 x droop parametrized by its length, and the blade is
+    # bent across it without stretching: the true length and area are those of the flat blade.
+    t = np.empty(0)
+    while len(t) < n:
+        candidates = rng.random(2 * n)
+        t = np.concatenate([t, candidates[rng.random(2 * n) < np.sin(np.pi * candidates) ** 0.8]])
+    t = t[:n]
+    s = (rng.random(n) * 2 - 1) * 0.5 * width * np.sin(np.pi * t) ** 0.8
+    horizontal = np.array([np.cos(azimuth), np.sin(azimuth), 0.0])
+    side = np.array([-np.sin(azimuth), np.cos(azimuth), 0.0])
+    x = t * length
+    # Angle of the midrib above the horizontal decreases linearly along it
+    curvature = 2 * droop
+    outward = (np.sin(elevation) - np.sin(elevation - curvature * x)) / curvature
+    upward = (np.cos(elevation - curvature * x) - np.cos(elevation)) / curvature
+    return base + outward[:, None] * horizontal + upward[:, None] * np.array([0.0, 0.0, 1.0]) + s[:, None] * side
+
+
+def synthetic_scan(n_points=200_000, seed=0, n_leaves=8, noise=0.3, outliers=0.005, color_noise=12, sample_seed=0):
+    """
+    Generate a synthetic scan of a potted plant with its reference object, in mm.
+
+    The scene has a pot (cylinder wall, dark grey), a soil disk (brown), a stem and procedural
+    lanceolate leaves (green, bent down), and the reference object of ReferenceObject.stl (blue
+    cube on a light stick) planted in the soil. Gaussian noise is added to the positions and
+    colours, and a few outliers are spread in the bounding box.
+
+    Args:
+        n_points (int, optional): Number of points. Defaults to 200 000.
+        seed (int, optional): Random seed. Defaults to 0.
+        n_leaves (int, optional): Number of leaves. Defaults to 8.
+        noise (float, optional): Standard deviation of the position noise, in mm. Defaults to 0.3.
+        outliers (float, optional): Share of outlier points. Defaults to 0.005.
+        color_noise (float, optional): Standard deviation of the colour noise (0-255). Defaults to 12.
+        sample_seed (int, optional): Seed of the sampling and noise: scans of the same seed and another
+                                     sample_seed show the same plant, sampled again. Defaults to 0.
+
+    Returns:
+        dict: points ((n, 3) float32), colors ((n, 3) uint8), part ((n,) index in PARTS) and leaf
+              ((n,) leaf of every point, -1 for none) of every point, the true leaves (length,
+              width and area of every blade, in mm), cube_edge, cube_volume (mm³) and cm_per_unit.
+    """
+    # The geometry of the plant depends on seed only, the sampling on both seeds
+    geometry = np.random.default_rng(seed)
+    rng = np.random.default_rng([seed, sample_seed])
+    counts = {name: int(share * n_points) for name, share in PART_SHARES.items()}
+    counts[POT] += n_points - int(n_points * outliers) - sum(counts.values())
+    blocks, parts, leaf_ids = [], [], []
+
+    def add(points, part, leaf=-1):
+        blocks.append(points)
+        parts.append(np.full(len(points), part, dtype=np.int8))
+        leaf_ids.append(np.full(len(points), leaf, dtype=np.int64))
+
+    # Pot: open cylinder, radius 60 mm, 90 mm high, rim at z = 0
+    angle = rng.random(counts[POT]) * 2 * np.pi
+    add(np.stack([60 * np.cos(angle), 60 * np.sin(angle), -90 * rng.random(counts[POT])], axis=1), POT)
+    # Soil: disk just under the rim
+    radius = 58 * np.sqrt(rng.random(counts[SOIL]))
+    angle = rng.random(counts[SOIL]) * 2 * np.pi
+    add(np.stack([radius * np.cos(angle), radius * np.sin(angle), np.full(counts[SOIL], -8.0)], axis=1), SOIL)
+
+    # Stem: thin cylinder from the soil, leaves attached along it
+    stem_height = 70.0
+    height = rng.random(counts["stem"]) * stem_height - 8
+    angle = rng.random(counts["stem"]) * 2 * np.pi
+    add(np.stack([1.5 * np.cos(angle), 1.5 * np.sin(angle), height], axis=1), PLANT)
+    leaves = []
+    per_leaf = np.diff(np.linspace(0, counts["leaves"], n_leaves + 1).astype(int))
+    for leaf, n in enumerate(per_leaf):
+        length, width, elevation, droop, jitter = geometry.uniform([40, 10, 0.3, 0.002, -0.2], [80, 20, 0.8, 0.006, 0.2])
+        base = np.array([0.0, 0.0, -8 + stem_height * (0.2 + 0.75 * leaf / max(n_leaves - 1, 1))])
+        # Golden angle between successive leaves, as a rosette
+        azimuth = leaf * 2.39996 + jitter
+        add(_leaf_points(n, length, width, azimuth, elevation, droop, base, rng), PLANT, leaf)
+        # Area of the flat blade: length x width x mean of the width profile
+        leaves.append({"leaf": leaf, "length": length, "width": width, "area": length * width * BLADE_FILL})
+
+    # Reference object planted in the soil, cube on top
+    reference = reference_object()
+    offset = np.array([35.0, -20.0, -8 - 25.0])
+    for part in (CUBE, STICK):
+        faces = reference["faces"][reference["face_part"] == part]
+        add(sample_triangles(reference["vertices"], faces, counts[part], rng) + offset, part)
+
+    points = np.concatenate(blocks)
+    points += rng.normal(0, noise, points.shape)
+    part = np.concatenate(parts)
+    colors = np.array([PART_COLORS[p] for p in range(len(PARTS))], dtype=np.float64)[part]
+    colors = np.clip(colors + rng.normal(0, color_noise, colors.shape), 0, 255)
+
+    # Outliers in the bounding box, of random colours (labelled as pot, they are not plant)
+    n_outliers = n_points - len(points)
+    low, high = points.min(axis=0), points.max(axis=0)
+    points = np.concatenate([points, low + rng.random((n_outliers, 3)) * (high - low)])
+    colors = np.concatenate([colors, rng.random((n_outliers, 3)) * 255])
+    part = np.concatenate([part, np.full(n_outliers, POT, dtype=np.int8)])
+    leaf_ids.append(np.full(n_outliers, -1, dtype=np.int64))
+
+    # Shuffle, as a scanner does not output the points part by part
+    order = rng.permutation(len(points))
+    return {"points": points[order].astype(np.float32), "colors": colors[order].astype(np.uint8),
+            "part": part[order], "leaf": np.concatenate(leaf_ids)[order], "leaves": leaves,
+            "cube_edge": reference["cube_edge"], "cube_volume": reference["cube_volume"], "cm_per_unit": CM_PER_UNIT}
+
+
+def rigid_transform(angle_deg=8.0, axis=(1.0, 0.0, 0.0), translation=(0.0, 0.0, 0.0)):
+    """4x4 rotation of angle_deg around axis, then translation (the tilt between the 0° and -8° scans)."""
+    axis = np.asarray(axis, dtype=np.float64) / np.linalg.norm(axis)
+    angle = np.radians(angle_deg)
+    cross = np.array([[0, -axis[2], axis[1]], [axis[2], 0, -axis[0]], [-axis[1], axis[0], 0]])
+    transform = np.eye(4)
+    transform[:3, :3] = np.eye(3) + np.sin(angle) * cross + (1 - np.cos(angle)) * cross @ cross
+    transform[:3, 3] = translation
+    return transform
+
+
+def synthetic_pair(n_points=200_000, seed=0, angle_deg=8.0, **options):
+    """
+    Two synthetic scans of the same plant, as the 0° and -8° scans: the same scene sampled twice
+    with independent noise, the second one tilted by angle_deg and shifted.
+
+    Args:
+        n_points (int, optional): Number of points of each scan. Defaults to 200 000.
+        seed (int, optional): Random seed of the scene. Defaults to 0.
+        angle_deg (float, optional): Tilt of the second scan. Defaults to 8.
+        **options: Other synthetic_scan options.
+
+    Returns:
+        tuple[dict, dict, np.ndarray]: The two scans (see synthetic_scan) and the 4x4 transform
+        taking the first one onto the second one.
+    """
+    first = synthetic_scan(n_points, seed, sample_seed=0, **options)
+    second = synthetic_scan(n_points, seed, sample_seed=1, **options)
+    transform = rigid_transform(angle_deg, translation=(5.0, -3.0, 2.0))
+    points = second["points"].astype(np.float64)
+    second["points"] = (points @ transform[:3, :3].T + transform[:3, 3]).astype(np.float32)
+    return first, second, transform
+
+
+def write_scan(path, scan):
+    """Write a synthetic scan as a binary PLY point cloud (points and colours)."""
+    ply_io.write_points(path, scan["points"], scan["colors"])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate synthetic scans of a potted plant with the reference cube.")
+    parser.add_argument("output", type=str, help="Path of the .ply file; with --pair, the directory of the two scans.")
+    parser.add_argument("--points", type=int, default=200_000, help="Number of points (default: 200000)")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed (default: 0)")
+    parser.add_argument("--leaves", type=int, default=8, help="Number of leaves (default: 8)")
+    parser.add_argument("--noise", type=float, default=0.3, help="Position noise in mm (default: 0.3)")
+    parser.add_argument("--pair", action="store_true", help="Write a 0°/-8° pair (Synthetic-<seed>-0_pc.ply and -8_pc.ply)")
+
+    args = parser.parse_args()
+    if args.pair:
+        os.makedirs(args.output, exist_ok=True)
+        first, second, _ = synthetic_pair(args.points, args.seed, n_leaves=args.leaves, noise=args.noise)
+        write_scan(os.path.join(args.output, f"Synthetic-{args.seed}-0_pc.ply"), first)
+        write_scan(os.path.join(args.output, f"Synthetic-{args.seed}-8_pc.ply"), second)
+    else:
+        write_scan(args.output, synthetic_scan(args.points, args.seed, args.leaves, args.noise))
+    print(f"Saved to {args.output}")
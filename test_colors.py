@@ -1,13 +1,18 @@
-import open3d as o3d
 import numpy as np
+import ply_io
+import stream_cloud
 
-# Load the point cloud
-pcd = o3d.io.read_point_cloud('scans/Merge_01_pc.ply')
+# Load the point cloud (memory-mapped, nothing is read before it is used)
+vertices = ply_io.read_vertices('scans/Merge_01_pc.ply')
 
 # Check if color information is available
-if pcd.has_colors():
-    colors = np.asarray(pcd.colors)  # Extract colors as a NumPy array
+colors = ply_io.colors(vertices)  # Colors as a NumPy array in [0, 1]
+if colors is not None:
     print("Colors extracted from point cloud:", colors)
 else:
     print("No color data found in this point cloud.")
 
+# Colour statistics of the whole cloud, read one chunk at a time (bounded memory)
+stats = stream_cloud.cloud_stats('scans/Merge_01_pc.ply', memory_budget_mb=256)
+if "color_mean" in stats:
+    print("Mean color:", np.round(stats["color_mean"], 3), "std:", np.round(stats["color_std"], 3))
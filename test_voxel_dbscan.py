@@ -0,0 +1,25 @@
+import numpy as np
+import pytest
+from sklearn.cluster import DBSCAN
+
+from voxel_dbscan import voxel_dbscan
+
+
+# Grid-quantized coordinates put many neighbours at exactly eps, where sklearn counts them
+@pytest.mark.parametrize("step, eps, min_samples", [(0.1, 0.3, 5), (1.0, 1.0, 4), (1.0, np.sqrt(2), 6)])
+def test_labels_match_sklearn_on_grid(step, eps, min_samples):
+    rng = np.random.default_rng(0)
+    points = np.round(rng.normal(scale=20 * step, size=(20_000, 3)) / step) * step
+    expected = DBSCAN(eps=eps, min_samples=min_samples).fit(points).labels_
+    np.testing.assert_array_equal(voxel_dbscan(points, eps, min_samples, chunk_size=3_000), expected)
+
+
+def test_duplicated_points():
+    rng = np.random.default_rng(1)
+    points = np.repeat(rng.integers(0, 30, (5_000, 3)).astype(float), 3, axis=0)
+    expected = DBSCAN(eps=1.0, min_samples=5).fit(points).labels_
+    np.testing.assert_array_equal(voxel_dbscan(points, 1.0, 5), expected)
+
+
+def test_empty_cloud():
+    assert len(voxel_dbscan(np.zeros((0, 3)))) == 0
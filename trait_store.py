@@ -0,0 +1,264 @@
+import argparse
+import csv
+import datetime
+import os
+import re
+import sqlite3
+
+# Version of the extraction code stored with every value: bump it when a change alters the
+# extracted values, so the results of the old and new code are kept side by side
+PIPELINE_VERSION = "1.1"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS traits (
+    plant TEXT NOT NULL,
+    date TEXT NOT NULL,
+    angle TEXT NOT NULL,
+    trait TEXT NOT NULL,
+    pipeline_version TEXT NOT NULL,
+    value REAL,
+    source TEXT,
+    recorded_at TEXT NOT NULL,
+    PRIMARY KEY (plant, date, angle, trait, pipeline_version)
+);
+CREATE INDEX IF NOT EXISTS traits_by_plant_trait ON traits (plant, trait, date);
+CREATE INDEX IF NOT EXISTS traits_by_trait_date ON traits (trait, date);
+"""
+
+UPSERT = """
+INSERT INTO traits (plant, date, angle, trait, pipeline_version, value, source, recorded_at)
+VALUES (:plant, :date, :angle, :trait, :pipeline_version, :value, :source, :recorded_at)
+ON CONFLICT (plant, date, angle, trait, pipeline_version)
+DO UPDATE SET value = excluded.value, source = excluded.source, recorded_at = excluded.recorded_at
+"""
+
+# Angle of the merged 0° + -8° scans
+MERGED = "merged"
+
+
+def split_scan_name(path):
+    """
+    Get the plant and scan angle from the path of a scan or of one of its outputs.
+
+    The file names follow the scanning protocol (plant name, then -0 or -8 for the angle), with
+    the prefixes and suffixes added by the scripts: A2L-D6-8-C-0_pc.ply is plant A2L-D6-8-C at
+    angle 0, Merge_A2L-D6-8-C_pc_Plant_Filtered.ply is the merged scan of the same plant.
+
+    Args:
+        path (str): Path of the file.
+
+    Returns:
+        tuple[str, str]: plant and angle ("0", "8" or "merged").
+    """
+    name = os.path.splitext(os.path.basename(path))[0]
+    name = re.sub(r"^Merge_", "", name)
+    name = re.sub(r"(_pc)?(_Plant_Filtered\w*)?(_calibration)?$", "", name)
+    match = re.fullmatch(r"(.+)-(0|8)", name)
+    return (match.group(1), match.group(2)) if match else (name, MERGED)
+
+
+def parse_scan_name(path, date=None):
+    """
+    Get the plant, scan angle and scan date from the path of a scan or of one of its outputs.
+
+    The plant and angle come from the file name (see split_scan_name). The date is part of the key
+    of the stored values, so it is never guessed: it is the given session date, else the first
+    YYYY-MM-DD (or YYYYMMDD) found in the path, e.g. the folder of the scan session.
+
+    Args:
+        path (str): Path of the file.
+        date (str, optional): Date of the scan session (YYYY-MM-DD). Defaults to the date in the path.
+
+    Returns:
+        dict: plant, angle ("0", "8" or "merged") and date (ISO format).
+
+    Raises:
+        ValueError: If no date is given and the path has none.
+    """
+    plant, angle = split_scan_name(path)
+    if date is None:
+        found = re.search(r"(?<!\d)(20\d{2})-?(\d{2})-?(\d{2})(?!\d)", path)
+        if not found:
+            raise ValueError(f"No date in {path}, give the date of the scan session")
+        date = datetime.date(*map(int, found.groups())).isoformat()
+    else:
+        date = datetime.date.fromisoformat(date).isoformat()
+    return {"plant": plant, "angle": angle, "date": date}
+
+
+class TraitStore:
+    """
+    SQLite store of the extracted traits: one row per (plant, date, angle, trait, pipeline version).
+
+    Recording a value again for the same key replaces it (upsert), so re-extraction runs do not
+    duplicate rows; a new pipeline version adds rows next to the old ones.
+    """
+
+    def __init__(self, path="traits.sqlite"):
+        """
+        Args:
+            path (str, optional): Path of the SQLite file, created if needed. Defaults to "traits.sqlite".
+        """
+        self.path = path
+        self.connection = sqlite3.connect(path)
+        self.connection.executescript(SCHEMA)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.connection.close()
+
+    def record_many(self, rows, version=PIPELINE_VERSION):
+        """
+        Record (upsert) many trait values in one transaction.
+
+        Args:
+            rows (iterable[dict]): Values with plant, date, trait and value, optionally angle
+                                   (merged by default) and source (file the value comes from).
+            version (str, optional): Pipeline version of the values. Defaults to PIPELINE_VERSION.
+
+        Returns:
+            int: Number of rows written.
+        """
+        now = datetime.datetime.now().isoformat(timespec="seconds")
+        records = [{"angle": MERGED, "source": None, **row, "pipeline_version": version, "recorded_at": now}
+                   for row in rows]
+        with self.connection:
+            self.connection.executemany(UPSERT, records)
+        return len(records)
+
+    def record(self, plant, date, trait, value, angle=MERGED, source=None, version=PIPELINE_VERSION):
+        """Record (upsert) one trait value, see record_many."""
+        self.record_many([{"plant": plant, "date": date, "angle": angle, "trait": trait, "value": value,
+                           "source": source}], version)
+
+    def record_scan(self, path, values, version=PIPELINE_VERSION, date=None):
+        """
+        Record the traits computed from one scan, its plant, angle and date taken from its path (see parse_scan_name).
+
+        Args:
+            path (str): Path of the scan (or of the file the values were computed from).
+            values (dict[str, float]): Trait name -> value. None values are skipped.
+            version (str, optional): Pipeline version of the values. Defaults to PIPELINE_VERSION.
+            date (str, optional): Date of the scan session. Defaults to the date in the path.
+
+        Returns:
+            int: Number of rows written.
+        """
+        scan = parse_scan_name(path, date)
+        return self.record_many([{**scan, "trait": trait, "value": float(value), "source": os.path.basename(path)}
+                                 for trait, value in values.items() if value not in (None, "")], version)
+
+    def time_series(self, plant, trait, angle=MERGED, version=None):
+        """
+        Values of one trait of one plant over time.
+
+        Args:
+            plant (str): Plant name.
+            trait (str): Trait name, e.g. "plant_volume_cm3".
+            angle (str, optional): Scan angle. Defaults to merged.
+            version (str, optional): Pipeline version. Defaults to the latest recorded value of every date.
+
+        Returns:
+            list[tuple[str, float]]: (date, value) pairs, sorted by date.
+        """
+        if version is not None:
+            query = ("SELECT date, value FROM traits WHERE plant = ? AND trait = ? AND angle = ? "
+                     "AND pipeline_version = ? ORDER BY date")
+            return self.connection.execute(query, (plant, trait, angle, version)).fetchall()
+        # SQLite takes the bare columns from the row of max(recorded_at)
+        query = ("SELECT date, value, max(recorded_at) FROM traits WHERE plant = ? AND trait = ? AND angle = ? "
+                 "GROUP BY date ORDER BY date")
+        return [(date, value) for date, value, _ in self.connection.execute(query, (plant, trait, angle))]
+
+    def trait_table(self, trait, angle=MERGED, version=PIPELINE_VERSION):
+        """
+        Values of one trait for every plant and date (e.g. to plot all the growth curves).
+
+        Returns:
+            list[tuple[str, str, float]]: (plant, date, value) rows, sorted by plant and date.
+        """
+        query = ("SELECT plant, date, value FROM traits WHERE trait = ? AND angle = ? AND pipeline_version = ? "
+                 "ORDER BY plant, date")
+        return self.connection.execute(query, (trait, angle, version)).fetchall()
+
+    def plants(self):
+        """Sorted names of the plants having values."""
+        return [row[0] for row in self.connection.execute("SELECT DISTINCT plant FROM traits ORDER BY plant")]
+
+    def traits(self):
+        """Sorted names of the recorded traits."""
+        return [row[0] for row in self.connection.execute("SELECT DISTINCT trait FROM traits ORDER BY trait")]
+
+
+def record_rows(store, rows, traits, directory, file_column="file", version=PIPELINE_VERSION, date=None):
+    """
+    Record the traits of result rows (one per scan, e.g. the rows of mesh_volume.run_batch) in a store.
+
+    Args:
+        store (TraitStore): The store.
+        rows (iterable[dict]): Result rows, one per scan.
+        traits (list[str]): Columns recorded as traits; missing or empty values are skipped.
+        directory (str): Folder of the scans, to find their dates.
+        file_column (str, optional): Column of the scan file names. Defaults to "file".
+        version (str, optional): Pipeline version of the values. Defaults to PIPELINE_VERSION.
+        date (str, optional): Date of the scan session. Defaults to the date in the path of every scan.
+
+    Returns:
+        int: Number of rows written.
+    """
+    written = 0
+    for row in rows:
+        values = {trait: row.get(trait) for trait in traits}
+        written += store.record_scan(os.path.join(directory, row[file_column]), values, version, date)
+    return written
+
+
+def import_csv(store, csv_path, traits, directory=None, file_column="file", version=PIPELINE_VERSION, date=None):
+    """
+    Record the traits of a results CSV file (e.g. the output of mesh_volume.py) in a store, see record_rows.
+
+    Args:
+        store (TraitStore): The store.
+        csv_path (str): Path of the CSV file, one row per scan.
+        traits (list[str]): Columns recorded as traits.
+        directory (str, optional): Folder of the scans, to find their dates. Defaults to the folder of the CSV.
+        file_column (str, optional): Column of the scan file names. Defaults to "file".
+        version (str, optional): Pipeline version of the values. Defaults to PIPELINE_VERSION.
+        date (str, optional): Date of the scan session. Defaults to the date in the path of every scan.
+
+    Returns:
+        int: Number of rows written.
+    """
+    directory = os.path.dirname(os.path.abspath(csv_path)) if directory is None else directory
+    with open(csv_path, newline="") as file:
+        return record_rows(store, csv.DictReader(file), traits, directory, file_column, version, date)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Store of the plant traits (SQLite).")
+    parser.add_argument("store", type=str, help="Path of the SQLite file.")
+    commands = parser.add_subparsers(dest="command", required=True)
+    add = commands.add_parser("import", help="Record the traits of a results CSV file.")
+    add.add_argument("csv_file", type=str, help="Results CSV file, one row per scan.")
+    add.add_argument("--traits", nargs="+", default=["plant_volume_cm3"], help="Columns recorded as traits (default: plant_volume_cm3)")
+    add.add_argument("--scans", type=str, default=None, help="Folder of the scans, to find their dates (default: folder of the CSV)")
+    add.add_argument("--date", type=str, default=None, help="Date of the scan session, YYYY-MM-DD (default: the date in the path of the scans)")
+    add.add_argument("--version", type=str, default=PIPELINE_VERSION, help=f"Pipeline version of the values (default: {PIPELINE_VERSION})")
+    series = commands.add_parser("series", help="Print the time series of a trait of a plant.")
+    series.add_argument("plant", type=str, help="Plant name.")
+    series.add_argument("trait", type=str, help="Trait name.")
+    series.add_argument("--angle", type=str, default=MERGED, help="Scan angle: 0, 8 or merged (default: merged)")
+
+    args = parser.parse_args()
+    with TraitStore(args.store) as store:
+        if args.command == "import":
+            written = import_csv(store, args.csv_file, args.traits, directory=args.scans, version=args.version, date=args.date)
+            print(f"{written} values recorded in {args.store}")
+        else:
+            for date, value in store.time_series(args.plant, args.trait, args.angle):
+                print(f"{date}\t{value}")
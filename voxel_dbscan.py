@@ -0,0 +1,158 @@
+import numpy as np
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+from scipy.spatial import cKDTree
+
+
+def voxel_keys(points, cell_size):
+    """
+    Return the linear index of the voxel containing each point.
+
+    Args:
+        points (np.ndarray): (n, 3) array of point coordinates.
+        cell_size (float): Edge length of the voxels.
+
+    Returns:
+        tuple[np.ndarray, np.ndarray]: (n,) int64 keys, points in the same voxel share the same key,
+                                       and the (3,) dimensions of the grid used to build them.
+    """
+    cells = np.floor((points - points.min(axis=0)) / cell_size).astype(np.int64)
+    dims = cells.max(axis=0) + 1
+    return (cells[:, 0] * dims[1] + cells[:, 1]) * dims[2] + cells[:, 2], dims
+
+
+def _cell_links(tree_points, tree_cells, other_tree, other_cells, eps, chunk_size, n_cells):
+    # Unique (a, b) voxel pairs, a < b, having a point of tree_points within eps of a point of other_tree
+    links = []
+    for start in range(0, len(tree_points), chunk_size):
+        chunk_tree = cKDTree(tree_points[start:start + chunk_size])
+        pairs = chunk_tree.sparse_distance_matrix(other_tree, eps, output_type="ndarray")
+        a = tree_cells[pairs["i"] + start]
+        b = other_cells[pairs["j"]]
+        a, b = np.minimum(a, b), np.maximum(a, b)
+        different = a != b
+        links.append(np.unique(a[different] * n_cells + b[different]))
+    return np.concatenate(links) if links else np.empty(0, dtype=np.int64)
+
+
+def _components(links, n_cells):
+    # Connected components of the voxel graph given as a * n_cells + b links
+    graph = coo_matrix((np.ones(len(links), dtype=np.int8), (links // n_cells, links % n_cells)), shape=(n_cells, n_cells))
+    return connected_components(graph, directed=False)[1]
+
+
+# Offsets of the voxels that can hold a neighbour: the voxel diagonal is eps, so neighbours are
+# at most two voxels away along each axis. Only half of them is kept, links are symmetric.
+_OFFSETS = np.array([(x, y, z) for x in range(-2, 3) for y in range(-2, 3) for z in range(-2, 3) if (x, y, z) > (0, 0, 0)])
+
+
+def voxel_dbscan(points, eps=0.5, min_samples=20, chunk_size=100_000, workers=-1, return_core=False):
+    """
+    DBSCAN clustering accelerated with a voxel grid and KD-trees.
+
+    The cloud is binned in voxels whose diagonal is eps, so all the points of a voxel are
+    neighbours of each other:
+    1. Voxels holding at least min_samples points only contain core points. The neighbours of
+       the remaining points are counted with one KD-tree query that does not keep the lists.
+    2. Core points of the same voxel belong to the same cluster, so only the links between
+       voxels are searched, chunk by chunk, and merged with a connected components pass.
+       Most links are found from one core point per voxel, all the core points are only
+       searched for the voxels that are neighbours but not linked yet.
+    3. Border points take the cluster of their core neighbours.
+
+    The labels are the same as sklearn.cluster.DBSCAN(eps, min_samples).fit(points).labels_,
+    including the numbering of the clusters and the choice made for border points that touch
+    several clusters, while memory stays bounded by chunk_size instead of the whole neighbour lists.
+
+    Args:
+        points (np.ndarray): (n, 3) array of point coordinates.
+        eps (float, optional): Maximum distance between two neighbouring points. Defaults to 0.5.
+        min_samples (int, optional): Number of neighbours (point included) of a core point. Defaults to 20.
+        chunk_size (int, optional): Number of core (or border) points searched per KD-tree query. Defaults to 100000.
+        workers (int, optional): Threads used by the KD-tree queries, -1 for all the CPUs. Defaults to -1.
+        return_core (bool, optional): Also return the core point mask. Defaults to False.
+
+    Returns:
+        np.ndarray: (n,) array of cluster labels, -1 for noise, and with return_core the (n,) boolean
+                    mask of the core points (core_sample_indices_ of sklearn).
+    """
+    points = np.ascontiguousarray(points, dtype=np.float64)
+    n = len(points)
+    labels = np.full(n, -1, dtype=np.int64)
+    core_mask = np.zeros(n, dtype=bool)
+    if n == 0:
+        return (labels, core_mask) if return_core else labels
+
+    # Sorting the points by voxel keeps every chunk spatially compact
+    keys, dims = voxel_keys(points, eps / np.sqrt(3))
+    order = np.argsort(keys, kind="stable")
+    cell_keys, cell, cell_count = np.unique(keys[order], return_inverse=True, return_counts=True)
+    sorted_points = points[order]
+    n_cells = len(cell_keys)
+
+    # 1. Core points
+    is_core = cell_count[cell] >= min_samples
+    sparse = np.flatnonzero(~is_core)
+    if len(sparse):
+        tree = cKDTree(sorted_points)
+        counts = tree.query_ball_point(sorted_points[sparse], eps, return_length=True, workers=workers)
+        is_core[sparse] = counts >= min_samples
+    core = np.flatnonzero(is_core)
+    core_mask[order[core]] = True
+    if len(core) == 0:
+        return (labels, core_mask) if return_core else labels
+
+    # 2. Link the voxels holding core points. A first pass only searches around one core
+    # point per voxel, which already links most of the neighbouring voxels.
+    core_points = sorted_points[core]
+    core_cell = cell[core]
+    core_tree = cKDTree(core_points)
+    core_cells, first = np.unique(core_cell, return_index=True)
+    links = _cell_links(core_points[first], core_cells, core_tree, core_cell, eps, chunk_size, n_cells)
+    cell_cluster = _components(links, n_cells)
+
+    # The second pass is exact: voxels close enough to be linked but still in different
+    # clusters are searched with all their core points.
+    coords = np.stack(np.unravel_index(cell_keys[core_cells], dims), axis=1)
+    unresolved = []
+    for offset in _OFFSETS:
+        neighbour = coords + offset
+        inside = np.all((neighbour >= 0) & (neighbour < dims), axis=1)
+        neighbour_keys = np.ravel_multi_index(neighbour[inside].T, dims)
+        found = np.minimum(np.searchsorted(cell_keys[core_cells], neighbour_keys), len(core_cells) - 1)
+        exists = cell_keys[core_cells[found]] == neighbour_keys
+        a = core_cells[inside][exists]
+        b = core_cells[found[exists]]
+        apart = cell_cluster[a] != cell_cluster[b]
+        unresolved.extend([a[apart], b[apart]])
+    unresolved = np.unique(np.concatenate(unresolved))
+    if len(unresolved):
+        subset = np.isin(core_cell, unresolved)
+        subset_tree = cKDTree(core_points[subset])
+        more = _cell_links(core_points[subset], core_cell[subset], subset_tree, core_cell[subset], eps, chunk_size, n_cells)
+        cell_cluster = _components(np.concatenate([links, more]), n_cells)
+
+    # Number the clusters like sklearn: in the order of their first core point in the input
+    core_cluster = cell_cluster[core_cell]
+    first_core = np.full(cell_cluster.max() + 1, n, dtype=np.int64)
+    np.minimum.at(first_core, core_cluster, order[core])
+    used = np.flatnonzero(first_core < n)
+    rank = np.empty_like(first_core)
+    rank[used[np.argsort(first_core[used])]] = np.arange(len(used))
+    core_label = rank[core_cluster]
+    labels[order[core]] = core_label
+
+    # 3. Border points join the cluster of their core neighbours. sklearn expands the clusters
+    # one after the other, so a point touching several clusters gets the lowest label. The
+    # neighbours within eps (distance eps included, as sklearn) are searched chunk by chunk.
+    non_core = np.flatnonzero(~is_core)
+    if len(non_core):
+        border_label = np.full(len(non_core), n, dtype=np.int64)
+        for start in range(0, len(non_core), chunk_size):
+            chunk_tree = cKDTree(sorted_points[non_core[start:start + chunk_size]])
+            pairs = chunk_tree.sparse_distance_matrix(core_tree, eps, output_type="ndarray")
+            np.minimum.at(border_label, pairs["i"] + start, core_label[pairs["j"]])
+        border = border_label < n
+        labels[order[non_core[border]]] = border_label[border]
+
+    return (labels, core_mask) if return_core else labels
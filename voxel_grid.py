@@ -0,0 +1,209 @@
+import numpy as np
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+
+# Offsets of the 26 neighbours of a voxel; only half of them is kept, adjacency is symmetric
+NEIGHBOR_OFFSETS = np.array([(x, y, z) for x in (-1, 0, 1) for y in (-1, 0, 1) for z in (-1, 0, 1) if (x, y, z) > (0, 0, 0)])
+
+
+def voxel_indices(points, voxel_size, origin=None):
+    """
+    Return the integer (i, j, k) index of the voxel containing each point.
+
+    Args:
+        points (np.ndarray): (n, 3) array of point coordinates.
+        voxel_size (float): Edge length of the voxels.
+        origin (np.ndarray, optional): (3,) corner of voxel (0, 0, 0). Defaults to the minimum of the points.
+
+    Returns:
+        tuple[np.ndarray, np.ndarray]: (n, 3) int64 voxel indices, all >= 0, and the origin.
+    """
+    points = np.asarray(points, dtype=np.float64)
+    origin = points.min(axis=0) if origin is None else np.asarray(origin, dtype=np.float64)
+    # floor, so the maximum point falls in the last voxel instead of one past the grid
+    return np.floor((points - origin) / voxel_size).astype(np.int64), origin
+
+
+def voxelize(points, voxel_size, origin=None):
+    """
+    Count the points of every voxel of a dense grid bounding the points.
+
+    The grid is filled with one np.add.at call; occupancy is counts > 0.
+
+    Args:
+        points (np.ndarray): (n, 3) array of point coordinates.
+        voxel_size (float): Edge length of the voxels.
+        origin (np.ndarray, optional): See voxel_indices.
+
+    Returns:
+        tuple[np.ndarray, np.ndarray]: (X, Y, Z) int32 grid of counts and its origin.
+    """
+    indices, origin = voxel_indices(points, voxel_size, origin)
+    counts = np.zeros(indices.max(axis=0) + 1 if len(indices) else (0, 0, 0), dtype=np.int32)
+    np.add.at(counts, tuple(indices.T), 1)
+    return counts, origin
+
+
+def sparse_voxelize(points, voxel_size, origin=None):
+    """
+    Sparse version of voxelize: only the occupied voxels are stored, as a set of coordinates.
+
+    Memory is proportional to the number of occupied voxels, not to the bounding box, which
+    matters for large plants where most of the box is empty.
+
+    Args:
+        points (np.ndarray): (n, 3) array of point coordinates.
+        voxel_size (float): Edge length of the voxels.
+        origin (np.ndarray, optional): See voxel_indices.
+
+    Returns:
+        tuple[np.ndarray, np.ndarray, np.ndarray]: (k, 3) int64 coordinates of the occupied
+        voxels (sorted), (k,) point counts and the origin.
+    """
+    indices, origin = voxel_indices(points, voxel_size, origin)
+    coords, counts = np.unique(indices, axis=0, return_counts=True)
+    return coords, counts, origin
+
+
+def voxel_downsample(points, voxel_size, values=None, origin=None):
+    """
+    One point per occupied voxel, at the mean position of its points (as Open3D's voxel_down_sample).
+
+    Args:
+        points (np.ndarray): (n, 3) array of point coordinates.
+        voxel_size (float): Edge length of the voxels.
+        values (np.ndarray, optional): (n, c) values averaged the same way, e.g. colours.
+        origin (np.ndarray, optional): See voxel_indices.
+
+    Returns:
+        tuple[np.ndarray, np.ndarray | None]: (k, 3) mean points and (k, c) mean values (None without values).
+    """
+    indices, _ = voxel_indices(points, voxel_size, origin)
+    _, inverse, counts = np.unique(indices, axis=0, return_inverse=True, return_counts=True)
+    inverse = inverse.ravel()
+
+    def means(array):
+        array = np.asarray(array, dtype=np.float64)
+        return np.stack([np.bincount(inverse, weights=column, minlength=len(counts)) for column in array.T], axis=1) / counts[:, None]
+
+    return means(points), None if values is None else means(values)
+
+
+def voxel_keys(coords, dims):
+    """Linear keys of voxel coordinates in a grid of shape dims; they sort like the coordinates."""
+    return np.ravel_multi_index(tuple(np.asarray(coords).T), dims)
+
+
+def voxel_neighbor_pairs(coords, simplify=False):
+    """
+    Find the pairs of 26-adjacent voxels of a sparse voxel set, by hashing instead of a dense grid.
+
+    On thin voxel lines (skeletons), a voxel is also adjacent to the voxel after its neighbour
+    where the line turns, which makes small triangles of links and false branch points. With
+    simplify=True, such shortcut links are left out: the links that are the strictly longest
+    side of a triangle of links. Connectivity is unchanged.
+
+    Args:
+        coords (np.ndarray): (k, 3) int coordinates of distinct voxels.
+        simplify (bool, optional): Leave out the shortcut links. Defaults to False.
+
+    Returns:
+        tuple[np.ndarray, np.ndarray]: Two (p,) arrays of row indices in coords, every adjacent
+                                       pair once.
+    """
+    coords = np.asarray(coords, dtype=np.int64)
+    if len(coords) == 0:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+    # Pad by one voxel so the neighbours of the border voxels have valid keys
+    low = coords.min(axis=0) - 1
+    shifted = coords - low
+    dims = shifted.max(axis=0) + 2
+    keys = voxel_keys(shifted, dims)
+    order = np.argsort(keys)
+    sorted_keys = keys[order]
+
+    def lookup(query):
+        # Row of the voxel at each query coordinate (inside the padded grid), -1 if empty
+        query_keys = voxel_keys(query, dims)
+        found = np.minimum(np.searchsorted(sorted_keys, query_keys), len(keys) - 1)
+        return np.where(sorted_keys[found] == query_keys, order[found], -1)
+
+    first, second = [], []
+    for offset in NEIGHBOR_OFFSETS:
+        rows = lookup(shifted + offset)
+        first.append(np.flatnonzero(rows >= 0))
+        second.append(rows[rows >= 0])
+    a, b = np.concatenate(first), np.concatenate(second)
+    if not simplify:
+        return a, b
+
+    # A link is a shortcut if a third voxel is linked to both of its ends by shorter links
+    step = coords[b] - coords[a]
+    length = (step ** 2).sum(axis=1)
+    shortcut = np.zeros(len(a), dtype=bool)
+    diagonal = np.flatnonzero(length >= 2)
+    for offset in np.concatenate([NEIGHBOR_OFFSETS, -NEIGHBOR_OFFSETS]):
+        rest = step[diagonal] - offset
+        valid = ((offset ** 2).sum() < length[diagonal]) & ((rest ** 2).sum(axis=1) < length[diagonal]) & (np.abs(rest).max(axis=1) <= 1)
+        candidates = diagonal[valid]
+        shortcut[candidates] |= lookup(shifted[a[candidates]] + offset) >= 0
+    return a[~shortcut], b[~shortcut]
+
+
+def voxel_components(coords):
+    """
+    Label the 26-connected components of a sparse voxel set.
+
+    Args:
+        coords (np.ndarray): (k, 3) int coordinates of distinct voxels.
+
+    Returns:
+        tuple[int, np.ndarray]: Number of components and (k,) component of every voxel.
+    """
+    a, b = voxel_neighbor_pairs(coords)
+    graph = coo_matrix((np.ones(len(a), dtype=np.int8), (a, b)), shape=(len(coords), len(coords)))
+    return connected_components(graph, directed=False)
+
+
+def dense_boxes(coords, padding=1):
+    """
+    Split a sparse voxel set in small dense boolean grids, one per connected component.
+
+    Processing components one at a time (e.g. skeletonize) needs the bounding box of each
+    component only, instead of the box of the whole set.
+
+    Args:
+        coords (np.ndarray): (k, 3) int coordinates of distinct voxels.
+        padding (int, optional): Empty voxels added around every box. Defaults to 1.
+
+    Yields:
+        tuple[np.ndarray, np.ndarray, np.ndarray]: Coordinates of voxel (0, 0, 0) of the box,
+        the dense boolean box and the rows of coords it holds.
+    """
+    coords = np.asarray(coords, dtype=np.int64)
+    n_components, labels = voxel_components(coords)
+    order = np.argsort(labels, kind="stable")
+    starts = np.searchsorted(labels[order], np.arange(n_components + 1))
+    for component in range(n_components):
+        rows = order[starts[component]:starts[component + 1]]
+        local = coords[rows]
+        corner = local.min(axis=0) - padding
+        box = np.zeros(local.max(axis=0) - corner + 1 + padding, dtype=bool)
+        box[tuple((local - corner).T)] = True
+        yield corner, box, rows
+
+
+def voxel_degrees(coords, simplify=False):
+    """
+    Number of 26-adjacent occupied voxels of every voxel, e.g. the node degrees of a skeleton.
+
+    Args:
+        coords (np.ndarray): (k, 3) int coordinates of distinct voxels.
+        simplify (bool, optional): Leave out the shortcut links (see voxel_neighbor_pairs),
+                                   use it for skeletons. Defaults to False.
+
+    Returns:
+        np.ndarray: (k,) degrees; 0 for isolated voxels, 1 for end points, 3 or more for branch points.
+    """
+    a, b = voxel_neighbor_pairs(coords, simplify)
+    return np.bincount(a, minlength=len(coords)) + np.bincount(b, minlength=len(coords))